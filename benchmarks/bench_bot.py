@@ -0,0 +1,233 @@
+"""小青離線效能測試。
+
+以假的 Discord 閘道與本機 OpenAI 相容測試伺服器驅動 bot.on_message、draw 與斜線指令，
+回報每秒訊息數（含背景工作完成時間）、尾端延遲、事件循環延遲與 SQLite 寫入速率。
+
+用法：
+    python benchmarks/bench_bot.py --scenario all --messages 200 --llm-latency 0.2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+from fakes import (
+    FakeChannel,
+    FakeGateway,
+    FakeGuild,
+    FakeUser,
+    LoopLagMonitor,
+    StubOpenAIServer,
+    format_report,
+    load_bot,
+)
+
+SCENARIOS = ("chat_burst", "long_chat", "raid", "story_flood", "long_story", "draw", "slash", "noise")
+
+
+async def count_writes(bot_module):
+    """統計會被寫入的資料列數（聊天記錄 + 攻擊記錄）"""
+    stats = await bot_module.storage.global_stats()
+    return stats.get("chat_history", 0) + stats.get("monster_attacks", 0)
+
+
+def build_messages(scenario, gateway, guilds, channel, users, count):
+    """依情境產生合成訊息（平均分散到多個伺服器）"""
+    if scenario == "chat_burst":
+        return [
+            gateway.message(f"第{i}句話，今天心情普通", random.choice(users), random.choice(guilds), channel, mention_bot=True)
+            for i in range(count)
+        ]
+    if scenario == "long_chat":
+        # 少數使用者各自連續聊很多輪，對話歷史越來越長
+        talkers = users[:3]
+        return [
+            gateway.message(f"第{i}句話，我們繼續聊昨天說到的冒險故事，你覺得主角接下來會遇到什麼事呢", talkers[i % len(talkers)], guilds[0], channel, mention_bot=True)
+            for i in range(count)
+        ]
+    if scenario == "story_flood":
+        return [
+            gateway.message(f"小青!{random.choice((300, 500, 1000))}字冒險故事", random.choice(users), random.choice(guilds), channel)
+            for _ in range(count)
+        ]
+    if scenario == "long_story":
+        return [
+            gateway.message(f"小青!{random.choice((3000, 6000, 10000))}字冒險故事", random.choice(users), random.choice(guilds), channel)
+            for _ in range(count)
+        ]
+    if scenario == "noise":
+        return [
+            gateway.message(f"路人的閒聊 {i}", random.choice(users), random.choice(guilds), channel)
+            for i in range(count)
+        ]
+    raise ValueError(scenario)
+
+
+async def run_raid(bot_module, gateway, guild, channel, users, count, concurrency):
+    """先生成怪物，再讓大量玩家同時攻擊"""
+    admin = users[0]
+    await gateway.dispatch(gateway.message("小青!生成怪物", admin, guild, channel))
+    names = await bot_module.storage.get_alive_monsters(guild.id)
+    if not names:
+        raise RuntimeError("生成怪物失敗，無法進行攻擊測試")
+    messages = [
+        gateway.message(f"小青!{random.choice(names)} {random.randint(1, 20)}", random.choice(users), guild, channel)
+        for _ in range(count)
+    ]
+    return await run_messages(gateway, messages, concurrency)
+
+
+def with_replays(messages, rate):
+    """模擬閘道恢復連線後重送：依比例把部分訊息（同一個訊息 ID）再送一次"""
+    replays = random.sample(messages, min(len(messages), int(len(messages) * rate)))
+    return messages + replays
+
+
+async def run_messages(gateway, messages, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def worker(message):
+        async with semaphore:
+            latencies.append(await gateway.dispatch(message))
+
+    await asyncio.gather(*(worker(m) for m in messages))
+    return latencies
+
+
+async def run_draws(gateway, guild, channel, users, count, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def worker(i):
+        async with semaphore:
+            message = gateway.message(f"小青!draw 測試圖片{i}", random.choice(users), guild, channel)
+            latencies.append(await gateway.draw(message, f"測試圖片{i}"))
+
+    await asyncio.gather(*(worker(i) for i in range(count)))
+    return latencies
+
+
+async def run_slash(gateway, guilds, channel, users, count, concurrency):
+    """以斜線指令（defer + followup）抽塔羅牌"""
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def worker(i):
+        async with semaphore:
+            latencies.append(await gateway.slash("塔羅", random.choice(users), random.choice(guilds), channel, question=f"第{i}個問題"))
+
+    await asyncio.gather(*(worker(i) for i in range(count)))
+    return latencies
+
+
+async def run_scenario(bot_module, gateway, scenario, args):
+    guilds = [FakeGuild(random.randint(10 ** 17, 10 ** 18), member_count=args.members) for _ in range(args.guilds)]
+    guild = guilds[0]
+    channel = FakeChannel(
+        random.randint(10 ** 17, 10 ** 18), send_latency=args.send_latency, rate_limit=args.channel_rate_limit,
+        on_rate_limit=bot_module.channel_rate_limits.update,
+    )
+    users = [FakeUser(100_000 + i, f"測試者{i}") for i in range(args.users)]
+
+    lag = LoopLagMonitor()
+    await lag.start()
+    writes_before = await count_writes(bot_module)
+    start = time.perf_counter()
+    if scenario == "raid":
+        latencies = await run_raid(bot_module, gateway, guild, channel, users, args.messages, args.concurrency)
+    elif scenario == "slash":
+        latencies = await run_slash(gateway, guilds, channel, users, args.messages, args.concurrency)
+    elif scenario == "draw":
+        latencies = await run_draws(gateway, guild, channel, users, max(1, args.messages // 10), args.concurrency)
+    elif scenario == "long_chat":
+        # 同一個使用者的對話依序進行，歷史才會逐輪累積
+        messages = build_messages(scenario, gateway, guilds, channel, users, args.messages)
+        latencies = await run_messages(gateway, messages, min(args.concurrency, 3))
+    elif scenario == "long_story":
+        messages = build_messages(scenario, gateway, guilds, channel, users, max(1, args.messages // 10))
+        latencies = await run_messages(gateway, with_replays(messages, args.replay_rate), args.concurrency)
+    else:
+        messages = build_messages(scenario, gateway, guilds, channel, users, args.messages)
+        latencies = await run_messages(gateway, with_replays(messages, args.replay_rate), args.concurrency)
+    # 故事與繪圖在背景工作佇列中執行，等全部完成後才計算總耗時
+    await bot_module.job_queue.join()
+    elapsed = time.perf_counter() - start
+    await lag.stop()
+    writes = await count_writes(bot_module) - writes_before
+    return format_report(scenario, latencies, elapsed, lag.samples, writes, channel.stats())
+
+
+def parse_rate_limit(spec):
+    """解析 --channel-rate-limit（格式：次數/秒數，例如 5/5）"""
+    if not spec:
+        return None
+    count, _, seconds = spec.partition("/")
+    return int(count), float(seconds)
+
+
+def parse_model_latency(spec):
+    """解析 --model-latency（格式：模型=秒數,模型=秒數）"""
+    result = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        model, _, seconds = item.partition("=")
+        result[model.strip()] = float(seconds)
+    return result
+
+
+async def main_async(args):
+    if args.partition_mode:
+        os.environ["DB_PARTITION_MODE"] = args.partition_mode
+    stub = StubOpenAIServer(
+        latency=args.llm_latency, jitter=args.llm_jitter, error_rate=args.error_rate, tokens_per_sec=args.llm_tokens_per_sec,
+        model_latency=parse_model_latency(args.model_latency), prefill_tokens_per_sec=args.llm_prefill_tokens_per_sec,
+    ).start()
+    bot_module = load_bot(args.db)
+    # 將 OpenAI 客戶端指向本機測試伺服器
+    bot_module.client = bot_module.OpenAI(api_key="bench", base_url=stub.base_url, max_retries=0)
+    bot_module.async_client = bot_module.AsyncOpenAI(api_key="bench", base_url=stub.base_url, max_retries=0)
+    gateway = FakeGateway(bot_module)
+    bot_module.loop_watchdog.start(asyncio.get_running_loop())
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    for scenario in scenarios:
+        print(await run_scenario(bot_module, gateway, scenario, args))
+    if args.stats:
+        print(bot_module.metrics.format_stats())
+        print(bot_module.loop_watchdog.format_report())
+        print(json.dumps({"llm_requests": stub.requests, "llm_aborted": stub.aborted}))
+    bot_module.loop_watchdog.stop()
+    bot_module.storage.shutdown()
+    bot_module.chat_memory.shutdown()
+    bot_module.job_queue.shutdown()
+    stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="小青離線效能測試")
+    parser.add_argument("--scenario", choices=("all",) + SCENARIOS, default="all")
+    parser.add_argument("--messages", type=int, default=100, help="每個情境的訊息數")
+    parser.add_argument("--users", type=int, default=20, help="模擬的使用者數")
+    parser.add_argument("--members", type=int, default=50, help="模擬伺服器的身分組成員數")
+    parser.add_argument("--concurrency", type=int, default=50, help="同時處理中的訊息上限")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="測試伺服器平均回應延遲（秒）")
+    parser.add_argument("--llm-jitter", type=float, default=0.05, help="測試伺服器延遲標準差（秒）")
+    parser.add_argument("--model-latency", default="", help="各模型的平均延遲，例如 gpt-5.1=0.8,gpt-4.1-nano=0.1")
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=0.0, help="測試伺服器每秒輸出的 token 數（0 表示不模擬）")
+    parser.add_argument("--llm-prefill-tokens-per-sec", type=float, default=0.0, help="測試伺服器每秒預填的未快取提示 token 數（0 表示不模擬）")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="測試伺服器回傳錯誤的比例")
+    parser.add_argument("--replay-rate", type=float, default=0.0, help="重送的訊息比例（模擬閘道恢復連線後重複收到同一則訊息）")
+    parser.add_argument("--channel-rate-limit", type=parse_rate_limit, default=None, help="模擬 Discord 頻道發送速率限制，例如 5/5（每 5 秒 5 則）")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="模擬 Discord 發送延遲（秒）")
+    parser.add_argument("--db", default=None, help="資料庫路徑（預設使用暫存檔）")
+    parser.add_argument("--partition-mode", choices=("guild", "bucket"), default=None, help="使用依伺服器分割的資料庫")
+    parser.add_argument("--guilds", type=int, default=1, help="訊息平均分散到的伺服器數")
+    parser.add_argument("--stats", action="store_true", help="結束時輸出 小青!stats 與事件循環監控報告")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
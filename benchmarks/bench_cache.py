@@ -0,0 +1,115 @@
+"""discord.py 快取設定檔記憶體測試。
+
+以合成的 GUILD_CREATE 與 MESSAGE_CREATE 資料載入真正的 discord.py 連線狀態，
+比較各 CACHE_PROFILE 實際配置的記憶體（tracemalloc）與 小青!狀態 中的快取估算，
+並回報估算時佔用事件循環的抽樣時間與在執行緒中計算深層大小的時間（三次的中位數）。
+
+用法：
+    python benchmarks/bench_cache.py --guilds 2000 --members 200 --messages 5000
+"""
+import argparse
+import gc
+import json
+import time
+import tracemalloc
+
+import discord
+
+from fakes import load_bot
+
+JOINED_AT = "2024-01-01T00:00:00+00:00"
+
+
+def user_payload(user_id):
+    return {"id": str(user_id), "username": f"玩家{user_id}", "discriminator": "0", "avatar": None}
+
+
+def guild_payload(guild_id, args):
+    """一個伺服器：@everyone 與數個身分組、文字頻道，以及一批成員（相當於載入完成的成員列表）"""
+    roles = [
+        {"id": str(guild_id + i), "name": "@everyone" if i == 0 else f"身分組{i}", "permissions": "0",
+         "position": i, "color": 0, "hoist": False, "managed": False, "mentionable": False}
+        for i in range(args.roles)
+    ]
+    channels = [
+        {"id": str(guild_id + 1000 + i), "type": 0, "name": f"頻道{i}", "position": i,
+         "permission_overwrites": [], "nsfw": False, "parent_id": None}
+        for i in range(args.channels)
+    ]
+    members = [
+        {"user": user_payload(guild_id * 10 + i), "roles": [str(guild_id + 1 + i % (args.roles - 1))],
+         "joined_at": JOINED_AT, "deaf": False, "mute": False, "flags": 0}
+        for i in range(args.members)
+    ]
+    return {
+        "id": str(guild_id), "name": f"伺服器{guild_id}", "owner_id": "1", "roles": roles, "channels": channels,
+        "members": members, "member_count": args.members, "emojis": [], "stickers": [], "features": [],
+        "threads": [], "voice_states": [], "presences": [], "large": False, "unavailable": False,
+    }
+
+
+def message_payload(message_id, guild_id, user_id):
+    return {
+        "id": str(message_id), "channel_id": str(guild_id + 1000), "guild_id": str(guild_id),
+        "author": user_payload(user_id),
+        "member": {"roles": [], "joined_at": JOINED_AT, "deaf": False, "mute": False, "flags": 0},
+        "content": f"路人的閒聊 {message_id}", "timestamp": JOINED_AT, "edited_timestamp": None,
+        "tts": False, "mention_everyone": False, "mentions": [], "mention_roles": [], "attachments": [],
+        "embeds": [], "pinned": False, "type": 0,
+    }
+
+
+def run_profile(bot_module, profile, args):
+    intents = discord.Intents.default()
+    intents.members = args.members_intent
+    gc.collect()
+    tracemalloc.start()
+    client = discord.Client(intents=intents, **bot_module.cache_options(profile, intents))
+    state = client._connection
+    guild_ids = [10 ** 9 * (i + 1) for i in range(args.guilds)]
+    for guild_id in guild_ids:
+        state._add_guild_from_data(guild_payload(guild_id, args))
+    for i in range(args.messages):
+        guild_id = guild_ids[i % len(guild_ids)]
+        state.parse_message_create(message_payload(10 ** 15 + i, guild_id, guild_id * 10 + i % args.members))
+    gc.collect()
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    footprint = bot_module.CacheFootprint(client)
+    sample_ms, measure_ms = [], []
+    for _ in range(3):
+        start = time.perf_counter()
+        categories = footprint.categories()
+        sampled = time.perf_counter()
+        rows = footprint.measure(categories)[1]
+        sample_ms.append((sampled - start) * 1000)
+        measure_ms.append((time.perf_counter() - sampled) * 1000)
+    return {
+        "profile": profile,
+        "allocated_mb": round(allocated / 1024 / 1024, 1),
+        "estimated_mb": round(sum(size for _, _, size in rows) / 1024 / 1024, 1),
+        "loop_sample_ms": round(sorted(sample_ms)[1], 2),
+        "thread_measure_ms": round(sorted(measure_ms)[1], 2),
+        "cached": {name: count for name, count, _ in rows if count},
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="discord.py 快取設定檔記憶體測試")
+    parser.add_argument("--guilds", type=int, default=2000, help="伺服器數")
+    parser.add_argument("--members", type=int, default=200, help="每個伺服器的成員數")
+    parser.add_argument("--channels", type=int, default=20, help="每個伺服器的頻道數")
+    parser.add_argument("--roles", type=int, default=10, help="每個伺服器的身分組數")
+    parser.add_argument("--messages", type=int, default=5000, help="收到的訊息數")
+    parser.add_argument("--no-members-intent", dest="members_intent", action="store_false", help="模擬未啟用 SERVER MEMBERS INTENT")
+    args = parser.parse_args()
+
+    bot_module = load_bot()
+    for profile in bot_module.CACHE_PROFILES:
+        print(json.dumps(run_profile(bot_module, profile, args), ensure_ascii=False))
+    bot_module.storage.shutdown()
+    bot_module.chat_memory.shutdown()
+
+
+if __name__ == "__main__":
+    main()
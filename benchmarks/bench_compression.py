@@ -0,0 +1,208 @@
+"""聊天內容壓縮測試。
+
+以合成的聊天、塔羅占卜與故事語料寫入 DatabaseManager，比較不壓縮、zlib 與 zstd（有安裝時）
+的壓縮率、chat_history 資料表大小，以及寫入與讀取（get_chat_history）的耗時。
+--existing-rows 另外模擬升級：既有的大量未壓縮記錄由 SQLiteStorage 的背景維護訓練字典並分批重新壓縮，
+期間持續聊天，回報查詢延遲與重新壓縮所需時間。
+有安裝 zstandard 時，另外檢查以 zstd 寫入的記錄在未安裝 zstandard 時重新壓縮成 zlib 不會遺失內容。
+
+用法：
+    python benchmarks/bench_compression.py --rows 3000 --existing-rows 100000
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+from fakes import load_bot, percentile
+
+PHRASES = (
+    "小青覺得", "今天的運勢", "塔羅牌顯示", "在冒險的旅途中", "勇者拔出了劍", "森林深處傳來奇怪的聲音",
+    "記得多喝水", "工作上會遇到貴人", "感情方面需要多一點耐心", "這張牌代表新的開始", "逆位的星星",
+    "村莊的長老說", "魔王的城堡", "夥伴們圍著營火", "月亮高高掛在天上", "命運之輪正在轉動",
+)
+
+
+def sentence(rng, count):
+    return "，".join(rng.choice(PHRASES) + rng.choice(("", "啊", "呢", "喔")) for _ in range(count)) + "。"
+
+
+def build_corpus(rows, seed=1):
+    """產生 (使用者訊息, 機器人回應) 組合：短聊天、塔羅占卜與長篇故事"""
+    rng = random.Random(seed)
+    corpus = []
+    for i in range(rows):
+        kind = rng.random()
+        if kind < 0.6:
+            corpus.append((f"小青你覺得{rng.choice(PHRASES)}怎麼樣？", sentence(rng, rng.randint(1, 4))))
+        elif kind < 0.9:
+            corpus.append(("小青!塔羅 我的工作運", "\n".join(sentence(rng, 6) for _ in range(4))))
+        else:
+            corpus.append((f"小青!{rng.choice((300, 500, 1000))}字冒險故事", "\n".join(sentence(rng, 10) for _ in range(10))))
+    return corpus
+
+
+def chat_table_bytes(path):
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = 'chat_history'").fetchone()
+        return row[0]
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+def run_maintenance(manager):
+    """直接執行 SQLiteStorage 在背景進行的壓縮維護，直到沒有工作為止（不計入寫入耗時）"""
+    while True:
+        step = manager.compression_step()
+        if isinstance(step, tuple):
+            owner, samples = step
+            owner.install_dictionary(owner.compressor.build_dictionary(samples), len(samples))
+        elif not step:
+            return
+
+
+def check_missing_codec(bot_module, corpus, users):
+    """以 zstd 寫入後，在未安裝 zstandard 的情況下改用 zlib 並完成重新壓縮：無法解壓的記錄必須保留原樣"""
+    path = os.path.join(tempfile.mkdtemp(prefix="xiaoqing_missing_codec_"), "chat_history.db")
+    manager = bot_module.DatabaseManager(path, compression="zstd")
+    for i, (message, response) in enumerate(corpus):
+        manager.add_chat(1, i % users, f"玩家{i % users}", message, response)
+    manager.close()
+    original = dict(sqlite3.connect(path).execute("SELECT id, response FROM chat_history").fetchall())
+
+    zstandard, bot_module.zstandard = bot_module.zstandard, None
+    try:
+        manager = bot_module.DatabaseManager(path, compression="zlib")
+        for i, (message, response) in enumerate(corpus[:200]):
+            manager.add_chat(1, i % users, f"玩家{i % users}", message, response)
+        run_maintenance(manager)
+        history = [turn for user_id in range(users) for turn in manager.get_chat_history(1, user_id)]
+        status = manager.compressor.format_status()
+        manager.close()
+    finally:
+        bot_module.zstandard = zstandard
+    stored = dict(sqlite3.connect(path).execute("SELECT id, response FROM chat_history").fetchall())
+    kept = [row_id for row_id, value in original.items() if isinstance(value, bytes) and row_id in stored]
+    return {
+        "check": "missing_codec",
+        "status": status,
+        "zstd_rows_kept": sum(1 for row_id in kept if stored[row_id] == original[row_id]),
+        "zstd_rows_lost": sum(1 for row_id in kept if stored[row_id] != original[row_id]),
+        "blank_turns_in_history": sum(1 for _, message, response in history if not message or not response),
+    }
+
+
+def run_codec(bot_module, codec, corpus, users, reads):
+    path = os.path.join(tempfile.mkdtemp(prefix=f"xiaoqing_{codec}_"), "chat_history.db")
+    manager = bot_module.DatabaseManager(path, compression=codec)
+    write_seconds = 0.0
+    for i, (message, response) in enumerate(corpus):
+        start = time.perf_counter()
+        manager.add_chat(1, i % users, f"玩家{i % users}", message, response)
+        write_seconds += time.perf_counter() - start
+        if manager.compressor.has_work:
+            run_maintenance(manager)
+    start = time.perf_counter()
+    for i in range(reads):
+        # 讀出並存取全部 60 筆，量測解壓在內的總耗時
+        list(manager.get_chat_history(1, i % users))
+    read_seconds = time.perf_counter() - start
+    status = manager.compressor.format_status()
+    ratio = manager.compressor.stored_bytes / manager.compressor.raw_bytes if manager.compressor.raw_bytes else 1.0
+    manager.conn.execute("VACUUM")
+    manager.close()
+    return {
+        "codec": codec,
+        "status": status,
+        "stored_ratio": round(ratio, 3),
+        "write_us_per_row": round(write_seconds / len(corpus) * 1e6, 1),
+        "read_us_per_history": round(read_seconds / reads * 1e6, 1),
+        "chat_history_bytes": chat_table_bytes(path),
+        "file_bytes": os.path.getsize(path),
+    }
+
+
+async def run_upgrade(bot_module, codec, existing, corpus, users, seconds):
+    """既有 existing 筆未壓縮的記錄，改用 codec 後持續聊天：量測背景維護期間的查詢延遲"""
+    path = os.path.join(tempfile.mkdtemp(prefix=f"xiaoqing_upgrade_{codec}_"), "chat_history.db")
+    manager = bot_module.DatabaseManager(path, compression="off")
+    for offset in range(0, existing, 5000):
+        manager.conn.executemany(
+            "INSERT INTO chat_history (server_id, user_id, message, response, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [(1, 10_000 + i, *corpus[i % len(corpus)], "2024-01-01 00:00:00") for i in range(offset, min(existing, offset + 5000))],
+        )
+        manager.conn.commit()
+    manager.close()
+
+    storage = bot_module.SQLiteStorage(bot_module.DatabaseManager(path, compression=codec))
+    compressor = storage.manager.compressor
+    latencies = []
+    done_at = None
+    start = time.perf_counter()
+    i = 0
+    while time.perf_counter() - start < seconds or (compressor.has_work and time.perf_counter() - start < seconds * 20):
+        message, response = corpus[i % len(corpus)]
+        began = time.perf_counter()
+        await storage.add_chat(1, i % users, f"玩家{i % users}", message, response)
+        list(await storage.get_chat_history(1, i % users, 10))
+        latencies.append((time.perf_counter() - began) * 1000)
+        i += 1
+        if done_at is None and compressor.dict_id and not compressor.has_work:
+            done_at = time.perf_counter() - start
+        await asyncio.sleep(0.005)
+    if done_at is None and compressor.dict_id and not compressor.has_work:
+        done_at = time.perf_counter() - start
+    status = compressor.format_status()
+    storage.shutdown()
+    return {
+        "codec": codec,
+        "existing_rows": existing,
+        "status": status,
+        "turns": len(latencies),
+        "turn_latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(max(latencies), 2),
+        },
+        "recompressed": compressor.recompressed,
+        "seconds_until_recompressed": round(done_at, 2) if done_at is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天內容壓縮測試")
+    parser.add_argument("--rows", type=int, default=3000, help="寫入的聊天記錄數")
+    parser.add_argument("--users", type=int, default=40, help="用戶數")
+    parser.add_argument("--reads", type=int, default=500, help="讀取 get_chat_history 的次數")
+    parser.add_argument("--existing-rows", type=int, default=0, help="升級測試：既有的未壓縮記錄數（0 表示不測試）")
+    parser.add_argument("--seconds", type=float, default=3.0, help="升級測試：至少持續聊天的秒數")
+    args = parser.parse_args()
+
+    bot_module = load_bot()
+    corpus = build_corpus(args.rows)
+    codecs = ["off", "zlib"] + (["zstd"] if bot_module.zstandard else [])
+    results = [run_codec(bot_module, codec, corpus, args.users, args.reads) for codec in codecs]
+    if args.existing_rows:
+        for codec in codecs[1:]:
+            results.append(asyncio.run(run_upgrade(bot_module, codec, args.existing_rows, corpus, args.users, args.seconds)))
+    if bot_module.zstandard:
+        results.append(check_missing_codec(bot_module, corpus, args.users))
+    bot_module.storage.shutdown()
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    if not bot_module.zstandard:
+        print("未安裝 zstandard，略過 zstd 測試")
+    elif results[-1]["zstd_rows_lost"] or results[-1]["blank_turns_in_history"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""聊天歷史視窗穩定度檢查。
+
+以 DatabaseManager 模擬同一位用戶連續聊很多輪（超過每人 60 條的記錄上限），每輪取得
+get_chat_history(limit, block) 的視窗，檢查視窗起點是否每 block 輪才移動一次；起點未移動時，
+上一輪的視窗內容必須是這一輪開頭完全相同的前綴（提示快取才能命中）。
+
+用法：
+    python benchmarks/bench_history_window.py --turns 200 --limit 10 --block 10
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+from fakes import load_bot
+
+
+def window_text(rows):
+    """依時間順序組成提示中的歷史內容"""
+    return "\n".join(f"{username}: {message}\n小青: {response}" for username, message, response in reversed(list(rows)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天歷史視窗穩定度檢查")
+    parser.add_argument("--turns", type=int, default=200, help="對話輪數")
+    parser.add_argument("--limit", type=int, default=10, help="最近幾輪（MEMORY_RECENT_TURNS）")
+    parser.add_argument("--block", type=int, default=10, help="視窗起點移動的間隔（CHAT_HISTORY_BLOCK）")
+    args = parser.parse_args()
+
+    bot_module = load_bot()
+    path = os.path.join(tempfile.mkdtemp(prefix="xiaoqing_window_"), "chat_history.db")
+    manager = bot_module.DatabaseManager(path)
+    previous = None
+    moves = []  # 視窗起點移動時的輪數
+    for turn in range(1, args.turns + 1):
+        current = window_text(manager.get_chat_history(1, 42, limit=args.limit, block=args.block))
+        if previous is not None and not current.startswith(previous):
+            moves.append(turn)
+        previous = current
+        manager.add_chat(1, 42, "玩家42", f"第{turn}句話", f"第{turn}句回覆")
+    manager.close()
+    bot_module.storage.shutdown()
+
+    gaps = [b - a for a, b in zip(moves, moves[1:])]
+    capped = [gap for move, gap in zip(moves[1:], gaps) if move > 60]
+    result = {
+        "turns": args.turns,
+        "window_moves": len(moves),
+        "first_moves": moves[:8],
+        "min_gap": min(gaps) if gaps else None,
+        "min_gap_after_60_rows": min(capped) if capped else None,
+        "stable": all(gap >= args.block for gap in gaps),
+    }
+    print(json.dumps(result, ensure_ascii=False))
+    if not result["stable"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
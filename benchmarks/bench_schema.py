@@ -0,0 +1,222 @@
+"""資料表結構前後對照測試。
+
+以舊版結構（TEXT 伺服器/用戶 ID、每列重複用戶名稱、攻擊記錄以怪物名稱參照）產生合成資料，
+量測檔案大小、各資料表與索引大小及常用查詢耗時；
+再以 DatabaseManager 開啟同一份資料庫觸發遷移，量測遷移後的結果。
+
+用法：
+    python benchmarks/bench_schema.py --guilds 20 --users 500 --chats 40 --attacks 20000
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from fakes import load_bot
+
+# 遷移前（第 1 版）的資料表結構
+LEGACY_SCHEMA = '''
+    CREATE TABLE chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id TEXT,
+        user_id TEXT,
+        username TEXT,
+        message TEXT,
+        response TEXT,
+        timestamp DATETIME,
+        UNIQUE(server_id, user_id, id)
+    );
+    CREATE TABLE monsters (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id TEXT,
+        name TEXT,
+        tier TEXT,
+        appearance TEXT,
+        max_hp INTEGER,
+        current_hp INTEGER,
+        created_at DATETIME,
+        is_alive INTEGER DEFAULT 1,
+        monster_type TEXT DEFAULT 'personal',
+        UNIQUE(server_id, name)
+    );
+    CREATE TABLE monster_attacks (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id TEXT,
+        monster_name TEXT,
+        user_id TEXT,
+        username TEXT,
+        damage INTEGER,
+        timestamp DATETIME
+    );
+    CREATE TABLE team_goals (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id TEXT,
+        target_count INTEGER,
+        killed_count INTEGER DEFAULT 0,
+        month_year TEXT,
+        created_at DATETIME,
+        UNIQUE(server_id, month_year)
+    );
+    CREATE TABLE personal_kills (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        server_id TEXT,
+        user_id TEXT,
+        username TEXT,
+        kill_count INTEGER DEFAULT 0,
+        month_year TEXT,
+        UNIQUE(server_id, user_id, month_year)
+    );
+'''
+
+# 兩個版本對應的常用查詢（聊天歷史、怪物攻擊者、個人擊殺數）
+QUERIES = {
+    1: {
+        "chat_history": '''
+            SELECT username, message, response FROM chat_history
+            WHERE server_id = ? AND user_id = ? ORDER BY timestamp DESC LIMIT 60
+        ''',
+        "monster_attackers": '''
+            SELECT DISTINCT user_id, username FROM monster_attacks
+            WHERE server_id = ? AND monster_name = ?
+        ''',
+        "personal_kills": '''
+            SELECT kill_count FROM personal_kills
+            WHERE server_id = ? AND user_id = ? AND month_year = ?
+        ''',
+    },
+    2: {
+        "chat_history": '''
+            SELECT u.username, c.message, c.response FROM chat_history c
+            LEFT JOIN users u ON u.user_id = c.user_id
+            WHERE c.server_id = ? AND c.user_id = ? ORDER BY c.id DESC LIMIT 60
+        ''',
+        "monster_attackers": '''
+            SELECT DISTINCT a.user_id, u.username FROM monsters m
+            JOIN monster_attacks a ON a.monster_id = m.id
+            LEFT JOIN users u ON u.user_id = a.user_id
+            WHERE m.server_id = ? AND m.name = ?
+        ''',
+        "personal_kills": '''
+            SELECT kill_count FROM personal_kills
+            WHERE server_id = ? AND user_id = ? AND month_year = ?
+        ''',
+    },
+}
+
+
+def snowflake():
+    return random.randint(10 ** 17, 10 ** 18)
+
+
+def build_legacy_db(path, args):
+    """以舊版結構產生合成資料，回傳查詢用的樣本鍵值"""
+    guilds = [snowflake() for _ in range(args.guilds)]
+    users = [(snowflake(), f"玩家名稱{i}") for i in range(args.users)]
+    month_year = datetime.now().strftime("%Y-%m")
+    start = datetime.now() - timedelta(days=30)
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    chats = []
+    for guild_id in guilds:
+        for user_id, username in random.sample(users, min(len(users), args.users_per_guild)):
+            for i in range(args.chats):
+                chats.append((str(guild_id), str(user_id), username, f"訊息 {i}", f"回應 {i}", start + timedelta(seconds=len(chats))))
+    conn.executemany(
+        "INSERT INTO chat_history (server_id, user_id, username, message, response, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+        chats,
+    )
+    monsters = [(str(guild_id), f"怪物{g}_{i}") for g, guild_id in enumerate(guilds) for i in range(args.monsters)]
+    conn.executemany(
+        "INSERT INTO monsters (server_id, name, tier, appearance, max_hp, current_hp, created_at) VALUES (?, ?, 'B', '外觀', 100, 100, ?)",
+        [(server_id, name, start) for server_id, name in monsters],
+    )
+    attacks = []
+    for i in range(args.attacks):
+        server_id, name = random.choice(monsters)
+        user_id, username = random.choice(users)
+        attacks.append((server_id, name, str(user_id), username, random.randint(1, 20), start + timedelta(seconds=i)))
+    conn.executemany(
+        "INSERT INTO monster_attacks (server_id, monster_name, user_id, username, damage, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
+        attacks,
+    )
+    conn.executemany(
+        "INSERT INTO personal_kills (server_id, user_id, username, kill_count, month_year) VALUES (?, ?, ?, ?, ?)",
+        [(str(guild_id), str(user_id), username, random.randint(1, 30), month_year) for guild_id in guilds for user_id, username in users],
+    )
+    conn.commit()
+    conn.close()
+    chat_keys = [(row[0], row[1]) for row in chats[:: max(1, len(chats) // 200)]]
+    return {
+        "chat_history": chat_keys,
+        "monster_attackers": random.sample(monsters, min(200, len(monsters))),
+        "personal_kills": [(str(random.choice(guilds)), str(random.choice(users)[0]), month_year) for _ in range(200)],
+    }
+
+
+def table_sizes(conn):
+    """各資料表與索引所佔的位元組（需要 SQLite 編譯時啟用 dbstat）"""
+    try:
+        rows = conn.execute("SELECT name, SUM(pgsize) FROM dbstat GROUP BY name ORDER BY name").fetchall()
+    except sqlite3.OperationalError:
+        return {}
+    return {name: size for name, size in rows if not name.startswith("sqlite_s")}
+
+
+def measure(path, version, samples, rounds):
+    """VACUUM 後量測檔案大小與查詢耗時（微秒）"""
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute("VACUUM")
+    timings = {}
+    for name, sql in QUERIES[version].items():
+        keys = samples[name]
+        if version == 2:
+            # 遷移後 ID 為 INTEGER
+            keys = [tuple(int(value) if isinstance(value, str) and value.isdigit() else value for value in key) for key in keys]
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for key in keys:
+                conn.execute(sql, key).fetchall()
+        timings[name] = round((time.perf_counter() - start) / (rounds * len(keys)) * 1e6, 1)
+    result = {
+        "schema_version": version,
+        "file_bytes": os.path.getsize(path),
+        "tables_bytes": table_sizes(conn),
+        "query_us": timings,
+    }
+    conn.close()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="資料表結構前後對照測試")
+    parser.add_argument("--guilds", type=int, default=20, help="伺服器數")
+    parser.add_argument("--users", type=int, default=500, help="用戶數")
+    parser.add_argument("--users-per-guild", type=int, default=100, help="每個伺服器中有聊天記錄的用戶數")
+    parser.add_argument("--chats", type=int, default=40, help="每位用戶的聊天記錄數")
+    parser.add_argument("--monsters", type=int, default=30, help="每個伺服器的怪物數")
+    parser.add_argument("--attacks", type=int, default=20000, help="攻擊記錄數")
+    parser.add_argument("--rounds", type=int, default=5, help="每個查詢樣本重複次數")
+    args = parser.parse_args()
+
+    path = os.path.join(tempfile.mkdtemp(prefix="xiaoqing_schema_"), "chat_history.db")
+    samples = build_legacy_db(path, args)
+    before = measure(path, 1, samples, args.rounds)
+
+    bot_module = load_bot(os.path.join(os.path.dirname(path), "unused.db"))
+    start = time.perf_counter()
+    bot_module.DatabaseManager(path).close()
+    migration_seconds = time.perf_counter() - start
+    after = measure(path, 2, samples, args.rounds)
+    bot_module.storage.shutdown()
+
+    print(json.dumps({"before": before, "after": after, "migration_seconds": round(migration_seconds, 2)}, ensure_ascii=False, indent=2))
+    print(f"檔案大小：{before['file_bytes'] / 1024:.0f}KB → {after['file_bytes'] / 1024:.0f}KB（{after['file_bytes'] / before['file_bytes']:.0%}）")
+
+
+if __name__ == "__main__":
+    main()
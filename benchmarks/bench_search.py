@@ -0,0 +1,128 @@
+"""小青!回憶 搜尋測試。
+
+大量寫入合成對話記錄後，比較 FTS5 trigram 全文索引（search_chat_history）
+與 LIKE '%關鍵字%' 逐筆比對的查詢延遲，並回報全文索引所佔空間。
+一、兩個字的關鍵字另外比較雙字索引（中文）與只比對最新記錄的逐筆比對（英數字）。
+
+用法：
+    python benchmarks/bench_search.py --rows 200000 --guilds 10
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import tempfile
+import time
+
+from bench_compression import build_corpus
+from fakes import load_bot, percentile
+
+LIKE_SQL = '''
+    SELECT u.username, chat_text(c.message), chat_text(c.response), c.timestamp
+    FROM chat_history c
+    LEFT JOIN users u ON u.user_id = c.user_id
+    WHERE c.server_id = ? AND (chat_text(c.message) LIKE ? OR chat_text(c.response) LIKE ?)
+    ORDER BY c.id DESC
+    LIMIT 5
+'''
+
+
+def load_rows(manager, rows, guilds, users, batch=5000):
+    """以批次方式寫入（觸發器同步更新全文索引），每 1000 筆插入一個罕見的代號"""
+    corpus = build_corpus(min(rows, 5000))
+    compress = manager.compressor.compress
+    manager.conn.executemany(
+        "INSERT OR IGNORE INTO users (user_id, username) VALUES (?, ?)",
+        [(user_id, f"玩家{user_id}") for user_id in range(users)],
+    )
+    start = time.perf_counter()
+    for offset in range(0, rows, batch):
+        values = []
+        for i in range(offset, min(rows, offset + batch)):
+            message, response = corpus[i % len(corpus)]
+            if i % 1000 == 0:
+                message = f"{message} 秘密代號{i:07d}"
+            values.append((i % guilds, i % users, compress(message), compress(response), "2024-01-01 00:00:00"))
+        manager.conn.executemany(
+            "INSERT INTO chat_history (server_id, user_id, message, response, timestamp) VALUES (?, ?, ?, ?, ?)",
+            values,
+        )
+        manager.conn.commit()
+    return time.perf_counter() - start
+
+
+def fts_bytes(path, prefix="chat_fts"):
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name LIKE ?", (prefix + "%",)).fetchone()
+        return row[0]
+    except sqlite3.OperationalError:
+        return None
+    finally:
+        conn.close()
+
+
+def timed(func, queries):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        func(*query)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "p50_ms": round(percentile(latencies, 0.50), 2),
+        "p95_ms": round(percentile(latencies, 0.95), 2),
+        "max_ms": round(max(latencies), 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="小青!回憶 搜尋測試")
+    parser.add_argument("--rows", type=int, default=200000, help="對話記錄數")
+    parser.add_argument("--guilds", type=int, default=10, help="伺服器數")
+    parser.add_argument("--users", type=int, default=2000, help="用戶數")
+    parser.add_argument("--queries", type=int, default=30, help="每種查詢的次數")
+    parser.add_argument("--compression", default="auto", help="CHAT_COMPRESSION 設定")
+    args = parser.parse_args()
+
+    bot_module = load_bot()
+    path = os.path.join(tempfile.mkdtemp(prefix="xiaoqing_search_"), "chat_history.db")
+    manager = bot_module.DatabaseManager(path, compression=args.compression)
+    if not manager.fts_enabled:
+        raise SystemExit("此 SQLite 不支援 FTS5 trigram，無法測試")
+    load_seconds = load_rows(manager, args.rows, args.guilds, args.users)
+
+    rng = random.Random(7)
+    rare = [(i % args.guilds, f"秘密代號{i:07d}") for i in rng.sample(range(0, args.rows, 1000), min(args.queries, args.rows // 1000))]
+    common = [(rng.randrange(args.guilds), rng.choice(("命運之輪", "魔王的城堡", "森林深處", "工作運"))) for _ in range(args.queries)]
+    short = [(rng.randrange(args.guilds), rng.choice(("魔王", "森林", "命運", "貓"))) for _ in range(args.queries)]
+    # 不存在的短關鍵字：逐筆比對必須掃過整個伺服器的記錄
+    missing = [(rng.randrange(args.guilds), rng.choice(("火山", "鯨"))) for _ in range(args.queries)]
+    ascii_short = [(rng.randrange(args.guilds), rng.choice(("xy", "qq"))) for _ in range(args.queries)]
+
+    def fts(server_id, keyword):
+        return manager.search_chat_history(server_id, keyword)
+
+    def like(server_id, keyword):
+        pattern = f"%{keyword}%"
+        return manager.conn.execute(LIKE_SQL, (server_id, pattern, pattern)).fetchall()
+
+    results = {
+        "rows": args.rows,
+        "load_rows_per_sec": round(args.rows / load_seconds),
+        "fts_index_bytes": fts_bytes(path),
+        "grams_index_bytes": fts_bytes(path, "chat_grams_fts"),
+        "rare_keyword": {"fts": timed(fts, rare), "like": timed(like, rare)},
+        "common_keyword": {"fts": timed(fts, common), "like": timed(like, common)},
+        "short_keyword": {"grams": timed(fts, short), "like": timed(like, short)},
+        "missing_short_keyword": {"grams": timed(fts, missing), "like": timed(like, missing)},
+        # 英數字短關鍵字沒有索引可用，search_chat_history 只比對最新的 RECALL_SCAN_ROWS 筆
+        "ascii_short_keyword": {"recent_scan": timed(fts, ascii_short), "like": timed(like, ascii_short)},
+    }
+    manager.close()
+    bot_module.storage.shutdown()
+    print(json.dumps(results, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+"""世界王壓力測試。
+
+同一個伺服器的大量玩家同時以「小青!(怪物名稱) (傷害值)」攻擊同一隻怪物，比較：
+- world：世界王，攻擊累加在記憶體分片，由合併協程定期寫入資料庫、節流編輯血條
+- personal：一般怪物，每次攻擊都寫一次資料庫並發一則訊息（對照組）
+回報每秒攻擊數、延遲、資料庫寫入與 Discord 呼叫次數，並檢查擊殺只公告一次、總傷害等於血量。
+
+用法：
+    python benchmarks/bench_world_boss.py --attacks 20000 --rate 2000 --users 2000 --channel-rate-limit 5/5
+"""
+import argparse
+import asyncio
+import json
+import random
+import sqlite3
+import time
+
+from bench_bot import parse_rate_limit
+from fakes import FakeChannel, FakeGateway, FakeGuild, FakeUser, LoopLagMonitor, StubOpenAIServer, load_bot, percentile
+
+
+def monster_damage(bot_module, server_id, name):
+    """直接讀取資料庫：怪物血量、存活狀態、攻擊記錄筆數與總傷害"""
+    conn = sqlite3.connect(bot_module.DB_PATH)
+    try:
+        return conn.execute('''
+            SELECT m.current_hp, m.is_alive, COUNT(a.id), COALESCE(SUM(a.damage), 0)
+            FROM monsters m
+            LEFT JOIN monster_attacks a ON a.monster_id = m.id
+            WHERE m.server_id = ? AND m.name = ?
+            GROUP BY m.id
+        ''', (server_id, name)).fetchone()
+    finally:
+        conn.close()
+
+
+async def spawn(bot_module, gateway, mode, guild, channel, admin, max_hp):
+    if mode == "world":
+        bot_module.world_bosses.hp_per_member = max_hp // guild.member_count
+        await gateway.dispatch(gateway.message("小青!世界王", admin, guild, channel))
+        return bot_module.world_bosses.get(guild.id).name
+    name = f"對照怪物{guild.id % 1000}"
+    await bot_module.storage.add_monster(guild.id, name, "高階", "", max_hp, 'personal')
+    return name
+
+
+async def wait_finished(bot_module, mode, guild, timeout):
+    """世界王：等合併協程寫入最後的傷害並公告擊殺"""
+    if mode != "world":
+        return
+    deadline = time.monotonic() + timeout
+    while bot_module.world_bosses.get(guild.id) is not None and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+
+
+async def run_mode(bot_module, gateway, mode, args):
+    guild = FakeGuild(random.randint(10 ** 17, 10 ** 18), member_count=args.members)
+    channel = FakeChannel(
+        random.randint(10 ** 17, 10 ** 18), send_latency=args.send_latency, rate_limit=args.channel_rate_limit,
+        on_rate_limit=bot_module.channel_rate_limits.update,
+    )
+    users = [FakeUser(100_000 + i, f"勇者{i}") for i in range(args.users)]
+    # 每次傷害都是成員數的倍數，血量剛好等於總傷害：最後一次攻擊完成擊殺，不會有擊殺後的多餘攻擊
+    damages = [random.randint(1, args.max_damage) * args.members for _ in range(args.attacks)]
+    max_hp = sum(damages)
+    name = await spawn(bot_module, gateway, mode, guild, channel, users[0], max_hp)
+    messages = [
+        gateway.message(f"小青!{name} {damage}", random.choice(users), guild, channel)
+        for damage in damages
+    ]
+    sent_before = len(channel.sent)
+
+    lag = LoopLagMonitor()
+    await lag.start()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def worker(message):
+        async with semaphore:
+            latencies.append(await gateway.dispatch(message))
+
+    start = time.perf_counter()
+    tasks = []
+    for i, message in enumerate(messages):
+        # 依 --rate 平均分散送出攻擊（0 表示一次全部送出）
+        delay = start + i / args.rate - time.perf_counter() if args.rate else 0
+        if delay > 0:
+            await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(worker(message)))
+    await asyncio.gather(*tasks)
+    attack_seconds = time.perf_counter() - start
+    await wait_finished(bot_module, mode, guild, args.timeout)
+    elapsed = time.perf_counter() - start
+    await lag.stop()
+
+    hp, alive, rows, damage = monster_damage(bot_module, guild.id, name)
+    # 合併發送時一則訊息可能包含多則通知，以公告字樣出現的次數計算
+    kills = sum((m.content or "").count("被擊敗了！") for m in channel.sent[sent_before:])
+    return {
+        "mode": mode,
+        "attacks": len(latencies),
+        "attacks_per_sec": round(len(latencies) / attack_seconds, 1),
+        "seconds_until_killed": round(elapsed, 2),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(max(latencies), 2),
+        },
+        "loop_lag_ms": {"p99": round(percentile(lag.samples, 0.99), 2), "max": round(max(lag.samples), 2)},
+        "monster": {"max_hp": max_hp, "hp": hp, "alive": bool(alive), "attack_rows": rows, "damage_recorded": damage},
+        "checks": {"killed_once": kills == 1 and not alive, "damage_equals_hp": damage == max_hp},
+        "discord": channel.stats(),
+    }
+
+
+async def main_async(args):
+    stub = StubOpenAIServer(latency=args.llm_latency, jitter=0.0).start()
+    bot_module = load_bot(args.db)
+    bot_module.client = bot_module.OpenAI(api_key="bench", base_url=stub.base_url, max_retries=0)
+    bot_module.async_client = bot_module.AsyncOpenAI(api_key="bench", base_url=stub.base_url, max_retries=0)
+    gateway = FakeGateway(bot_module)
+    modes = ("world", "personal") if args.mode == "both" else (args.mode,)
+    for mode in modes:
+        print(json.dumps(await run_mode(bot_module, gateway, mode, args), ensure_ascii=False))
+    if args.stats:
+        print(bot_module.world_bosses.format_status())
+        print(bot_module.edit_throttle.format_status())
+    bot_module.storage.shutdown()
+    bot_module.chat_memory.shutdown()
+    bot_module.job_queue.shutdown()
+    stub.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="世界王壓力測試")
+    parser.add_argument("--mode", choices=("both", "world", "personal"), default="both")
+    parser.add_argument("--attacks", type=int, default=5000, help="攻擊次數")
+    parser.add_argument("--users", type=int, default=500, help="參與攻擊的玩家數")
+    parser.add_argument("--members", type=int, default=100, help="伺服器成員數（世界王血量依成員數計算）")
+    parser.add_argument("--rate", type=float, default=2000, help="每秒送出的攻擊數（0 表示一次全部送出）")
+    parser.add_argument("--max-damage", type=int, default=20, help="每次攻擊的最大傷害（乘上成員數）")
+    parser.add_argument("--concurrency", type=int, default=500, help="同時處理中的攻擊上限")
+    parser.add_argument("--llm-latency", type=float, default=0.05, help="擊殺誇獎句子的回應延遲（秒）")
+    parser.add_argument("--channel-rate-limit", type=parse_rate_limit, default=None, help="模擬 Discord 頻道發送速率限制，例如 5/5")
+    parser.add_argument("--send-latency", type=float, default=0.0, help="模擬 Discord 發送延遲（秒）")
+    parser.add_argument("--timeout", type=float, default=30.0, help="等待世界王擊殺公告的秒數上限")
+    parser.add_argument("--db", default=None, help="資料庫路徑（預設使用暫存檔）")
+    parser.add_argument("--stats", action="store_true", help="結束時輸出世界王與編輯節流狀態")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
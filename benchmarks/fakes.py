@@ -0,0 +1,456 @@
+"""效能測試用的假 Discord 物件與本機 OpenAI 相容測試伺服器。
+
+不需要真正的 DISCORD_TOKEN / OPENAI_API_KEY：
+- StubOpenAIServer 在背景執行緒中提供 /v1/chat/completions、/v1/images/generations 與 /v1/embeddings，
+  可設定回應延遲與錯誤率
+- FakeGateway 以假的使用者、伺服器、頻道與訊息物件直接驅動 bot.on_message、draw 與斜線指令
+"""
+import asyncio
+import contextlib
+import hashlib
+import itertools
+import json
+import os
+import re
+import random
+import sys
+import tempfile
+import threading
+import time
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 1x1 透明 PNG，作為繪圖下載的假圖片
+PNG_BYTES = bytes.fromhex(
+    "89504e470d0a1a0a0000000d4948445200000001000000010806000000"
+    "1f15c4890000000d49444154789c6360000002000105fe02fea70000000049454e44ae426082"
+)
+
+
+def load_bot(db_path=None):
+    """在不需要真實金鑰的情況下匯入 bot.py（使用暫存資料庫）"""
+    if db_path is None:
+        db_path = os.path.join(tempfile.mkdtemp(prefix="xiaoqing_bench_"), "chat_history.db")
+    os.environ["CHAT_DB_PATH"] = db_path
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    if REPO_ROOT not in sys.path:
+        sys.path.insert(0, REPO_ROOT)
+    import bot as bot_module
+    return bot_module
+
+
+class StubOpenAIServer:
+    """OpenAI 相容的本機測試伺服器（在獨立執行緒與事件循環中執行）"""
+
+    # 模擬供應商的提示快取：前綴至少 1024 token，之後每 128 token 一個快取點
+    CACHE_MIN_TOKENS = 1024
+    CACHE_STEP_TOKENS = 128
+
+    def __init__(self, latency=0.2, jitter=0.05, error_rate=0.0, tokens_per_sec=0.0, model_latency=None,
+                 prefill_tokens_per_sec=0.0):
+        self.latency = latency
+        self.model_latency = model_latency or {}  # 模型 -> 平均延遲（秒），未列出的模型使用 latency
+        self.tokens_per_sec = tokens_per_sec
+        self.prefill_tokens_per_sec = prefill_tokens_per_sec
+        self._prefix_cache = set()
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.requests = 0
+        self.aborted = 0  # 回應前用戶端已經中斷連線的聊天請求（例如被取消的任務）
+        self.port = None
+        self._names = itertools.count(1)
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._ready = threading.Event()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="stub-openai", daemon=True)
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def stop(self):
+        if self._loop:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result(timeout=5)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        from aiohttp import web
+
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._chat)
+        app.router.add_post("/v1/images/generations", self._images)
+        app.router.add_post("/v1/embeddings", self._embeddings)
+        app.router.add_get("/image.png", self._image_file)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        self._loop.run_until_complete(site.start())
+        self.port = site._server.sockets[0].getsockname()[1]
+        self._ready.set()
+        self._loop.run_forever()
+
+    async def _delay(self, model=None):
+        self.requests += 1
+        await asyncio.sleep(max(0.0, random.gauss(self.model_latency.get(model, self.latency), self.jitter)))
+        return random.random() < self.error_rate
+
+    def _reply_text(self, body):
+        prompt = body["messages"][-1]["content"]
+        if "名稱：" in prompt:
+            return f"名稱：測試獸{next(self._names)}"
+        if "大綱" in prompt and "JSON" in prompt:
+            sections = int(re.search(r"分成 (\d+) 段", prompt).group(1))
+            return json.dumps({
+                "title": "測試故事", "setting": "測試鎮",
+                "characters": [{"name": "小明", "description": "勇敢的少年"}],
+                "sections": [f"第{i + 1}段的情節" for i in range(sections)],
+            }, ensure_ascii=False)
+        match = re.search(r"(\d+)字", prompt)
+        if match and "故事" in prompt:
+            return "故" * int(match.group(1))
+        return "好的，我聽到了。"
+
+    def _cached_tokens(self, body):
+        """以「一個字一個 token」計算提示長度，回傳（提示 token 數, 命中快取的前綴 token 數）"""
+        prompt = "".join(f"<{m['role']}>{m['content']}" for m in body["messages"])
+        model = body.get("model", "stub")
+        cached = 0
+        for end in range(self.CACHE_MIN_TOKENS, len(prompt) + 1, self.CACHE_STEP_TOKENS):
+            key = (model, hashlib.sha1(prompt[:end].encode("utf-8")).digest())
+            if key in self._prefix_cache:
+                cached = end
+            self._prefix_cache.add(key)
+        return len(prompt), cached
+
+    async def _chat(self, request):
+        from aiohttp import web
+
+        body = await request.json()
+        if await self._delay(body.get("model")):
+            return web.json_response({"error": {"message": "stub overloaded", "type": "server_error"}}, status=503)
+        prompt_tokens, cached_tokens = self._cached_tokens(body)
+        if self.prefill_tokens_per_sec:
+            # 模擬預填：未命中快取的提示越長，第一個字出來得越慢
+            await asyncio.sleep((prompt_tokens - cached_tokens) / self.prefill_tokens_per_sec)
+        text = self._reply_text(body)
+        if self.tokens_per_sec:
+            # 模擬逐字輸出：回應越長等越久
+            await asyncio.sleep(len(text) / self.tokens_per_sec)
+        if request.transport is None or request.transport.is_closing():
+            self.aborted += 1
+        return web.json_response({
+            "id": f"chatcmpl-{self.requests}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "stub"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(text),
+                "total_tokens": prompt_tokens + len(text),
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            },
+        })
+
+    async def _embeddings(self, request):
+        from aiohttp import web
+
+        body = await request.json()
+        if await self._delay():
+            return web.json_response({"error": {"message": "stub overloaded", "type": "server_error"}}, status=503)
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        dim = body.get("dimensions", 256)
+        data = []
+        for index, text in enumerate(inputs):
+            # 以文字內容決定的假向量，同樣的文字得到同樣的向量
+            rng = random.Random(text)
+            data.append({"object": "embedding", "index": index, "embedding": [rng.uniform(-1, 1) for _ in range(dim)]})
+        tokens = sum(len(text) for text in inputs)
+        return web.json_response({
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "stub"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        })
+
+    async def _images(self, request):
+        from aiohttp import web
+
+        if await self._delay():
+            return web.json_response({"error": {"message": "stub overloaded", "type": "server_error"}}, status=503)
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"url": f"http://127.0.0.1:{self.port}/image.png"}],
+        })
+
+    async def _image_file(self, request):
+        from aiohttp import web
+
+        return web.Response(body=PNG_BYTES, content_type="image/png")
+
+
+class FakeUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id
+        self.name = name
+        self.bot = bot
+        self.roles = []
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+    def mentioned_in(self, message):
+        return any(user.id == self.id for user in message.mentions)
+
+    def __eq__(self, other):
+        return isinstance(other, FakeUser) and other.id == self.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class FakeRole:
+    def __init__(self, role_id, members):
+        self.id = role_id
+        self.members = members
+
+
+class FakeGuild:
+    def __init__(self, guild_id, name="測試伺服器", member_count=50):
+        self.id = guild_id
+        self.name = name
+        self.chunked = True
+        self.member_count = member_count
+        self.members = [FakeUser(10_000 + i, f"玩家{i}") for i in range(member_count)]
+
+    def get_role(self, role_id):
+        return FakeRole(role_id, self.members)
+
+
+# 用戶訊息與機器人訊息共用同一組 ID，才能比較頻道中最新的一則是誰發的
+_snowflakes = itertools.count(1)
+
+
+class FakeSentMessage:
+    def __init__(self, channel, content):
+        self.id = next(_snowflakes)
+        self.channel = channel
+        self.content = content
+
+    async def edit(self, content=None, **kwargs):
+        self.channel.edits += 1
+        self.content = content
+
+    async def delete(self):
+        self.channel.deletes += 1
+
+
+class FakeChannel:
+    """模擬頻道：記錄發送/編輯次數，可設定每次發送的延遲與 Discord 的頻道發送速率限制"""
+
+    def __init__(self, channel_id, send_latency=0.0, rate_limit=None, on_rate_limit=None):
+        self.id = channel_id
+        self.send_latency = send_latency
+        self.rate_limit = rate_limit  # (每個週期的次數, 週期秒數)
+        self.on_rate_limit = on_rate_limit  # 每次發送後以 (頻道 ID, 剩餘次數, 重置秒數) 回報，相當於回應標頭
+        self.last_message_id = None
+        self.sent = []
+        self.edits = 0
+        self.deletes = 0
+        self.rate_limited = 0
+        self._remaining = 0
+        self._reset_at = 0.0
+
+    async def _acquire(self):
+        """與 discord.py 相同：額度用完時等到重置才發送"""
+        limit, per = self.rate_limit
+        while True:
+            now = time.monotonic()
+            if now >= self._reset_at:
+                self._reset_at = now + per
+                self._remaining = limit
+            if self._remaining > 0:
+                self._remaining -= 1
+                return
+            self.rate_limited += 1
+            await asyncio.sleep(self._reset_at - now)
+
+    async def send(self, content=None, **kwargs):
+        if self.rate_limit:
+            await self._acquire()
+        if self.send_latency:
+            await asyncio.sleep(self.send_latency)
+        msg = FakeSentMessage(self, content)
+        self.sent.append(msg)
+        self.last_message_id = msg.id
+        if self.rate_limit and self.on_rate_limit:
+            self.on_rate_limit(self.id, self._remaining, max(0.0, self._reset_at - time.monotonic()))
+        return msg
+
+    def stats(self):
+        return {"sent": len(self.sent), "edits": self.edits, "deletes": self.deletes, "rate_limited": self.rate_limited}
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+
+class FakeMessage:
+    def __init__(self, content, author, guild, channel, mentions=()):
+        self.id = next(_snowflakes)
+        self.content = content
+        self.author = author
+        self.guild = guild
+        self.channel = channel
+        self.mentions = list(mentions)
+        self.mention_everyone = False
+        self._state = None
+
+
+class FakeContext:
+    """draw 指令使用的最小 Context"""
+
+    def __init__(self, message):
+        self.message = message
+        self.author = message.author
+        self.channel = message.channel
+        self.guild = message.guild
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+    def typing(self):
+        return self.channel.typing()
+
+
+class FakeInteractionResponse:
+    def __init__(self):
+        self.deferred = False
+
+    async def defer(self, thinking=False, **kwargs):
+        self.deferred = True
+
+
+class FakeFollowup:
+    def __init__(self, channel):
+        self.channel = channel
+
+    async def send(self, content=None, wait=False, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+class FakeInteraction:
+    """斜線指令使用的最小 Interaction（defer 後以 followup 回覆到頻道）"""
+
+    def __init__(self, user, guild, channel):
+        self.user = user
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = channel
+        self.response = FakeInteractionResponse()
+        self.followup = FakeFollowup(channel)
+
+
+class LoopLagMonitor:
+    """以固定間隔睡眠並量測實際醒來的延遲，估算事件循環延遲"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - start - self.interval) * 1000)
+
+    async def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+        # 讓取樣任務先進入第一次睡眠，才能量到之後的阻塞
+        await asyncio.sleep(0)
+
+    async def stop(self):
+        # 等待進行中的取樣完成，避免漏掉最後一次阻塞
+        await asyncio.sleep(self.interval * 2)
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+
+
+class FakeGateway:
+    """把合成的訊息直接送進 bot.on_message / draw"""
+
+    def __init__(self, bot_module):
+        self.bot_module = bot_module
+        self.bot_user = FakeUser(1, "小青", bot=True)
+        # discord.py 的 bot.user 取自連線狀態
+        bot_module.bot._connection.user = self.bot_user
+
+    def message(self, content, author, guild, channel, mention_bot=False):
+        mentions = [self.bot_user] if mention_bot else []
+        if mention_bot:
+            content = f"<@{self.bot_user.id}> {content}"
+        return FakeMessage(content, author, guild, channel, mentions)
+
+    async def dispatch(self, message):
+        """送出一則訊息，回傳處理耗時（毫秒）"""
+        start = time.perf_counter()
+        # 閘道收到訊息時，這則訊息成為頻道中最新的一則
+        message.channel.last_message_id = message.id
+        await self.bot_module.on_message(message)
+        return (time.perf_counter() - start) * 1000
+
+    async def slash(self, name, user, guild, channel, **options):
+        """執行斜線指令的 callback（略過 Discord 端的選項解析）"""
+        command = self.bot_module.bot.tree.get_command(name)
+        start = time.perf_counter()
+        await command.callback(FakeInteraction(user, guild, channel), **options)
+        return (time.perf_counter() - start) * 1000
+
+    async def draw(self, message, prompt):
+        start = time.perf_counter()
+        with self.bot_module.metrics.trace_message():
+            await self.bot_module.draw.callback(FakeContext(message), prompt=prompt)
+        return (time.perf_counter() - start) * 1000
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def format_report(name, latencies, elapsed, lag_samples, db_writes, discord_calls=None):
+    report = {
+        "scenario": name,
+        "messages": len(latencies),
+        "messages_per_sec": round(len(latencies) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 0.50), 2),
+            "p95": round(percentile(latencies, 0.95), 2),
+            "p99": round(percentile(latencies, 0.99), 2),
+            "max": round(max(latencies), 2) if latencies else 0.0,
+        },
+        "loop_lag_ms": {
+            "p99": round(percentile(lag_samples, 0.99), 2),
+            "max": round(max(lag_samples), 2) if lag_samples else 0.0,
+        },
+        "sqlite_writes_per_sec": round(db_writes / elapsed, 2) if elapsed else 0.0,
+    }
+    if discord_calls is not None:
+        report["discord"] = discord_calls
+    return json.dumps(report, ensure_ascii=False)
@@ -1,8 +1,9 @@
 from dotenv import load_dotenv
 import os
 import discord
+from discord import app_commands
 from discord.ext import commands
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 import asyncio
 import sqlite3
 from datetime import datetime, timedelta
@@ -13,64 +14,1352 @@ import random
 import shutil
 import psutil
 import socket
+import time
+import bisect
+import queue
+import logging
+import logging.handlers
+import contextvars
+import functools
+import sys
+import threading
+import signal
+import argparse
+import subprocess
+import glob
+import zlib
+import struct
+import json
+import hashlib
+import itertools
+import math
+import types
+import unicodedata
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from collections import defaultdict, deque, OrderedDict
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard  # 選用：聊天內容的 zstd 字典壓縮
+except ImportError:
+    zstandard = None
+
+try:
+    import numpy as np  # 選用：長期記憶的向量索引
+except ImportError:
+    np = None
 
 # 載入環境變數
 load_dotenv()
 
-# 檢查必要的環境變數
+# 設置非同步緩衝日誌：熱路徑只把紀錄放進佇列，由背景執行緒寫入 stdout
+log_queue = queue.SimpleQueue()
+logger = logging.getLogger('xiaoqing')
+logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+logger.addHandler(logging.handlers.QueueHandler(log_queue))
+logger.propagate = False
+_log_stream_handler = logging.StreamHandler()
+# 分片工作程序在每行日誌前標示負責的分片
+_log_shard_tag = f"[分片 {os.getenv('SHARD_IDS')}] " if os.getenv('SHARD_IDS') else ""
+_log_stream_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s ' + _log_shard_tag + '%(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, _log_stream_handler)
+log_listener.start()
+
+# 讀取環境變數（必要變數在 main() 啟動前檢查，讓模組可被效能測試工具匯入）
 discord_token = os.getenv('DISCORD_TOKEN')
 openai_api_key = os.getenv('OPENAI_API_KEY')
 
-if not discord_token:
-    raise ValueError("缺少 DISCORD_TOKEN 環境變數")
-if not openai_api_key:
-    raise ValueError("缺少 OPENAI_API_KEY 環境變數")
+# 資料庫路徑，可用 CHAT_DB_PATH 覆寫（例如效能測試時使用暫存資料庫）
+DB_PATH = os.getenv('CHAT_DB_PATH') or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_history.db')
 
-# 檢查磁碟空間和權限
-try:
-    disk = psutil.disk_usage('.')
-    if disk.percent > 95:
-        print(f"警告：磁碟使用率過高 ({disk.percent}%)")
-    if disk.free < 100 * 1024 * 1024:  # 少於 100MB
-        print(f"警告：可用磁碟空間不足 ({disk.free / 1024 / 1024:.1f}MB)")
-    
-    # 檢查當前目錄的寫入權限
-    test_file = os.path.join(os.getcwd(), 'test_write.tmp')
+# 設置 OpenAI API 客戶端
+client = OpenAI(api_key=openai_api_key or "missing")
+# 非同步客戶端：在事件循環中等待回應，任務被取消時會一併中斷 HTTP 請求
+async_client = AsyncOpenAI(api_key=openai_api_key or "missing")
+
+# 延遲直方圖（固定分桶，記錄為 O(log n)，分位數由分桶內插估算）
+class LatencyHistogram:
+    # 分桶上限（毫秒），最後一桶為無限大
+    BOUNDS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 60000, 120000, float('inf'))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS_MS)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, ms):
+        """記錄一次耗時（毫秒）"""
+        self.counts[bisect.bisect_left(self.BOUNDS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        if ms > self.max_ms:
+            self.max_ms = ms
+
+    def quantile(self, q):
+        """以分桶線性內插估算分位數（毫秒）"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for i, bucket_count in enumerate(self.counts):
+            if cumulative + bucket_count >= rank and bucket_count:
+                lower = self.BOUNDS_MS[i - 1] if i > 0 else 0.0
+                upper = min(self.BOUNDS_MS[i], self.max_ms)
+                if upper <= lower:
+                    return upper
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.max_ms
+
+# 目前訊息的追蹤資訊（每個處理中的訊息各自一份）
+class MessageTrace:
+    __slots__ = ("start", "command")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.command = None
+
+_current_trace = contextvars.ContextVar('current_trace', default=None)
+_active_stage = contextvars.ContextVar('active_stage', default=None)
+
+# 熱路徑效能指標：各指令、各階段（route、db、memory、llm、send、total）的延遲與 token 用量
+class MetricsRegistry:
+    STAGES = ("route", "db", "memory", "llm", "send", "total")
+
+    def __init__(self):
+        self.histograms = defaultdict(LatencyHistogram)  # (command, stage) -> 直方圖
+        self.tokens = defaultdict(int)  # (command, kind) -> token 數
+        self.cache = defaultdict(lambda: [0, 0])  # 快取名稱 -> [命中, 未命中]
+        self.messages_total = 0
+        self.messages_routed = 0
+        self.messages_rejected = defaultdict(int)  # 預先過濾丟棄的原因 -> 訊息數
+
+    @contextmanager
+    def trace_message(self):
+        """追蹤一則訊息從進入到處理完成的完整流程"""
+        trace = MessageTrace()
+        token = _current_trace.set(trace)
+        self.messages_total += 1
+        try:
+            yield trace
+        finally:
+            _current_trace.reset(token)
+            if trace.command:
+                self.observe(trace.command, "total", (time.perf_counter() - trace.start) * 1000)
+
+    def route(self, command):
+        """標記目前訊息對應的指令，並記錄路由耗時"""
+        trace = _current_trace.get()
+        if trace is None or trace.command:
+            return
+        trace.command = command
+        self.messages_routed += 1
+        self.observe(command, "route", (time.perf_counter() - trace.start) * 1000)
+
+    @contextmanager
+    def stage(self, stage):
+        """記錄目前指令某個階段的耗時（巢狀的同一階段只記錄最外層）"""
+        if _active_stage.get() == stage:
+            yield
+            return
+        token = _active_stage.set(stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            _active_stage.reset(token)
+            self.observe(self.current_command(), stage, (time.perf_counter() - start) * 1000)
+
+    def current_command(self):
+        trace = _current_trace.get()
+        return trace.command if trace and trace.command else "background"
+
+    def observe(self, command, stage, ms):
+        self.histograms[(command, stage)].observe(ms)
+
+    def record_usage(self, response):
+        """記錄 OpenAI 回應中的 token 用量與提示快取命中"""
+        usage = getattr(response, "usage", None)
+        if usage is None:
+            return
+        command = self.current_command()
+        self.tokens[(command, "prompt")] += getattr(usage, "prompt_tokens", 0) or 0
+        self.tokens[(command, "completion")] += getattr(usage, "completion_tokens", 0) or 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        if isinstance(details, dict):
+            # 較舊的 openai 套件不認得這個欄位，會保留成 dict
+            cached = details.get("cached_tokens", 0)
+        else:
+            cached = getattr(details, "cached_tokens", 0) if details else 0
+        self.tokens[(command, "cached")] += cached or 0
+        self.record_cache("prompt", bool(cached))
+
+    def record_cache(self, name, hit):
+        self.cache[name][0 if hit else 1] += 1
+
+    def record_rejected(self, reason):
+        self.messages_rejected[reason] += 1
+
+    def format_stats(self):
+        """格式化 小青!stats 指令的內容"""
+        rejected = sum(self.messages_rejected.values())
+        lines = ["**效能統計**", f"收到訊息：{self.messages_total + rejected}（預先過濾：{rejected}，需處理：{self.messages_routed}）"]
+        if rejected:
+            reasons = "、".join(f"{reason} {count}" for reason, count in sorted(self.messages_rejected.items()))
+            lines.append(f"過濾原因：{reasons}")
+        commands_seen = sorted({command for command, _ in self.histograms})
+        for command in commands_seen:
+            lines.append(f"\n**{command}**")
+            for stage in self.STAGES:
+                hist = self.histograms.get((command, stage))
+                if not hist or not hist.count:
+                    continue
+                lines.append(
+                    f"{stage}：n={hist.count} p50={hist.quantile(0.5):.1f}ms "
+                    f"p95={hist.quantile(0.95):.1f}ms p99={hist.quantile(0.99):.1f}ms"
+                )
+            prompt_tokens = self.tokens.get((command, "prompt"), 0)
+            completion_tokens = self.tokens.get((command, "completion"), 0)
+            if prompt_tokens or completion_tokens:
+                lines.append(f"tokens：輸入 {prompt_tokens}（快取 {self.tokens.get((command, 'cached'), 0)}）／輸出 {completion_tokens}")
+        for name, (hits, misses) in sorted(self.cache.items()):
+            total = hits + misses
+            lines.append(f"\n快取 {name}：命中率 {hits / total * 100:.1f}%（{hits}/{total}）")
+        return "\n".join(lines)
+
+    def format_prometheus(self):
+        """輸出 Prometheus 文字格式"""
+        lines = [
+            "# TYPE xiaoqing_messages_total counter",
+            f"xiaoqing_messages_total {self.messages_total}",
+            "# TYPE xiaoqing_messages_routed_total counter",
+            f"xiaoqing_messages_routed_total {self.messages_routed}",
+            "# TYPE xiaoqing_messages_rejected_total counter",
+        ]
+        for reason, value in sorted(self.messages_rejected.items()):
+            lines.append(f'xiaoqing_messages_rejected_total{{reason="{reason}"}} {value}')
+        lines += [
+            "# TYPE xiaoqing_stage_latency_seconds histogram",
+        ]
+        for (command, stage), hist in sorted(self.histograms.items()):
+            labels = f'command="{command}",stage="{stage}"'
+            cumulative = 0
+            for bound, bucket_count in zip(hist.BOUNDS_MS, hist.counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float('inf') else f"{bound / 1000:g}"
+                lines.append(f'xiaoqing_stage_latency_seconds_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"xiaoqing_stage_latency_seconds_sum{{{labels}}} {hist.total_ms / 1000:.6f}")
+            lines.append(f"xiaoqing_stage_latency_seconds_count{{{labels}}} {hist.count}")
+        lines.append("# TYPE xiaoqing_llm_tokens_total counter")
+        for (command, kind), value in sorted(self.tokens.items()):
+            lines.append(f'xiaoqing_llm_tokens_total{{command="{command}",kind="{kind}"}} {value}')
+        lines.append("# TYPE xiaoqing_cache_requests_total counter")
+        for name, (hits, misses) in sorted(self.cache.items()):
+            lines.append(f'xiaoqing_cache_requests_total{{cache="{name}",result="hit"}} {hits}')
+            lines.append(f'xiaoqing_cache_requests_total{{cache="{name}",result="miss"}} {misses}')
+        return "\n".join(lines) + "\n"
+
+    async def serve_prometheus(self, port):
+        """在本機啟動 /metrics 端點（設定 METRICS_PORT 時啟用）"""
+        from aiohttp import web
+
+        async def handle_metrics(request):
+            return web.Response(text=self.format_prometheus(), content_type="text/plain")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle_metrics)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, "127.0.0.1", port).start()
+        logger.info(f"Prometheus 指標端點已啟動: http://127.0.0.1:{port}/metrics")
+
+# 創建效能指標實例
+metrics = MetricsRegistry()
+
+def traced(stage):
+    """裝飾器：記錄函式（同步或協程）的階段耗時"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                with metrics.stage(stage):
+                    return await func(*args, **kwargs)
+            return wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with metrics.stage(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中，直接失敗而不呼叫 API"""
+
+# OpenAI 斷路器：依各端點（API 類型 + 模型）近期的錯誤率與慢呼叫比例開啟，開啟期間直接失敗；
+# 冷卻後進入半開狀態，只放行一個試探呼叫，成功則關閉、失敗則再次開啟
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+    STATE_LABELS = {"closed": "正常", "open": "開啟（快速失敗）", "half_open": "半開（試探中）"}
+
+    def __init__(self, name, slow_seconds, window=20, min_calls=10, error_rate=0.5, slow_rate=0.8, cooldown=30.0):
+        self.name = name
+        self.slow_seconds = slow_seconds
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.cooldown = cooldown
+        self.lock = threading.Lock()  # 會在多個執行緒中呼叫
+        self.results = deque(maxlen=window)  # (是否失敗, 是否過慢)
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self.probing = False
+        self.times_opened = 0
+        self.rejected = 0
+        self.last_error = None
+
+    @staticmethod
+    def is_dependency_error(error):
+        """只有連線錯誤、逾時、429 與 5xx 算是服務異常；請求本身的錯誤（4xx）不計入"""
+        status = getattr(error, "status_code", None)
+        return status is None or status == 429 or status >= 500
+
+    @property
+    def rejecting(self):
+        """目前是否會直接拒絕呼叫（功能可據此提前改用本機模式）"""
+        with self.lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self.opened_at < self.cooldown
+            return self.state == self.HALF_OPEN and self.probing
+
+    def _open(self, error):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self.last_error = str(error) if error else "回應過慢"
+        logger.warning(f"斷路器 {self.name} 開啟：{self.last_error}")
+
+    def before_call(self):
+        with self.lock:
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+                self.probing = False
+            if self.state == self.OPEN or (self.state == self.HALF_OPEN and self.probing):
+                self.rejected += 1
+                raise CircuitOpenError(f"OpenAI 服務暫時不穩定（{self.name}），請稍後再試")
+            if self.state == self.HALF_OPEN:
+                self.probing = True
+
+    def record(self, seconds, error=None):
+        failed = error is not None and self.is_dependency_error(error)
+        slow = seconds >= self.slow_seconds
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.probing = False
+                if failed or slow:
+                    self._open(error)
+                else:
+                    self.state = self.CLOSED
+                    self.results.clear()
+                    logger.info(f"斷路器 {self.name} 已關閉")
+                return
+            self.results.append((failed, slow))
+            if self.state == self.CLOSED and len(self.results) >= self.min_calls:
+                failures = sum(1 for f, _ in self.results if f)
+                slow_calls = sum(1 for _, s in self.results if s)
+                if failures / len(self.results) >= self.error_rate or slow_calls / len(self.results) >= self.slow_rate:
+                    self._open(error)
+                    self.results.clear()
+
+    @contextmanager
+    def call(self):
+        """包住一次 API 呼叫：開啟中直接拋出 CircuitOpenError，並記錄結果與耗時"""
+        self.before_call()
+        start = time.perf_counter()
+        try:
+            yield
+        except asyncio.CancelledError:
+            # 被取消的請求沒有結果，不計入統計；試探中的請求被取消時讓下一個請求重新試探
+            with self.lock:
+                if self.state == self.HALF_OPEN:
+                    self.probing = False
+            raise
+        except Exception as e:
+            self.record(time.perf_counter() - start, e)
+            raise
+        self.record(time.perf_counter() - start)
+
+    def format_status(self):
+        with self.lock:
+            calls = len(self.results)
+            failures = sum(1 for f, _ in self.results if f)
+            slow_calls = sum(1 for _, s in self.results if s)
+            line = (
+                f"{self.name}：{self.STATE_LABELS[self.state]}，近期 {calls} 次呼叫錯誤 {failures}、過慢 {slow_calls}，"
+                f"開啟 {self.times_opened} 次、快速失敗 {self.rejected} 次"
+            )
+            if self.state == self.OPEN:
+                remaining = max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+                line += f"（{remaining:.0f} 秒後試探，原因：{self.last_error}）"
+            return line
+
+# 各 OpenAI 端點的斷路器（第一次呼叫時建立）
+class CircuitBreakers:
+    # 各 API 類型的慢呼叫門檻（秒）：長篇故事與繪圖本來就比較久
+    SLOW_SECONDS = {"chat": 60.0, "images": 90.0, "embeddings": 10.0}
+
+    def __init__(self, cooldown):
+        self.cooldown = cooldown
+        self.breakers = {}
+        self.lock = threading.Lock()
+
+    def get(self, api, model):
+        name = f"{api}:{model}"
+        breaker = self.breakers.get(name)
+        if breaker is None:
+            with self.lock:
+                breaker = self.breakers.setdefault(
+                    name, CircuitBreaker(name, self.SLOW_SECONDS.get(api, 60.0), cooldown=self.cooldown)
+                )
+        return breaker
+
+    def peek(self, api, model):
+        """取得已存在的斷路器，尚未呼叫過的端點回傳 None（不建立，狀態中不會出現沒有呼叫過的模型）"""
+        return self.breakers.get(f"{api}:{model}")
+
+    def rejecting(self, api, model):
+        """端點的斷路器是否正在拒絕呼叫（只讀取狀態，尚未呼叫過的端點視為正常）"""
+        breaker = self.peek(api, model)
+        return breaker is not None and breaker.rejecting
+
+    def format_status(self):
+        """格式化斷路器狀態"""
+        lines = ["**OpenAI 斷路器**"]
+        if not self.breakers:
+            lines.append("尚未呼叫 OpenAI")
+        lines.extend(breaker.format_status() for _, breaker in sorted(self.breakers.items()))
+        return "\n".join(lines)
+
+# 創建斷路器實例（BREAKER_COOLDOWN 為開啟後多久試探一次，單位秒）
+breakers = CircuitBreakers(cooldown=float(os.getenv('BREAKER_COOLDOWN', '30')))
+
+# 模型路由：依功能的策略表與各模型近期的延遲、錯誤率、進行中請求數選擇模型
+# preferred：依序使用第一個健康的模型；fastest：在健康的模型中選近期 p50 延遲最低者（樣本不足的先試用）
+class ModelRouter:
+    # 功能 -> 候選模型（依偏好排序）、策略、延遲預算（秒），baseline 為路由前固定使用的模型（用於估算節省）
+    POLICIES = {
+        "chat": {"models": ("gpt-5.1", "gpt-4o-mini"), "strategy": "preferred", "latency_budget": 15.0, "baseline": "gpt-5.1"},
+        "tarot": {"models": ("gpt-4o-mini", "gpt-5.1"), "strategy": "preferred", "latency_budget": 10.0, "baseline": "gpt-5.1"},
+        "story": {"models": ("gpt-4o-mini",), "strategy": "preferred", "latency_budget": 120.0, "baseline": "gpt-4o-mini"},
+        "food": {"models": ("gpt-4o-mini", "gpt-4.1-nano"), "strategy": "fastest", "latency_budget": 5.0, "baseline": "gpt-4o-mini"},
+        "monster": {"models": ("gpt-4o-mini", "gpt-4.1-nano"), "strategy": "fastest", "latency_budget": 5.0, "baseline": "gpt-4o-mini"},
+        "praise": {"models": ("gpt-4o-mini", "gpt-4.1-nano"), "strategy": "fastest", "latency_budget": 5.0, "baseline": "gpt-4o-mini"},
+    }
+    # 每百萬 token 的美元價格（輸入, 輸出）
+    PRICES = {"gpt-5.1": (1.25, 10.0), "gpt-4o-mini": (0.15, 0.60), "gpt-4.1-nano": (0.10, 0.40)}
+    WINDOW = 50
+    STATS_TTL = 300.0  # 超過 5 分鐘的樣本不計入，被避開的模型之後會重新得到流量
+    MIN_SAMPLES = 5
+    MAX_ERROR_RATE = 0.2
+    MAX_INFLIGHT = 32  # 單一模型進行中的請求超過此數視為排隊過深
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.lock = threading.Lock()  # 在多個執行緒中記錄結果
+        self.samples = defaultdict(lambda: deque(maxlen=self.WINDOW))  # (功能, 模型) -> (時間, 秒數, 是否失敗)
+        self.inflight = defaultdict(int)  # 模型 -> 進行中的請求數
+        self.decisions = defaultdict(lambda: defaultdict(int))  # 功能 -> 模型 -> 次數
+        self.savings = defaultdict(float)  # 功能 -> 相對 baseline 估計節省的美元
+        self.last_choice = {}
+
+    def _recent(self, feature, model):
+        cutoff = time.monotonic() - self.STATS_TTL
+        return [(seconds, failed) for at, seconds, failed in self.samples[(feature, model)] if at >= cutoff]
+
+    def _health(self, feature, model, budget):
+        """回傳 (是否健康, 近期 p50 秒數或 None, 原因)"""
+        if breakers.rejecting("chat", model):
+            return False, None, "斷路器開啟"
+        if self.inflight[model] >= self.MAX_INFLIGHT:
+            return False, None, f"進行中 {self.inflight[model]} 個請求"
+        recent = self._recent(feature, model)
+        if len(recent) < self.MIN_SAMPLES:
+            return True, None, "樣本不足"
+        errors = sum(1 for _, failed in recent if failed)
+        if errors / len(recent) > self.MAX_ERROR_RATE:
+            return False, None, f"錯誤率 {errors / len(recent):.0%}"
+        latencies = sorted(seconds for seconds, failed in recent if not failed)
+        p50 = latencies[len(latencies) // 2]
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        if p95 > budget:
+            return False, p50, f"p95 {p95:.1f}s 超過預算 {budget:g}s"
+        return True, p50, f"p50 {p50:.1f}s"
+
+    def choose(self, feature):
+        """依策略表為功能選擇模型"""
+        policy = self.policies[feature]
+        with self.lock:
+            health = [(model,) + self._health(feature, model, policy["latency_budget"]) for model in policy["models"]]
+        healthy = [entry for entry in health if entry[1]]
+        if not healthy:
+            # 全部不健康時，優先選斷路器未開啟的模型
+            healthy = [entry for entry in health if entry[3] != "斷路器開啟"] or health
+            choice = healthy[0]
+        elif policy["strategy"] == "fastest":
+            # 樣本不足的模型先試用，其餘選 p50 最低者
+            unexplored = [entry for entry in healthy if entry[2] is None]
+            choice = unexplored[0] if unexplored else min(healthy, key=lambda entry: entry[2])
+        else:
+            choice = healthy[0]
+        model, _, _, reason = choice
+        self.decisions[feature][model] += 1
+        if self.last_choice.get(feature) != model:
+            skipped = "；".join(f"{m} {r}" for m, ok, _, r in health if m != model)
+            logger.info(f"模型路由 {feature}：改用 {model}（{reason}{'；' + skipped if skipped else ''}）")
+            self.last_choice[feature] = model
+        logger.debug(f"模型路由 {feature} -> {model}（{reason}）")
+        return model
+
+    @contextmanager
+    def track(self, model):
+        """記錄一次呼叫的進行中請求數"""
+        with self.lock:
+            self.inflight[model] += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.inflight[model] -= 1
+
+    def record(self, feature, model, seconds, failed, usage=None):
+        """記錄結果，並依 token 用量估算相對 baseline 模型的節省"""
+        with self.lock:
+            self.samples[(feature, model)].append((time.monotonic(), seconds, failed))
+            baseline = self.policies[feature]["baseline"]
+            if usage is not None and model != baseline and model in self.PRICES and baseline in self.PRICES:
+                prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+                completion_tokens = getattr(usage, "completion_tokens", 0) or 0
+                (base_in, base_out), (in_price, out_price) = self.PRICES[baseline], self.PRICES[model]
+                self.savings[feature] += (prompt_tokens * (base_in - in_price) + completion_tokens * (base_out - out_price)) / 1e6
+
+    def format_status(self):
+        """格式化各功能的模型選擇次數與估計節省"""
+        lines = ["**模型路由**"]
+        for feature, policy in self.policies.items():
+            decisions = self.decisions.get(feature)
+            if not decisions:
+                continue
+            counts = "、".join(f"{model} {count}" for model, count in sorted(decisions.items()))
+            lines.append(f"{feature}（{policy['strategy']}）：{counts}，相對 {policy['baseline']} 估計節省 ${self.savings[feature]:.4f}")
+        if len(lines) == 1:
+            lines.append("尚無請求")
+        return "\n".join(lines)
+
+def create_model_router():
+    """建立模型路由；MODEL_POLICY_<功能> 可覆寫候選模型（逗號分隔，依偏好排序）"""
+    policies = {}
+    for feature, policy in ModelRouter.POLICIES.items():
+        policy = dict(policy)
+        override = os.getenv(f"MODEL_POLICY_{feature.upper()}")
+        if override:
+            policy["models"] = tuple(model.strip() for model in override.split(",") if model.strip())
+        policies[feature] = policy
+    return ModelRouter(policies)
+
+# 創建模型路由實例
+model_router = create_model_router()
+
+def create_chat_completion(feature=None, **kwargs):
+    """呼叫 OpenAI 聊天 API（經過斷路器），並記錄耗時與 token 用量；指定 feature 時由模型路由選擇模型"""
+    if feature and "model" not in kwargs:
+        kwargs["model"] = model_router.choose(feature)
+    model = kwargs.get("model")
+    start = time.perf_counter()
     try:
-        with open(test_file, 'w') as f:
-            f.write('test')
-        os.remove(test_file)
-        print("檔案系統權限正常")
-    except Exception as e:
-        print(f"警告：檔案系統可能有問題: {e}")
-except Exception as e:
-    print(f"無法檢查系統資源: {e}")
+        with breakers.get("chat", model).call(), model_router.track(model), metrics.stage("llm"):
+            response = client.chat.completions.create(**kwargs)
+    except CircuitOpenError:
+        raise
+    except Exception:
+        if feature:
+            model_router.record(feature, model, time.perf_counter() - start, True)
+        raise
+    if feature:
+        model_router.record(feature, model, time.perf_counter() - start, False, getattr(response, "usage", None))
+    metrics.record_usage(response)
+    return response
 
-# 檢查系統資源
-try:
-    memory = psutil.virtual_memory()
-    if memory.percent > 95:
-        print(f"警告：記憶體使用率過高 ({memory.percent}%)")
-    
-    # 檢查網路連接
+async def async_chat_completion(feature=None, **kwargs):
+    """與 create_chat_completion 相同，但以 AsyncOpenAI 在事件循環中等待；任務被取消時 HTTP 請求也會中斷"""
+    if feature and "model" not in kwargs:
+        kwargs["model"] = model_router.choose(feature)
+    model = kwargs.get("model")
+    start = time.perf_counter()
     try:
-        socket.create_connection(("8.8.8.8", 53), timeout=3)
-        print("網路連接正常")
-    except OSError:
-        print("警告：網路連接可能有問題")
-    
-except Exception as e:
-    print(f"無法檢查系統資源: {e}")
+        with breakers.get("chat", model).call(), model_router.track(model), metrics.stage("llm"):
+            response = await async_client.chat.completions.create(**kwargs)
+    except CircuitOpenError:
+        raise
+    except Exception:
+        if feature:
+            model_router.record(feature, model, time.perf_counter() - start, True)
+        raise
+    if feature:
+        model_router.record(feature, model, time.perf_counter() - start, False, getattr(response, "usage", None))
+    metrics.record_usage(response)
+    return response
 
-# 設置 OpenAI API 客戶端
-client = OpenAI(api_key=openai_api_key)
+async def chat_completion(**kwargs):
+    """在執行緒中呼叫 create_chat_completion，等待時不阻塞事件循環（沿用目前指令的追蹤）"""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(None, functools.partial(context.run, create_chat_completion, **kwargs))
+
+# 有期限的 LLM 呼叫：超過近期 p95 延遲仍未回應時送出一個重複請求（hedge），取先成功者；
+# 超過功能的期限時回傳 None，由呼叫端改用本機產生的內容，API 不穩時用戶仍能在期限內得到回覆
+class HedgedCompletion:
+    DEFAULT_DEADLINES = {"food": 6.0, "monster": 8.0}  # 功能 -> 期限（秒）
+    WINDOW = 200  # 計算 p95 的近期樣本數
+    MIN_SAMPLES = 20  # 樣本不足時在期限的一半送出 hedge
+
+    def __init__(self, deadlines, max_workers=16):
+        self.deadlines = deadlines
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-hedge")
+        self.latencies = defaultdict(lambda: deque(maxlen=self.WINDOW))
+        self.counts = defaultdict(lambda: defaultdict(int))  # 功能 -> 請求、hedge、hedge 勝出、逾時、失敗次數
+
+    def hedge_after(self, feature):
+        """送出 hedge 前等待的秒數：近期 p95 延遲，最多為期限的一半"""
+        deadline = self.deadlines[feature]
+        samples = self.latencies[feature]
+        if len(samples) < self.MIN_SAMPLES:
+            return deadline / 2
+        ordered = sorted(samples)
+        return min(ordered[int(0.95 * (len(ordered) - 1))], deadline / 2)
+
+    async def complete(self, feature, **kwargs):
+        """在期限內取得聊天回應；逾時或全部失敗時回傳 None"""
+        loop = asyncio.get_running_loop()
+        deadline = self.deadlines[feature]
+        hedge_at = self.hedge_after(feature)
+        counts = self.counts[feature]
+        counts["requests"] += 1
+        if "model" not in kwargs:
+            kwargs["model"] = model_router.choose(feature)
+        if breakers.rejecting("chat", kwargs["model"]):
+            # 斷路器開啟中，不送出請求直接改用本機備援
+            counts["short_circuited"] += 1
+            return None
+        start = time.perf_counter()
+
+        def launch():
+            # 每個請求各自複製 contextvars，沿用目前指令的追蹤；請求逾時設為期限，執行緒不會被卡住太久
+            context = contextvars.copy_context()
+            future = loop.run_in_executor(
+                self.executor, functools.partial(context.run, create_chat_completion, feature, timeout=deadline, **kwargs)
+            )
+            # 輸掉的請求結束時取走例外，避免未取用的警告
+            future.add_done_callback(lambda f: f.cancelled() or f.exception())
+            return future
+
+        primary = launch()
+        pending = {primary}
+        hedged = False
+        while True:
+            elapsed = time.perf_counter() - start
+            if not hedged and (elapsed >= hedge_at or not pending):
+                hedged = True
+                counts["hedged"] += 1
+                pending.add(launch())
+            if not pending or elapsed >= deadline:
+                break
+            wait_for = (deadline if hedged else hedge_at) - elapsed
+            done, pending = await asyncio.wait(pending, timeout=wait_for, return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.latencies[feature].append(time.perf_counter() - start)
+                    if future is not primary:
+                        counts["hedge_wins"] += 1
+                    return future.result()
+                logger.warning(f"{feature} 的 LLM 請求失敗: {future.exception()}")
+        counts["timeouts" if pending else "errors"] += 1
+        logger.warning(f"{feature} 的 LLM 請求在 {time.perf_counter() - start:.1f} 秒內沒有成功，改用本機備援")
+        return None
+
+    def format_status(self):
+        """格式化各功能的期限與備援統計"""
+        lines = ["**LLM 期限與備援**"]
+        for feature, deadline in self.deadlines.items():
+            counts = self.counts[feature]
+            fallbacks = counts["timeouts"] + counts["errors"] + counts["short_circuited"]
+            lines.append(
+                f"{feature}：期限 {deadline:.1f}s，hedge 門檻 {self.hedge_after(feature):.1f}s，"
+                f"請求 {counts['requests']}、hedge {counts['hedged']}（勝出 {counts['hedge_wins']}）、"
+                f"本機備援 {fallbacks}（逾時 {counts['timeouts']}、斷路 {counts['short_circuited']}）"
+            )
+        return "\n".join(lines)
+
+def create_hedged_completion():
+    """依 LLM_DEADLINE_<功能> 環境變數建立有期限的 LLM 呼叫"""
+    deadlines = {
+        feature: float(os.getenv(f"LLM_DEADLINE_{feature.upper()}", default))
+        for feature, default in HedgedCompletion.DEFAULT_DEADLINES.items()
+    }
+    return HedgedCompletion(deadlines)
+
+# 創建有期限的 LLM 呼叫實例
+hedged_llm = create_hedged_completion()
+
+DISCORD_MESSAGE_LIMIT = 2000
+
+# Discord 頻道發送訊息的速率限制：從 discord.py 收到的回應標頭記錄每個頻道剩餘的次數與重置時間
+class ChannelRateLimits:
+    MESSAGES_PATH = re.compile(r"/channels/(\d+)/messages$")
+    MAX_BUCKETS = 4096
+
+    def __init__(self):
+        self.buckets = {}  # 頻道 ID -> (剩餘次數, 重置的 monotonic 時間)
+
+    def update(self, channel_id, remaining, reset_after):
+        if len(self.buckets) >= self.MAX_BUCKETS:
+            now = time.monotonic()
+            self.buckets = {key: bucket for key, bucket in self.buckets.items() if bucket[1] > now}
+        self.buckets[channel_id] = (remaining, time.monotonic() + reset_after)
+
+    def wait_time(self, channel_id):
+        """發送下一則訊息前需要等待的秒數（還有額度或已經重置時為 0）"""
+        bucket = self.buckets.get(channel_id)
+        if bucket is None:
+            return 0.0
+        remaining, reset_at = bucket
+        delay = reset_at - time.monotonic()
+        if delay <= 0:
+            del self.buckets[channel_id]
+            return 0.0
+        return delay if remaining <= 0 else 0.0
+
+    def trace_config(self):
+        """給 discord.py 的 aiohttp 追蹤設定（http_trace），讀取每個發送訊息請求的速率限制標頭"""
+        trace = aiohttp.TraceConfig()
+        trace.on_request_end.append(self._on_request_end)
+        return trace
+
+    async def _on_request_end(self, session, context, params):
+        if params.method != "POST":
+            return
+        match = self.MESSAGES_PATH.search(params.url.path)
+        headers = params.response.headers
+        if match is None or "X-RateLimit-Remaining" not in headers or "X-RateLimit-Reset-After" not in headers:
+            return
+        self.update(int(match.group(1)), int(headers["X-RateLimit-Remaining"]), float(headers["X-RateLimit-Reset-After"]))
+
+# 創建頻道速率限制實例
+channel_rate_limits = ChannelRateLimits()
+
+class ChannelOutbox:
+    __slots__ = ("pending", "task", "last_message", "last_content", "last_sent_at")
+
+    def __init__(self):
+        self.pending = deque()  # (內容, 其他參數, 可否合併, future)
+        self.task = None
+        self.last_message = None  # 最近一則可以接在後面的合併訊息
+        self.last_content = ""
+        self.last_sent_at = 0.0
+
+# 頻道發送排程：每個頻道一個佇列依序發送；可合併的通知（例如怪物戰的攻擊結果）在短時間內合併成一則，
+# 小青的上一則合併訊息仍是頻道最新的一則時改為編輯接在後面；頻道的發送額度用完時先等到重置，期間排入的訊息一起合併
+class OutboundScheduler:
+    MAX_OUTBOXES = 1024
+
+    def __init__(self, rate_limits, window=0.3, append_window=15.0):
+        self.rate_limits = rate_limits
+        self.window = window
+        self.append_window = append_window
+        self.outboxes = {}  # 頻道 ID -> ChannelOutbox
+        self.counts = defaultdict(int)  # 排入、發送、合併、編輯、等待額度的次數
+
+    async def send(self, channel, content=None, merge=False, **kwargs):
+        """排入頻道的發送佇列並等待送出，回傳訊息（合併的通知回傳合併後的那一則）"""
+        if self.window <= 0 or isinstance(channel, InteractionChannel):
+            # 斜線指令的 followup 不是一般頻道訊息，直接送出
+            return await channel.send(content, **kwargs)
+        outbox = self.outboxes.get(channel.id)
+        if outbox is None:
+            if len(self.outboxes) >= self.MAX_OUTBOXES:
+                self._prune()
+            outbox = self.outboxes[channel.id] = ChannelOutbox()
+        future = asyncio.get_running_loop().create_future()
+        outbox.pending.append((content, kwargs, bool(merge and content and not kwargs), future))
+        self.counts["queued"] += 1
+        if outbox.task is None:
+            outbox.task = asyncio.get_running_loop().create_task(self._drain(channel, outbox))
+        return await future
+
+    def _prune(self):
+        """移除閒置的頻道佇列"""
+        cutoff = time.monotonic() - self.append_window
+        self.outboxes = {
+            channel_id: outbox for channel_id, outbox in self.outboxes.items()
+            if outbox.task is not None or outbox.last_sent_at > cutoff
+        }
+
+    async def _drain(self, channel, outbox):
+        collected = False
+        try:
+            while outbox.pending:
+                wait = self.rate_limits.wait_time(channel.id)
+                if wait > 0:
+                    self.counts["paced"] += 1
+                    await asyncio.sleep(wait)
+                    continue
+                if outbox.pending[0][2] and not collected:
+                    # 可合併的通知先等一小段時間，收集同一時間要送到這個頻道的其他通知；獨立的訊息直接發送
+                    collected = True
+                    await asyncio.sleep(self.window)
+                    continue
+                batch = self._take_batch(outbox)
+                collected = False
+                try:
+                    message = await self._deliver(channel, outbox, batch)
+                except Exception as e:
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                else:
+                    for *_, future in batch:
+                        if not future.done():
+                            future.set_result(message)
+        finally:
+            outbox.task = None
+
+    def _take_batch(self, outbox):
+        """取出下一則要發送的內容：可合併的通知盡量合併到字數上限"""
+        batch = [outbox.pending.popleft()]
+        if batch[0][2]:
+            length = len(batch[0][0])
+            while outbox.pending and outbox.pending[0][2] and length + 2 + len(outbox.pending[0][0]) <= DISCORD_MESSAGE_LIMIT:
+                length += 2 + len(outbox.pending[0][0])
+                batch.append(outbox.pending.popleft())
+            self.counts["merged"] += len(batch) - 1
+        return batch
+
+    async def _deliver(self, channel, outbox, batch):
+        content, kwargs, mergeable, _ = batch[0]
+        if not mergeable:
+            message = await channel.send(content, **kwargs)
+            self.counts["sent"] += 1
+            # 獨立的訊息（例如之後會被編輯的佔位訊息）不接在後面
+            outbox.last_message = None
+            return message
+        text = "\n\n".join(item[0] for item in batch)
+        last = outbox.last_message
+        if (
+            last is not None
+            and getattr(channel, "last_message_id", None) == last.id
+            and time.monotonic() - outbox.last_sent_at <= self.append_window
+            and len(outbox.last_content) + 2 + len(text) <= DISCORD_MESSAGE_LIMIT
+        ):
+            # 上一則合併訊息仍是頻道最新的一則：編輯接在後面，不佔用發送額度
+            combined = f"{outbox.last_content}\n\n{text}"
+            try:
+                await last.edit(content=combined)
+                self.counts["edited"] += 1
+                outbox.last_content = combined
+                outbox.last_sent_at = time.monotonic()
+                return last
+            except discord.HTTPException as e:
+                logger.warning(f"無法編輯頻道 {channel.id} 的合併訊息: {e}")
+        message = await channel.send(text)
+        self.counts["sent"] += 1
+        outbox.last_message = message
+        outbox.last_content = text
+        outbox.last_sent_at = time.monotonic()
+        return message
+
+    def format_status(self):
+        counts = self.counts
+        return (
+            f"**頻道發送排程**\n合併視窗 {self.window:g}s：排入 {counts['queued']} 則、發送 {counts['sent']} 則、"
+            f"合併 {counts['merged']} 則、編輯接續 {counts['edited']} 次、等待發送額度 {counts['paced']} 次"
+        )
+
+# 創建頻道發送排程實例（OUTBOUND_WINDOW 為合併視窗秒數，0 表示直接發送；OUTBOUND_APPEND_WINDOW 為可接在後面的秒數）
+outbound = OutboundScheduler(
+    channel_rate_limits,
+    window=float(os.getenv('OUTBOUND_WINDOW', '0.3')),
+    append_window=float(os.getenv('OUTBOUND_APPEND_WINDOW', '15')),
+)
+
+async def send_message(channel, content=None, **kwargs):
+    """發送訊息並記錄耗時（經過頻道發送排程，回傳獨立的一則訊息）"""
+    with metrics.stage("send"):
+        return await outbound.send(channel, content, **kwargs)
+
+async def post_message(channel, content):
+    """發送之後不會再編輯的通知：同一頻道短時間內的多則會合併，或接在小青上一則通知後面"""
+    with metrics.stage("send"):
+        await outbound.send(channel, content, merge=True)
+
+async def edit_message(msg, content):
+    """編輯訊息並記錄耗時"""
+    with metrics.stage("send"):
+        return await msg.edit(content=content)
+
+# 訊息編輯節流：經常變動的訊息（例如世界王血條）每則每 interval 秒最多編輯一次，只送出最新的內容
+class EditThrottle:
+    def __init__(self, interval=2.0):
+        self.interval = interval
+        self.pending = {}  # 訊息 ID -> [訊息, 最新內容, 已送出的內容]
+        self.counts = {"scheduled": 0, "edited": 0, "failed": 0}
+
+    def schedule(self, message, content):
+        """排入一次編輯；節流期間再次排入時只保留最新的內容"""
+        self.counts["scheduled"] += 1
+        entry = self.pending.get(message.id)
+        if entry is not None:
+            entry[1] = content
+            return
+        entry = self.pending[message.id] = [message, content, None]
+        asyncio.get_running_loop().create_task(self._run(message.id, entry))
+
+    async def _run(self, key, entry):
+        try:
+            while entry[1] != entry[2]:
+                content = entry[1]
+                try:
+                    await edit_message(entry[0], content)
+                    self.counts["edited"] += 1
+                except discord.HTTPException as e:
+                    self.counts["failed"] += 1
+                    logger.warning(f"編輯訊息 {key} 失敗: {e}")
+                entry[2] = content
+                await asyncio.sleep(self.interval)
+        finally:
+            del self.pending[key]
+
+    def format_status(self):
+        counts = self.counts
+        return (
+            f"**訊息編輯節流**\n間隔 {self.interval:g}s：排入 {counts['scheduled']} 次、實際編輯 {counts['edited']} 次、"
+            f"失敗 {counts['failed']} 次、進行中 {len(self.pending)} 則"
+        )
+
+# 創建訊息編輯節流實例（EDIT_THROTTLE_INTERVAL 為同一則訊息兩次編輯的最短間隔秒數）
+edit_throttle = EditThrottle(interval=float(os.getenv('EDIT_THROTTLE_INTERVAL', '2')))
+
+def split_message(text, limit=DISCORD_MESSAGE_LIMIT):
+    """把長文字切成不超過 Discord 字數上限的多則訊息（盡量在換行處切開）"""
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    chunks.append(text)
+    return chunks
+
+# 事件循環監控：心跳協程量測延遲，取樣執行緒在卡頓時擷取堆疊並統計阻塞來源
+class LoopWatchdog:
+    def __init__(self, threshold_ms=200, interval=0.05, top=5):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval
+        self.top = top
+        self.lag = LatencyHistogram()
+        self.culprits = {}  # 呼叫位置 -> [累計阻塞毫秒, 取樣次數, 最內層呼叫]
+        self.stalls = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._last_beat = None
+        self._loop_thread_id = None
+        self._stall_beat = None
+        self._thread = None
+
+    def start(self, loop):
+        """啟動心跳與取樣執行緒（需在事件循環執行緒中呼叫）"""
+        if self._thread:
+            return
+        self._loop_thread_id = threading.get_ident()
+        self._last_beat = time.monotonic()
+        loop.create_task(self._heartbeat())
+        self._thread = threading.Thread(target=self._sampler, name="loop-watchdog", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while not self._stopped.is_set():
+            self._last_beat = time.monotonic()
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lag.observe(max(0.0, loop.time() - expected) * 1000)
+
+    def _sampler(self):
+        while not self._stopped.wait(self.interval):
+            beat = self._last_beat
+            blocked = time.monotonic() - beat - self.interval
+            if blocked < self.threshold:
+                continue
+            frame = sys._current_frames().get(self._loop_thread_id)
+            if frame is None:
+                continue
+            if beat != self._stall_beat:
+                # 新的卡頓：把目前已阻塞的時間都算給這個位置
+                self._stall_beat = beat
+                self.stalls += 1
+                blocked_ms = blocked * 1000
+                first_sample = True
+            else:
+                blocked_ms = self.interval * 1000
+                first_sample = False
+            site, innermost = self._attribute(frame)
+            with self._lock:
+                entry = self.culprits.setdefault(site, [0.0, 0, innermost])
+                entry[0] += blocked_ms
+                entry[1] += 1
+            if first_sample:
+                logger.warning(f"事件循環阻塞超過 {blocked * 1000:.0f}ms：{site}，阻塞於 {innermost}")
+
+    @staticmethod
+    def _attribute(frame, depth=2):
+        """找出最內層的 bot.py 呼叫鏈（最多 depth 層）與實際阻塞的最內層函式"""
+        innermost = f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})"
+        chain = []
+        current = frame
+        while current is not None and len(chain) < depth:
+            # 略過 traced 裝飾器產生的包裝函式
+            if current.f_code.co_filename == __file__ and current.f_code.co_name != "wrapper":
+                chain.append(f"{current.f_code.co_name} (bot.py:{current.f_lineno})")
+            current = current.f_back
+        return (" ← ".join(chain) if chain else innermost), innermost
+
+    def format_report(self):
+        """格式化事件循環監控報告"""
+        lines = [
+            "**事件循環監控**",
+            f"延遲：p50={self.lag.quantile(0.5):.1f}ms p99={self.lag.quantile(0.99):.1f}ms 最大={self.lag.max_ms:.1f}ms",
+            f"超過 {self.threshold * 1000:.0f}ms 的卡頓：{self.stalls} 次",
+        ]
+        with self._lock:
+            ranked = sorted(self.culprits.items(), key=lambda item: item[1][0], reverse=True)[:self.top]
+        for i, (site, (total_ms, samples, innermost)) in enumerate(ranked, 1):
+            lines.append(f"{i}. {site} 共 {total_ms:.0f}ms（{samples} 次取樣），阻塞於 {innermost}")
+        return "\n".join(lines)
+
+# 創建事件循環監控實例
+loop_watchdog = LoopWatchdog(threshold_ms=int(os.getenv('WATCHDOG_THRESHOLD_MS', '200')))
+
+# 聊天內容壓縮：以自己的聊天語料訓練字典，長訊息與回應以 BLOB 壓縮儲存，短文字仍存為 TEXT
+# 有安裝 zstandard 時使用 zstd 字典壓縮，否則使用 zlib 預設字典（zdict）
+class ChatDecodeError(Exception):
+    """聊天記錄無法解壓（未安裝對應的壓縮套件、找不到字典或內容損壞）"""
+
+class ChatCompressor:
+    MIN_LENGTH = 64  # 短於此長度（位元組）的文字不壓縮
+    ZLIB_DICT_SIZE = 8 * 1024  # zlib 每次解壓都要重新載入字典，字典越大讀取越慢
+    HEADER = struct.Struct(">cI")  # 壓縮格式（Z=zlib、S=zstd）與字典 id（0 表示無字典）
+    CODECS = {"zlib": b"Z", "zstd": b"S"}
+
+    def __init__(self, codec="auto", db_path=None, train_after=500, dict_size=32 * 1024, samples=2000):
+        codec = (codec or "off").lower()
+        if codec == "auto":
+            codec = "zstd" if zstandard else "zlib"
+        elif codec == "zstd" and not zstandard:
+            logger.warning("未安裝 zstandard，聊天內容改用 zlib 壓縮")
+            codec = "zlib"
+        if codec not in ("zlib", "zstd", "off"):
+            raise ValueError(f"不支援的壓縮格式: {codec}")
+        self.codec = None if codec == "off" else codec
+        self.db_path = db_path
+        self.train_after = train_after
+        self.dict_size = dict_size
+        self.samples = samples
+        self.dict_id = 0
+        self.dictionaries = {0: None}  # 字典 id -> 字典內容
+        self._zstd = {}  # (字典 id, 壓縮/解壓) -> zstd 物件
+        self._lock = threading.Lock()  # zstd 物件不可在多個執行緒同時使用
+        self.writes = 0
+        self.raw_bytes = 0
+        self.stored_bytes = 0
+        self.training_due = False  # 已累積足夠記錄、等待背景維護訓練字典
+        self.recompress_after = None  # 背景重新壓縮進行到的記錄 id（None 表示沒有進行中的重新壓縮）
+        self.recompress_until = 0  # 換字典時最新的記錄 id，之後寫入的記錄已使用新字典
+        self.recompressed = 0
+        self.unreadable = 0  # 重新壓縮時因無法解壓而保留原樣的記錄數
+
+    @property
+    def has_work(self):
+        """是否有等待背景維護處理的字典訓練或重新壓縮"""
+        return self.training_due or self.recompress_after is not None
+
+    def load(self, conn):
+        """載入所有字典，並使用目前格式最新的字典壓縮"""
+        for dict_id, codec, data in conn.execute("SELECT id, codec, data FROM chat_dictionaries ORDER BY id"):
+            self.dictionaries[dict_id] = data
+            if codec == self.codec:
+                self.dict_id = dict_id
+
+    def _dictionary(self, dict_id):
+        """取得字典；其他程序（分片）新訓練的字典以唯讀連接載入"""
+        if dict_id not in self.dictionaries:
+            conn = sqlite3.connect(f"file:{self.db_path}?mode=ro", uri=True, timeout=5.0)
+            try:
+                row = conn.execute("SELECT data FROM chat_dictionaries WHERE id = ?", (dict_id,)).fetchone()
+            finally:
+                conn.close()
+            if not row:
+                raise KeyError(f"找不到壓縮字典 #{dict_id}")
+            self.dictionaries[dict_id] = row[0]
+        return self.dictionaries[dict_id]
+
+    def _zstd_object(self, dict_id, kind):
+        key = (dict_id, kind)
+        if key not in self._zstd:
+            data = self._dictionary(dict_id)
+            kwargs = {"dict_data": zstandard.ZstdCompressionDict(data)} if data else {}
+            self._zstd[key] = zstandard.ZstdCompressor(level=3, **kwargs) if kind == "c" else zstandard.ZstdDecompressor(**kwargs)
+        return self._zstd[key]
+
+    def compress(self, text):
+        """壓縮文字；太短或壓縮後沒有變小時回傳原文字"""
+        if not self.codec or not text:
+            return text
+        raw = text.encode("utf-8")
+        if len(raw) < self.MIN_LENGTH:
+            return text
+        dictionary = self.dictionaries.get(self.dict_id)
+        if self.codec == "zstd":
+            with self._lock:
+                payload = self._zstd_object(self.dict_id, "c").compress(raw)
+        else:
+            compressor = zlib.compressobj(6, zdict=dictionary) if dictionary else zlib.compressobj(6)
+            payload = compressor.compress(raw) + compressor.flush()
+        blob = self.HEADER.pack(self.CODECS[self.codec], self.dict_id) + payload
+        if len(blob) >= len(raw):
+            return text
+        return blob
+
+    def readable(self, value):
+        """不解壓，只檢查記錄的壓縮格式是否可用、字典是否存在"""
+        if not isinstance(value, bytes):
+            return True
+        try:
+            codec, dict_id = self.HEADER.unpack_from(value)
+            if codec == b"S" and not zstandard or codec not in self.CODECS.values():
+                return False
+            self._dictionary(dict_id)
+            return True
+        except Exception:
+            return False
+
+    def decompress(self, value):
+        """解壓 BLOB；TEXT（未壓縮）直接回傳；無法解壓時引發 ChatDecodeError（不可當成空字串使用）"""
+        if not isinstance(value, bytes):
+            return value
+        try:
+            codec, dict_id = self.HEADER.unpack_from(value)
+            payload = value[self.HEADER.size:]
+            dictionary = self._dictionary(dict_id)
+            if codec == b"S":
+                if not zstandard:
+                    raise RuntimeError("此記錄以 zstd 壓縮，但未安裝 zstandard")
+                with self._lock:
+                    return self._zstd_object(dict_id, "d").decompress(payload).decode("utf-8")
+            if codec != b"Z":
+                raise ValueError(f"未知的壓縮格式 {codec!r}")
+            decompressor = zlib.decompressobj(zdict=dictionary) if dictionary else zlib.decompressobj()
+            return (decompressor.decompress(payload) + decompressor.flush()).decode("utf-8")
+        except Exception as e:
+            raise ChatDecodeError(f"解壓聊天記錄錯誤: {e}") from e
+
+    def chat_text(self, value):
+        """SQL 函式 chat_text()：無法解壓的記錄回傳 NULL，不會被索引或搜尋到空白內容"""
+        try:
+            return self.decompress(value)
+        except ChatDecodeError as e:
+            logger.debug("%s", e)
+            return None
+
+    def record_write(self, conn, *pairs):
+        """統計壓縮率，累積足夠的記錄後標記需要訓練字典（由背景維護執行，不在寫入時進行）"""
+        for text, stored in pairs:
+            if text:
+                self.raw_bytes += len(text.encode("utf-8"))
+                self.stored_bytes += len(stored) if isinstance(stored, bytes) else len(stored.encode("utf-8"))
+        self.writes += 1
+        if self.codec and self.dict_id == 0 and not self.training_due and self.writes % 100 == 0:
+            count = conn.execute("SELECT COUNT(*) FROM chat_history").fetchone()[0]
+            if count >= self.train_after:
+                self.training_due = True
+
+    def training_samples(self, conn):
+        """取出最近的聊天記錄作為訓練樣本"""
+        rows = conn.execute(
+            "SELECT message, response FROM chat_history ORDER BY id DESC LIMIT ?", (self.samples,)
+        ).fetchall()
+        return [self.decompress(value).encode("utf-8") for row in rows for value in row if value and self.readable(value)]
+
+    def build_dictionary(self, samples):
+        """以樣本訓練字典（只需要 CPU，不使用資料庫連接）；失敗時回傳 None"""
+        if not samples:
+            return None
+        try:
+            if self.codec == "zstd":
+                return zstandard.train_dictionary(self.dict_size, samples).as_bytes()
+            # zlib 優先使用字典尾端的內容，把最新的語料放在最後
+            return b"".join(reversed(samples))[-min(self.dict_size, self.ZLIB_DICT_SIZE):]
+        except Exception as e:
+            logger.warning(f"訓練壓縮字典失敗: {e}")
+            return None
+
+    def install_dictionary(self, conn, data, samples):
+        """儲存新字典並改用它壓縮，既有記錄之後由背景維護分批重新壓縮（訓練失敗時 data 為 None，之後再試）"""
+        self.training_due = False
+        if not data:
+            return
+        cursor = conn.execute(
+            "INSERT INTO chat_dictionaries (codec, data, samples, created_at) VALUES (?, ?, ?, ?)",
+            (self.codec, data, samples, datetime.now()),
+        )
+        conn.commit()
+        self.dict_id = cursor.lastrowid
+        self.dictionaries[self.dict_id] = data
+        self.recompress_after = 0
+        self.recompress_until = conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_history").fetchone()[0]
+        logger.info(f"已訓練聊天壓縮字典 #{self.dict_id}（{self.codec}，{len(data)} 位元組，{samples} 筆樣本）")
+
+    def recompress_batch(self, conn, batch):
+        """以目前的字典重新壓縮下一批既有記錄（一批一次提交）"""
+        rows = conn.execute(
+            "SELECT id, message, response FROM chat_history WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+            (self.recompress_after, self.recompress_until, batch),
+        ).fetchall()
+        if not rows:
+            self.recompress_after = None
+            logger.info(f"已重新壓縮 {self.recompressed} 筆聊天記錄")
+            if self.unreadable:
+                logger.warning(f"{self.unreadable} 筆聊天記錄無法解壓（可能缺少壓縮套件），已保留原樣")
+            return
+        changes = []
+        for row_id, message, response in rows:
+            # 無法解壓的記錄（例如以 zstd 壓縮、但目前未安裝 zstandard）保留原樣，不可寫回
+            try:
+                new_message = self.compress(self.decompress(message))
+                new_response = self.compress(self.decompress(response))
+            except ChatDecodeError as e:
+                self.unreadable += 1
+                logger.debug("略過無法解壓的聊天記錄 #%d: %s", row_id, e)
+                continue
+            if new_message != message or new_response != response:
+                changes.append((new_message, new_response, row_id))
+        conn.executemany("UPDATE chat_history SET message = ?, response = ? WHERE id = ?", changes)
+        conn.commit()
+        self.recompressed += len(changes)
+        self.recompress_after = rows[-1][0]
+
+    def format_status(self):
+        if not self.codec:
+            return "聊天壓縮：關閉"
+        ratio = f"{self.stored_bytes / self.raw_bytes:.0%}" if self.raw_bytes else "無資料"
+        dictionary = f"字典 #{self.dict_id}" if self.dict_id else "尚未訓練字典"
+        if self.training_due:
+            dictionary += "，等待背景訓練"
+        elif self.recompress_after is not None:
+            dictionary += f"，背景重新壓縮中（已更新 {self.recompressed} 筆）"
+        if self.unreadable:
+            dictionary += f"，{self.unreadable} 筆無法解壓、保留原樣"
+        return f"聊天壓縮：{self.codec}（{dictionary}），本次寫入壓縮後為原大小的 {ratio}"
+
+def chat_snippet(text, terms, width=40):
+    """擷取關鍵字附近的片段並以粗體標示關鍵字；找不到時回傳 None"""
+    lowered = (text or "").lower()
+    positions = [lowered.find(term.lower()) for term in terms]
+    positions = [position for position in positions if position >= 0]
+    if not positions:
+        return None
+    start = max(0, min(positions) - width // 2)
+    end = min(len(text), start + width + max(len(term) for term in terms))
+    snippet = text[start:end].replace("\n", " ")
+    for term in terms:
+        snippet = re.sub(re.escape(term), lambda match: f"**{match.group(0)}**", snippet, flags=re.IGNORECASE)
+    return ("…" if start > 0 else "") + snippet + ("…" if end < len(text) else "")
+
+# 中日韓文字（漢字、假名、諺文）連續段落
+CJK_RUN = re.compile(r"[\u3041-\u3096\u30a1-\u30fa\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7a3\uf900-\ufaff]+")
+
+def chat_grams(text):
+    """雙字索引用：中日韓文字段落展開成依序相鄰的兩個字，後面再接各個單字；其他文字保持原樣"""
+    if not text:
+        return text
+
+    def expand(match):
+        run = match.group()
+        return " " + " ".join([run[i:i + 2] for i in range(len(run) - 1)] + list(run)) + " "
+
+    return CJK_RUN.sub(expand, text)
+
+def chat_grams_query(terms):
+    """把中日韓關鍵字轉成雙字索引的查詢：單字直接比對，兩字以上比對相鄰雙字組成的片語"""
+    phrases = []
+    for term in terms:
+        grams = [term[i:i + 2] for i in range(len(term) - 1)] or [term]
+        phrases.append('"' + " ".join(grams) + '"')
+    return " ".join(phrases)
+
+# 沒有索引可用時（例如英數字的短關鍵字），小青!回憶 只逐筆比對伺服器最新的幾筆記錄
+RECALL_SCAN_ROWS = 5000
+
+class RecallResults(list):
+    """搜尋結果；scanned 不為 None 時表示只逐筆比對了最新的 scanned 筆記錄"""
+    scanned = None
+
+def build_recall_results(rows, terms, scanned=None):
+    """把搜尋結果整理為 (用戶名稱, 是否為小青的回覆, 片段, 時間)"""
+    results = RecallResults()
+    results.scanned = scanned
+    for username, message, response, timestamp in rows:
+        snippet = chat_snippet(message, terms)
+        from_bot = snippet is None
+        if from_bot:
+            snippet = chat_snippet(response, terms)
+        if snippet:
+            results.append((username, from_bot, snippet, timestamp))
+    return results
+
+# 延遲解壓的聊天記錄：存取到某一列時才解壓該列
+class LazyChatRows(Sequence):
+    def __init__(self, rows, compressor):
+        self.rows = rows
+        self.compressor = compressor
+        self.decoded = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self.rows)))]
+        if index < 0:
+            index += len(self.rows)
+        if index not in self.decoded:
+            username, message, response = self.rows[index]
+            self.decoded[index] = (username, self.compressor.decompress(message), self.compressor.decompress(response))
+        return self.decoded[index]
+
+    def __repr__(self):
+        return f"LazyChatRows({len(self.rows)} 筆)"
 
 # 資料庫相關功能
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, db_path=None, compression=None):
         try:
             # 使用絕對路徑確保資料庫文件位置正確
-            db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_history.db')
+            db_path = os.path.abspath(db_path or DB_PATH)
             self.db_path = db_path
             
             # 檢查目錄權限
@@ -81,17 +1370,17 @@ class DatabaseManager:
             # 檢查資料庫是否損壞並嘗試修復
             if os.path.exists(db_path):
                 try:
-                    # 嘗試連接並檢查完整性
+                    # 嘗試連接並快速檢查（完整檢查改由背景健康檢查執行）
                     test_conn = None
                     try:
                         test_conn = sqlite3.connect(db_path, check_same_thread=False, timeout=5.0)
                         test_cursor = test_conn.cursor()
-                        test_cursor.execute("PRAGMA integrity_check")
+                        test_cursor.execute("PRAGMA quick_check")
                         result = test_cursor.fetchone()
                         
                         if result and result[0] != "ok":
-                            print(f"警告：資料庫完整性檢查失敗: {result[0]}")
-                            print("嘗試修復資料庫...")
+                            logger.warning(f"警告：資料庫完整性檢查失敗: {result[0]}")
+                            logger.info("嘗試修復資料庫...")
                             # 確保連接關閉
                             test_conn.close()
                             test_conn = None
@@ -104,40 +1393,47 @@ class DatabaseManager:
                             test_conn.close()
                             
                 except sqlite3.DatabaseError as db_error:
-                    print(f"資料庫損壞檢測: {db_error}")
-                    print("嘗試修復資料庫...")
+                    logger.error(f"資料庫損壞檢測: {db_error}")
+                    logger.info("嘗試修復資料庫...")
                     # 等待一下讓文件釋放
                     import time
                     time.sleep(0.5)
                     self._repair_database(db_path)
                 except Exception as e:
-                    print(f"檢查資料庫時發生錯誤: {e}")
+                    logger.error(f"檢查資料庫時發生錯誤: {e}")
             
             # 檢查修復後的資料庫是否可用
             if not os.path.exists(db_path):
                 # 資料庫已被刪除或重命名，使用原路徑創建新資料庫
-                print("將創建新的資料庫文件")
+                logger.info("將創建新的資料庫文件")
             elif not self._can_connect(db_path):
                 # 資料庫存在但無法連接，嘗試重命名
                 try:
                     corrupted_path = db_path + f".corrupted_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
                     os.rename(db_path, corrupted_path)
-                    print(f"已將損壞的資料庫重命名為: {corrupted_path}")
-                    print("將創建新的資料庫文件")
+                    logger.info(f"已將損壞的資料庫重命名為: {corrupted_path}")
+                    logger.info("將創建新的資料庫文件")
                 except Exception as e:
-                    print(f"無法重命名損壞的資料庫: {e}")
+                    logger.warning(f"無法重命名損壞的資料庫: {e}")
                     # 使用新資料庫文件名
-                    db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_history_new.db')
+                    db_path = os.path.join(os.path.dirname(db_path), 'chat_history_new.db')
                     self.db_path = db_path
-                    print(f"將使用新的資料庫文件: {db_path}")
+                    logger.info(f"將使用新的資料庫文件: {db_path}")
             
             # 確保使用正確的路徑
             self.db_path = db_path
             self.conn = sqlite3.connect(db_path, check_same_thread=False, timeout=10.0)
+            # WAL 模式讓多個分片程序可同時讀取，寫入時也不會阻擋讀取
+            self.conn.execute("PRAGMA journal_mode=WAL")
             self.cursor = self.conn.cursor()
+            self.compressor = ChatCompressor(compression or os.getenv('CHAT_COMPRESSION', 'auto'), db_path)
+            # 觸發器（全文索引）透過 chat_text() 取得解壓後的文字
+            self.conn.create_function("chat_text", 1, self.compressor.chat_text, deterministic=True)
+            self.conn.create_function("chat_grams", 1, chat_grams, deterministic=True)
             self.setup_database()
+            self.compressor.load(self.conn)
         except Exception as e:
-            print(f"資料庫初始化錯誤: {e}")
+            logger.error(f"資料庫初始化錯誤: {e}")
             raise e
     
     def _can_connect(self, db_path):
@@ -160,9 +1456,9 @@ class DatabaseManager:
             if os.path.exists(db_path):
                 try:
                     shutil.copy2(db_path, backup_path)
-                    print(f"已創建資料庫備份: {backup_path}")
+                    logger.info(f"已創建資料庫備份: {backup_path}")
                 except Exception as e:
-                    print(f"創建備份失敗: {e}")
+                    logger.warning(f"創建備份失敗: {e}")
             
             # 等待一下，確保所有連接都已關閉
             time.sleep(1)
@@ -174,7 +1470,7 @@ class DatabaseManager:
                 repair_conn.execute("VACUUM")
                 repair_conn.close()
                 repair_conn = None
-                print("資料庫修復完成（VACUUM）")
+                logger.info("資料庫修復完成（VACUUM）")
                 time.sleep(0.5)
                 
                 # 再次檢查完整性
@@ -188,15 +1484,15 @@ class DatabaseManager:
                     test_conn = None
                     
                     if result and result[0] == "ok":
-                        print("資料庫完整性檢查通過")
+                        logger.info("資料庫完整性檢查通過")
                         return
                     else:
-                        print("VACUUM 後資料庫仍然損壞，將重新創建")
+                        logger.info("VACUUM 後資料庫仍然損壞，將重新創建")
                 finally:
                     if test_conn:
                         test_conn.close()
             except Exception as e:
-                print(f"VACUUM 修復失敗: {e}")
+                logger.warning(f"VACUUM 修復失敗: {e}")
             finally:
                 if repair_conn:
                     repair_conn.close()
@@ -209,140 +1505,300 @@ class DatabaseManager:
                     corrupted_path = db_path + f".corrupted_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
                     try:
                         os.rename(db_path, corrupted_path)
-                        print(f"已將損壞的資料庫重命名為: {corrupted_path}")
-                        print("將創建新的資料庫文件")
+                        logger.info(f"已將損壞的資料庫重命名為: {corrupted_path}")
+                        logger.info("將創建新的資料庫文件")
                     except Exception as rename_error:
                         # 如果重命名也失敗，嘗試刪除
-                        print(f"無法重命名資料庫: {rename_error}")
-                        print("嘗試刪除損壞的資料庫...")
+                        logger.warning(f"無法重命名資料庫: {rename_error}")
+                        logger.info("嘗試刪除損壞的資料庫...")
                         try:
                             os.remove(db_path)
-                            print("已刪除損壞的資料庫，將重新創建")
+                            logger.info("已刪除損壞的資料庫，將重新創建")
                         except Exception as remove_error:
-                            print(f"無法刪除損壞的資料庫: {remove_error}")
-                            print("警告：無法處理損壞的資料庫，程序將嘗試繼續運行")
-                            print("請手動關閉所有使用該資料庫的程序，然後重新啟動機器人")
+                            logger.warning(f"無法刪除損壞的資料庫: {remove_error}")
+                            logger.warning("警告：無法處理損壞的資料庫，程序將嘗試繼續運行")
+                            logger.info("請手動關閉所有使用該資料庫的程序，然後重新啟動機器人")
             except Exception as e:
-                print(f"處理損壞資料庫時發生錯誤: {e}")
+                logger.error(f"處理損壞資料庫時發生錯誤: {e}")
                     
         except Exception as e:
-            print(f"修復資料庫時發生錯誤: {e}")
-            print("警告：資料庫修復失敗，程序將嘗試繼續運行")
-            print("如果遇到問題，請手動關閉所有使用該資料庫的程序，然後重新啟動機器人")
+            logger.error(f"修復資料庫時發生錯誤: {e}")
+            logger.warning("警告：資料庫修復失敗，程序將嘗試繼續運行")
+            logger.info("如果遇到問題，請手動關閉所有使用該資料庫的程序，然後重新啟動機器人")
+    
+    # 目前的資料表結構版本（記錄於 PRAGMA user_version）
+    # 2：伺服器與用戶 ID 改存為 INTEGER，用戶名稱集中在 users 表，攻擊記錄以怪物 id 參照
+    SCHEMA_VERSION = 2
+    
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            user_id INTEGER,
+            message TEXT,
+            response TEXT,
+            timestamp DATETIME
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history (server_id, user_id, id);
+        CREATE TABLE IF NOT EXISTS chat_turns (
+            server_id INTEGER,
+            user_id INTEGER,
+            turns INTEGER,
+            PRIMARY KEY (server_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS monsters (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            name TEXT,
+            tier TEXT,
+            appearance TEXT,
+            max_hp INTEGER,
+            current_hp INTEGER,
+            created_at DATETIME,
+            is_alive INTEGER DEFAULT 1,
+            monster_type TEXT DEFAULT 'personal',
+            UNIQUE(server_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS monster_attacks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            monster_id INTEGER REFERENCES monsters(id),
+            user_id INTEGER,
+            damage INTEGER,
+            timestamp DATETIME
+        );
+        CREATE INDEX IF NOT EXISTS idx_monster_attacks_monster ON monster_attacks (monster_id);
+        CREATE TABLE IF NOT EXISTS team_goals (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            target_count INTEGER,
+            killed_count INTEGER DEFAULT 0,
+            month_year TEXT,
+            created_at DATETIME,
+            UNIQUE(server_id, month_year)
+        );
+        CREATE TABLE IF NOT EXISTS personal_kills (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            server_id INTEGER,
+            user_id INTEGER,
+            kill_count INTEGER DEFAULT 0,
+            month_year TEXT,
+            UNIQUE(server_id, user_id, month_year)
+        );
+        CREATE TABLE IF NOT EXISTS chat_dictionaries (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            codec TEXT,
+            data BLOB,
+            samples INTEGER,
+            created_at DATETIME
+        );
+    '''
     
     def setup_database(self):
         try:
-            # 創建用戶對話記錄表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    server_id TEXT,
-                    user_id TEXT,
-                    username TEXT,
-                    message TEXT,
-                    response TEXT,
-                    timestamp DATETIME,
-                    UNIQUE(server_id, user_id, id)
-                )
-            ''')
-            
-            # 創建怪物資料表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS monsters (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    server_id TEXT,
-                    name TEXT,
-                    tier TEXT,
-                    appearance TEXT,
-                    max_hp INTEGER,
-                    current_hp INTEGER,
-                    created_at DATETIME,
-                    is_alive INTEGER DEFAULT 1,
-                    monster_type TEXT DEFAULT 'personal',
-                    UNIQUE(server_id, name)
-                )
-            ''')
-            
-            # 創建怪物攻擊記錄表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS monster_attacks (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    server_id TEXT,
-                    monster_name TEXT,
-                    user_id TEXT,
-                    username TEXT,
-                    damage INTEGER,
-                    timestamp DATETIME
-                )
-            ''')
-            
-            # 創建團隊目標表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS team_goals (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    server_id TEXT,
-                    target_count INTEGER,
-                    killed_count INTEGER DEFAULT 0,
-                    month_year TEXT,
-                    created_at DATETIME,
-                    UNIQUE(server_id, month_year)
-                )
-            ''')
-            
-            # 創建個人擊殺統計表
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS personal_kills (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    server_id TEXT,
-                    user_id TEXT,
-                    username TEXT,
-                    kill_count INTEGER DEFAULT 0,
-                    month_year TEXT,
-                    UNIQUE(server_id, user_id, month_year)
-                )
-            ''')
-            
-            # 資料庫遷移：檢查並添加缺失的欄位
-            try:
-                # 檢查 monsters 表是否有 monster_type 欄位
-                self.cursor.execute("PRAGMA table_info(monsters)")
-                columns = [column[1] for column in self.cursor.fetchall()]
-                if 'monster_type' not in columns:
-                    print("正在添加 monster_type 欄位到 monsters 表...")
-                    self.cursor.execute('''
-                        ALTER TABLE monsters 
-                        ADD COLUMN monster_type TEXT DEFAULT 'personal'
-                    ''')
-                    print("成功添加 monster_type 欄位")
-            except Exception as e:
-                print(f"資料庫遷移錯誤（monster_type）: {e}")
-            
-            self.conn.commit()
-            
-            # 檢查資料庫完整性
-            self.cursor.execute("PRAGMA integrity_check")
-            result = self.cursor.fetchone()
-            if result[0] != "ok":
-                print(f"警告：資料庫完整性檢查失敗: {result[0]}")
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            self.cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'chat_history'")
+            if version < self.SCHEMA_VERSION and self.cursor.fetchone():
+                self._migrate_to_integer_ids()
             else:
-                print("資料庫完整性檢查通過")
+                self.conn.executescript(self.SCHEMA)
+                self.conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            self.conn.commit()
+            self._setup_fulltext()
                 
         except Exception as e:
-            print(f"資料庫設置錯誤: {e}")
+            logger.error(f"資料庫設置錯誤: {e}")
             raise e
     
+    def _setup_fulltext(self):
+        """建立 chat_history 的 FTS5 全文索引（trigram 分詞，支援中文），以觸發器保持同步"""
+        # 索引本身不儲存內容（content=''），刪除時以 chat_text() 取回原文字；無法解壓的記錄 chat_text() 為 NULL，不會被索引
+        statements = (
+            '''CREATE VIRTUAL TABLE chat_fts USING fts5(message, response, content='', tokenize='trigram')''',
+            '''CREATE TRIGGER IF NOT EXISTS chat_fts_insert AFTER INSERT ON chat_history BEGIN
+                INSERT INTO chat_fts (rowid, message, response)
+                VALUES (new.id, chat_text(new.message), chat_text(new.response));
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS chat_fts_delete AFTER DELETE ON chat_history BEGIN
+                INSERT INTO chat_fts (chat_fts, rowid, message, response)
+                VALUES ('delete', old.id, chat_text(old.message), chat_text(old.response));
+            END''',
+            # 重新壓縮只改變儲存格式，文字相同時不需重建索引
+            '''CREATE TRIGGER IF NOT EXISTS chat_fts_update AFTER UPDATE OF message, response ON chat_history
+            WHEN chat_text(old.message) IS NOT chat_text(new.message)
+                OR chat_text(old.response) IS NOT chat_text(new.response) BEGIN
+                INSERT INTO chat_fts (chat_fts, rowid, message, response)
+                VALUES ('delete', old.id, chat_text(old.message), chat_text(old.response));
+                INSERT INTO chat_fts (rowid, message, response)
+                VALUES (new.id, chat_text(new.message), chat_text(new.response));
+            END''',
+        )
+        self.fts_enabled = False
+        try:
+            exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_fts'").fetchone()
+            if not exists:
+                self.conn.execute(statements[0])
+            for statement in statements[1:]:
+                self.conn.execute(statement)
+            if not exists:
+                # 為既有的對話記錄建立索引
+                self.conn.execute('''
+                    INSERT INTO chat_fts (rowid, message, response)
+                    SELECT id, chat_text(message), chat_text(response) FROM chat_history
+                ''')
+                logger.info("已建立對話記錄全文索引")
+            self.conn.commit()
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            self.conn.rollback()
+            logger.warning(f"無法建立全文索引（SQLite 需支援 FTS5 trigram），小青!回憶 將改用逐筆比對: {e}")
+        self._setup_grams()
+    
+    def _setup_grams(self):
+        """建立中日韓雙字索引：trigram 無法搜尋一、兩個字的關鍵字（例如「貓」「魔王」），以 chat_grams() 展開後另建一個索引"""
+        statements = (
+            '''CREATE VIRTUAL TABLE chat_grams_fts USING fts5(message, response, content='', tokenize='unicode61')''',
+            '''CREATE TRIGGER IF NOT EXISTS chat_grams_insert AFTER INSERT ON chat_history BEGIN
+                INSERT INTO chat_grams_fts (rowid, message, response)
+                VALUES (new.id, chat_grams(chat_text(new.message)), chat_grams(chat_text(new.response)));
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS chat_grams_delete AFTER DELETE ON chat_history BEGIN
+                INSERT INTO chat_grams_fts (chat_grams_fts, rowid, message, response)
+                VALUES ('delete', old.id, chat_grams(chat_text(old.message)), chat_grams(chat_text(old.response)));
+            END''',
+            '''CREATE TRIGGER IF NOT EXISTS chat_grams_update AFTER UPDATE OF message, response ON chat_history
+            WHEN chat_text(old.message) IS NOT chat_text(new.message)
+                OR chat_text(old.response) IS NOT chat_text(new.response) BEGIN
+                INSERT INTO chat_grams_fts (chat_grams_fts, rowid, message, response)
+                VALUES ('delete', old.id, chat_grams(chat_text(old.message)), chat_grams(chat_text(old.response)));
+                INSERT INTO chat_grams_fts (rowid, message, response)
+                VALUES (new.id, chat_grams(chat_text(new.message)), chat_grams(chat_text(new.response)));
+            END''',
+        )
+        self.grams_enabled = False
+        try:
+            exists = self.conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'chat_grams_fts'").fetchone()
+            if not exists:
+                self.conn.execute(statements[0])
+            for statement in statements[1:]:
+                self.conn.execute(statement)
+            if not exists:
+                # 為既有的對話記錄建立索引
+                self.conn.execute('''
+                    INSERT INTO chat_grams_fts (rowid, message, response)
+                    SELECT id, chat_grams(chat_text(message)), chat_grams(chat_text(response)) FROM chat_history
+                ''')
+                logger.info("已建立對話記錄雙字索引")
+            self.conn.commit()
+            self.grams_enabled = True
+        except sqlite3.OperationalError as e:
+            self.conn.rollback()
+            logger.warning(f"無法建立雙字索引（SQLite 需支援 FTS5），短關鍵字只會搜尋最新的 {RECALL_SCAN_ROWS} 筆記錄: {e}")
+
+    def _migrate_to_integer_ids(self):
+        """將舊版（TEXT ID、每列重複用戶名稱）的資料表遷移到目前的結構"""
+        logger.info("正在遷移資料庫結構：ID 改為 INTEGER 並建立 users 表...")
+        conn = self.conn
+        tables = ("chat_history", "monsters", "monster_attacks", "team_goals", "personal_kills")
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        # 舊版資料庫可能缺少 monster_type 欄位
+        if "monsters" in existing:
+            columns = [column[1] for column in conn.execute("PRAGMA table_info(monsters)").fetchall()]
+            if 'monster_type' not in columns:
+                conn.execute("ALTER TABLE monsters ADD COLUMN monster_type TEXT DEFAULT 'personal'")
+        copies = {
+            "chat_history": '''
+                INSERT INTO chat_history (id, server_id, user_id, message, response, timestamp)
+                SELECT id, CAST(server_id AS INTEGER), CAST(user_id AS INTEGER), message, response, timestamp
+                FROM chat_history_v1
+            ''',
+            "monsters": '''
+                INSERT INTO monsters (id, server_id, name, tier, appearance, max_hp, current_hp, created_at, is_alive, monster_type)
+                SELECT id, CAST(server_id AS INTEGER), name, tier, appearance, max_hp, current_hp, created_at, is_alive, monster_type
+                FROM monsters_v1
+            ''',
+            # 攻擊記錄改以怪物 id 參照；已被清除的怪物其 monster_id 為 NULL
+            "monster_attacks": '''
+                INSERT INTO monster_attacks (id, server_id, monster_id, user_id, damage, timestamp)
+                SELECT a.id, CAST(a.server_id AS INTEGER), m.id, CAST(a.user_id AS INTEGER), a.damage, a.timestamp
+                FROM monster_attacks_v1 a
+                LEFT JOIN monsters m ON m.server_id = CAST(a.server_id AS INTEGER) AND m.name = a.monster_name
+            ''',
+            "team_goals": '''
+                INSERT INTO team_goals (id, server_id, target_count, killed_count, month_year, created_at)
+                SELECT id, CAST(server_id AS INTEGER), target_count, killed_count, month_year, created_at
+                FROM team_goals_v1
+            ''',
+            "personal_kills": '''
+                INSERT INTO personal_kills (id, server_id, user_id, kill_count, month_year)
+                SELECT id, CAST(server_id AS INTEGER), CAST(user_id AS INTEGER), kill_count, month_year
+                FROM personal_kills_v1
+            ''',
+        }
+        # 每位用戶保留最新的名稱（擊殺統計沒有時間，優先序最低）
+        name_sources = {
+            "chat_history": "SELECT user_id, username, timestamp AS seen FROM chat_history_v1",
+            "monster_attacks": "SELECT user_id, username, timestamp AS seen FROM monster_attacks_v1",
+            "personal_kills": "SELECT user_id, username, '' AS seen FROM personal_kills_v1",
+        }
+        try:
+            conn.execute("BEGIN")
+            migrated = [table for table in tables if table in existing]
+            for table in migrated:
+                conn.execute(f"ALTER TABLE {table} RENAME TO {table}_v1")
+            for statement in self.SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+            sources = [sql for table, sql in name_sources.items() if table in existing]
+            if sources:
+                conn.execute(f'''
+                    INSERT INTO users (user_id, username)
+                    SELECT CAST(user_id AS INTEGER), username FROM (
+                        SELECT user_id, username, ROW_NUMBER() OVER (
+                            PARTITION BY user_id ORDER BY seen DESC
+                        ) AS rank
+                        FROM ({" UNION ALL ".join(sources)})
+                        WHERE user_id IS NOT NULL
+                    ) WHERE rank = 1
+                ''')
+            for table in migrated:
+                conn.execute(copies[table])
+            for table in migrated:
+                conn.execute(f"DROP TABLE {table}_v1")
+            conn.execute(f"PRAGMA user_version = {self.SCHEMA_VERSION}")
+            conn.commit()
+            logger.info("資料庫結構遷移完成")
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"資料庫結構遷移錯誤: {e}")
+            raise
+    
+    def _upsert_user(self, user_id, username):
+        """記錄用戶最新的名稱（名稱未變時不寫入）"""
+        self.cursor.execute('''
+            INSERT INTO users (user_id, username) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET username = excluded.username
+            WHERE users.username IS NOT excluded.username
+        ''', (user_id, username))
+    
+    def run_integrity_check(self):
+        """執行完整的資料庫完整性檢查（使用獨立連接，可在背景執行緒中呼叫）"""
+        check_conn = None
+        try:
+            check_conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10.0)
+            result = check_conn.execute("PRAGMA integrity_check").fetchone()
+            return result[0] if result else "無結果"
+        finally:
+            if check_conn:
+                check_conn.close()
+    
+    @traced("db")
     def add_chat(self, server_id, user_id, username, message, response):
         try:
-            # 檢查記憶體使用情況
-            memory = psutil.virtual_memory()
-            if memory.percent > 90:  # 記憶體使用率超過90%
-                print(f"警告：記憶體使用率過高 ({memory.percent}%)")
-            
-            # 檢查磁碟空間
-            disk = psutil.disk_usage('.')
-            if disk.free < 50 * 1024 * 1024:  # 少於 50MB
-                print(f"警告：磁碟空間不足 ({disk.free / 1024 / 1024:.1f}MB)")
-            
             # 檢查該用戶是否超過 60 條記錄
             self.cursor.execute('''
                 SELECT COUNT(*) 
@@ -358,76 +1814,180 @@ class DatabaseManager:
                     WHERE server_id = ? AND user_id = ? AND id IN (
                         SELECT id FROM chat_history 
                         WHERE server_id = ? AND user_id = ?
-                        ORDER BY timestamp ASC 
+                        ORDER BY id ASC 
                         LIMIT 1
                     )
                 ''', (server_id, user_id, server_id, user_id))
             
-            # 添加新記錄
+            # 累計對話輪數只增不減（記錄上限 60 條，筆數不能用來對齊歷史視窗）
+            self.cursor.execute('''
+                INSERT INTO chat_turns (server_id, user_id, turns) VALUES (?, ?, ?)
+                ON CONFLICT(server_id, user_id) DO UPDATE SET turns = turns + 1
+            ''', (server_id, user_id, count + 1))
+            
+            # 添加新記錄（用戶名稱只記在 users 表，訊息與回應壓縮儲存）
+            self._upsert_user(user_id, username)
+            stored_message = self.compressor.compress(message)
+            stored_response = self.compressor.compress(response)
             self.cursor.execute('''
-                INSERT INTO chat_history (server_id, user_id, username, message, response, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (server_id, user_id, username, message, response, datetime.now()))
+                INSERT INTO chat_history (server_id, user_id, message, response, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (server_id, user_id, stored_message, stored_response, datetime.now()))
             
             self.conn.commit()
-            print(f"成功添加聊天記錄: {username}")
+            self.compressor.record_write(self.conn, (message, stored_message), (response, stored_response))
+            logger.debug("成功添加聊天記錄: %s", username)
         except Exception as e:
-            print(f"添加聊天記錄錯誤: {e}")
+            logger.error(f"添加聊天記錄錯誤: {e}")
             # 嘗試重新連接資料庫
             try:
                 self.conn.rollback()
-                db_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chat_history.db')
-                self.conn = sqlite3.connect(db_path, check_same_thread=False)
+                self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
+                self.conn.create_function("chat_text", 1, self.compressor.chat_text, deterministic=True)
+                self.conn.create_function("chat_grams", 1, chat_grams, deterministic=True)
                 self.cursor = self.conn.cursor()
-                print("資料庫重新連接成功")
+                logger.info("資料庫重新連接成功")
             except Exception as reconnect_error:
-                print(f"重新連接資料庫失敗: {reconnect_error}")
+                logger.warning(f"重新連接資料庫失敗: {reconnect_error}")
     
-    def get_chat_history(self, server_id, user_id=None, limit=60):
+    @staticmethod
+    def aligned_limit(total, limit, block):
+        """讓歷史視窗的起點只在每 block 輪移動一次：回傳 limit 到 limit + block - 1 之間的筆數
+        （total 為累計對話輪數；起點不變時，前面的對話在每次請求中完全相同，可命中提示快取）"""
+        if block <= 1 or total <= limit:
+            return limit
+        return total - (total - limit) // block * block
+
+    @traced("db")
+    def get_chat_history(self, server_id, user_id=None, limit=60, block=1):
         try:
             if user_id:
+                if block > 1:
+                    self.cursor.execute(
+                        "SELECT turns FROM chat_turns WHERE server_id = ? AND user_id = ?", (server_id, user_id)
+                    )
+                    row = self.cursor.fetchone()
+                    if row is None:
+                        # 尚未記錄輪數的舊用戶，以目前的筆數為起點
+                        self.cursor.execute(
+                            "SELECT COUNT(*) FROM chat_history WHERE server_id = ? AND user_id = ?", (server_id, user_id)
+                        )
+                        row = self.cursor.fetchone()
+                    limit = self.aligned_limit(row[0], limit, block)
                 # 獲取特定用戶的歷史記錄
                 self.cursor.execute('''
-                    SELECT username, message, response 
-                    FROM chat_history 
-                    WHERE server_id = ? AND user_id = ?
-                    ORDER BY timestamp DESC 
+                    SELECT u.username, c.message, c.response 
+                    FROM chat_history c
+                    LEFT JOIN users u ON u.user_id = c.user_id
+                    WHERE c.server_id = ? AND c.user_id = ?
+                    ORDER BY c.id DESC 
                     LIMIT ?
                 ''', (server_id, user_id, limit))
             else:
                 # 獲取伺服器的所有歷史記錄
                 self.cursor.execute('''
-                    SELECT username, message, response 
-                    FROM chat_history 
-                    WHERE server_id = ? 
-                    ORDER BY timestamp DESC 
+                    SELECT u.username, c.message, c.response 
+                    FROM chat_history c
+                    LEFT JOIN users u ON u.user_id = c.user_id
+                    WHERE c.server_id = ? 
+                    ORDER BY c.id DESC 
                     LIMIT ?
                 ''', (server_id, limit))
             
             result = self.cursor.fetchall()
-            print(f"成功獲取聊天歷史: {len(result)} 條記錄")
-            return result
+            # 無法解壓的記錄（缺少壓縮套件或字典）不放進提示，避免把空白的對話送給模型
+            readable = [row for row in result if self.compressor.readable(row[1]) and self.compressor.readable(row[2])]
+            if len(readable) < len(result):
+                logger.warning(f"略過 {len(result) - len(readable)} 筆無法解壓的聊天記錄")
+            logger.debug("成功獲取聊天歷史: %d 條記錄", len(readable))
+            return LazyChatRows(readable, self.compressor)
         except Exception as e:
-            print(f"獲取聊天歷史錯誤: {e}")
+            logger.error(f"獲取聊天歷史錯誤: {e}")
             return []
     
-    def add_monster(self, server_id, name, tier, appearance, max_hp, monster_type='personal'):
-        """新增怪物到資料庫"""
+    RECALL_CANDIDATES = 500  # 小青!回憶 依相關度排序前，最多取幾筆最新的符合記錄
+    
+    @traced("db")
+    def search_chat_history(self, server_id, keyword, limit=5):
+        """在伺服器的對話記錄中搜尋關鍵字（以空白分隔多個關鍵字），依相關度回傳片段"""
         try:
-            self.cursor.execute('''
-                INSERT INTO monsters (server_id, name, tier, appearance, max_hp, current_hp, created_at, is_alive, monster_type)
+            terms = keyword.split()
+            if not terms:
+                return []
+            scanned = None
+            if self.fts_enabled and all(len(term) >= 3 for term in terms):
+                table, query = "chat_fts", " ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            elif self.grams_enabled and all(CJK_RUN.fullmatch(term) for term in terms):
+                # trigram 索引無法搜尋少於 3 個字的關鍵字，中日韓關鍵字改用雙字索引
+                table, query = "chat_grams_fts", chat_grams_query(terms)
+            else:
+                table = query = None
+            if table:
+                # 常見關鍵字可能對應數萬筆記錄，只在最新的候選中依相關度排序，
+                # 並且只解壓最後要顯示的記錄
+                self.cursor.execute(f'''
+                    SELECT u.username, chat_text(c.message), chat_text(c.response), c.timestamp
+                    FROM (
+                        SELECT id, rank FROM (
+                            SELECT f.rowid AS id, f.rank AS rank
+                            FROM {table} f
+                            JOIN chat_history h ON h.id = f.rowid
+                            WHERE {table} MATCH ? AND h.server_id = ?
+                            ORDER BY f.rowid DESC
+                            LIMIT ?
+                        )
+                        ORDER BY rank
+                        LIMIT ?
+                    ) AS top
+                    JOIN chat_history c ON c.id = top.id
+                    LEFT JOIN users u ON u.user_id = c.user_id
+                    ORDER BY top.rank
+                ''', (query, server_id, self.RECALL_CANDIDATES, limit))
+            else:
+                # 沒有索引可用（例如英數字的短關鍵字），只逐筆比對最新的 RECALL_SCAN_ROWS 筆記錄（最新的優先）
+                scanned = RECALL_SCAN_ROWS
+                patterns = []
+                for term in terms:
+                    pattern = "%" + re.sub(r"([%_\\])", r"\\\1", term) + "%"
+                    patterns.extend([pattern, pattern])
+                conditions = " AND ".join(
+                    ["(chat_text(c.message) LIKE ? ESCAPE '\\' OR chat_text(c.response) LIKE ? ESCAPE '\\')"] * len(terms)
+                )
+                self.cursor.execute(f'''
+                    SELECT u.username, chat_text(c.message), chat_text(c.response), c.timestamp
+                    FROM (
+                        SELECT id FROM chat_history WHERE server_id = ? ORDER BY id DESC LIMIT ?
+                    ) AS recent
+                    JOIN chat_history c ON c.id = recent.id
+                    LEFT JOIN users u ON u.user_id = c.user_id
+                    WHERE {conditions}
+                    ORDER BY c.id DESC
+                    LIMIT ?
+                ''', (server_id, scanned, *patterns, limit))
+            return build_recall_results(self.cursor.fetchall(), terms, scanned)
+        except Exception as e:
+            logger.error(f"搜尋聊天記錄錯誤: {e}")
+            return []
+    
+    @traced("db")
+    def add_monster(self, server_id, name, tier, appearance, max_hp, monster_type='personal'):
+        """新增怪物到資料庫"""
+        try:
+            self.cursor.execute('''
+                INSERT INTO monsters (server_id, name, tier, appearance, max_hp, current_hp, created_at, is_alive, monster_type)
                 VALUES (?, ?, ?, ?, ?, ?, ?, 1, ?)
             ''', (server_id, name, tier, appearance, max_hp, max_hp, datetime.now(), monster_type))
             self.conn.commit()
-            print(f"成功新增怪物: {name}")
+            logger.info(f"成功新增怪物: {name}")
             return True
         except sqlite3.IntegrityError:
-            print(f"怪物已存在: {name}")
+            logger.info(f"怪物已存在: {name}")
             return False
         except Exception as e:
-            print(f"新增怪物錯誤: {e}")
+            logger.error(f"新增怪物錯誤: {e}")
             return False
     
+    @traced("db")
     def get_monster(self, server_id, name):
         """獲取怪物資料"""
         try:
@@ -438,18 +1998,24 @@ class DatabaseManager:
             ''', (server_id, name))
             return self.cursor.fetchone()
         except Exception as e:
-            print(f"獲取怪物資料錯誤: {e}")
+            logger.error(f"獲取怪物資料錯誤: {e}")
             return None
     
+    @traced("db")
     def attack_monster(self, server_id, monster_name, user_id, username, damage):
         """攻擊怪物並記錄"""
         try:
             # 獲取怪物當前血量
-            monster = self.get_monster(server_id, monster_name)
+            self.cursor.execute('''
+                SELECT id, current_hp, is_alive
+                FROM monsters
+                WHERE server_id = ? AND name = ?
+            ''', (server_id, monster_name))
+            monster = self.cursor.fetchone()
             if not monster:
                 return None, "怪物不存在"
             
-            name, tier, appearance, max_hp, current_hp, is_alive = monster
+            monster_id, current_hp, is_alive = monster
             
             if not is_alive:
                 return None, "怪物已經被擊敗了"
@@ -461,35 +2027,85 @@ class DatabaseManager:
             self.cursor.execute('''
                 UPDATE monsters
                 SET current_hp = ?, is_alive = ?
-                WHERE server_id = ? AND name = ?
-            ''', (new_hp, 1 if new_hp > 0 else 0, server_id, monster_name))
+                WHERE id = ?
+            ''', (new_hp, 1 if new_hp > 0 else 0, monster_id))
             
             # 記錄攻擊
+            self._upsert_user(user_id, username)
             self.cursor.execute('''
-                INSERT INTO monster_attacks (server_id, monster_name, user_id, username, damage, timestamp)
-                VALUES (?, ?, ?, ?, ?, ?)
-            ''', (server_id, monster_name, user_id, username, damage, datetime.now()))
+                INSERT INTO monster_attacks (server_id, monster_id, user_id, damage, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (server_id, monster_id, user_id, damage, datetime.now()))
             
             self.conn.commit()
             
             return new_hp, None
         except Exception as e:
-            print(f"攻擊怪物錯誤: {e}")
+            logger.error(f"攻擊怪物錯誤: {e}")
             return None, str(e)
-    
+
+    @traced("db")
+    def record_boss_damage(self, server_id, monster_name, damage, attacks):
+        """寫入世界王一次合併的總傷害與各用戶傷害（attacks 為 (用戶 ID, 名稱, 傷害) 列表）
+        資料庫錯誤會直接拋出，由呼叫端保留傷害稍後重試"""
+        try:
+            self.cursor.execute('''
+                SELECT id, is_alive
+                FROM monsters
+                WHERE server_id = ? AND name = ?
+            ''', (server_id, monster_name))
+            monster = self.cursor.fetchone()
+            if not monster:
+                return None, "怪物不存在"
+            monster_id, is_alive = monster
+            if not is_alive:
+                return None, "怪物已經被擊敗了"
+
+            # 以 is_alive = 1 為條件扣血，血量歸零只會發生一次
+            self.cursor.execute('''
+                UPDATE monsters
+                SET current_hp = MAX(0, current_hp - ?),
+                    is_alive = CASE WHEN current_hp - ? > 0 THEN 1 ELSE 0 END
+                WHERE id = ? AND is_alive = 1
+            ''', (damage, damage, monster_id))
+            if self.cursor.rowcount == 0:
+                # 查詢後已被其他連接擊敗：這次合併不能再公告一次擊殺
+                self.conn.rollback()
+                return None, "怪物已經被擊敗了"
+            self.cursor.execute('SELECT current_hp FROM monsters WHERE id = ?', (monster_id,))
+            new_hp = self.cursor.fetchone()[0]
+
+            now = datetime.now()
+            for user_id, username, _ in attacks:
+                self._upsert_user(user_id, username)
+            self.cursor.executemany('''
+                INSERT INTO monster_attacks (server_id, monster_id, user_id, damage, timestamp)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(server_id, monster_id, user_id, user_damage, now) for user_id, _, user_damage in attacks])
+
+            self.conn.commit()
+            return new_hp, None
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    @traced("db")
     def get_monster_attackers(self, server_id, monster_name):
         """獲取攻擊過怪物的所有用戶"""
         try:
             self.cursor.execute('''
-                SELECT DISTINCT user_id, username
-                FROM monster_attacks
-                WHERE server_id = ? AND monster_name = ?
+                SELECT DISTINCT a.user_id, u.username
+                FROM monsters m
+                JOIN monster_attacks a ON a.monster_id = m.id
+                LEFT JOIN users u ON u.user_id = a.user_id
+                WHERE m.server_id = ? AND m.name = ?
             ''', (server_id, monster_name))
             return self.cursor.fetchall()
         except Exception as e:
-            print(f"獲取攻擊者列表錯誤: {e}")
+            logger.error(f"獲取攻擊者列表錯誤: {e}")
             return []
     
+    @traced("db")
     def set_team_goal(self, server_id, target_count, month_year):
         """設置團隊目標"""
         try:
@@ -500,9 +2116,10 @@ class DatabaseManager:
             self.conn.commit()
             return True
         except Exception as e:
-            print(f"設置團隊目標錯誤: {e}")
+            logger.error(f"設置團隊目標錯誤: {e}")
             return False
     
+    @traced("db")
     def get_team_goal(self, server_id, month_year):
         """獲取團隊目標"""
         try:
@@ -516,9 +2133,10 @@ class DatabaseManager:
                 return result[0], result[1]
             return None, None
         except Exception as e:
-            print(f"獲取團隊目標錯誤: {e}")
+            logger.error(f"獲取團隊目標錯誤: {e}")
             return None, None
     
+    @traced("db")
     def increment_team_kills(self, server_id, month_year):
         """增加團隊擊殺數"""
         try:
@@ -530,12 +2148,14 @@ class DatabaseManager:
             self.conn.commit()
             return True
         except Exception as e:
-            print(f"增加團隊擊殺數錯誤: {e}")
+            logger.error(f"增加團隊擊殺數錯誤: {e}")
             return False
     
+    @traced("db")
     def increment_personal_kills(self, server_id, user_id, username, month_year):
         """增加個人擊殺數"""
         try:
+            self._upsert_user(user_id, username)
             # 先檢查是否存在
             self.cursor.execute('''
                 SELECT kill_count FROM personal_kills
@@ -547,22 +2167,23 @@ class DatabaseManager:
                 # 更新
                 self.cursor.execute('''
                     UPDATE personal_kills
-                    SET kill_count = kill_count + 1, username = ?
+                    SET kill_count = kill_count + 1
                     WHERE server_id = ? AND user_id = ? AND month_year = ?
-                ''', (username, server_id, user_id, month_year))
+                ''', (server_id, user_id, month_year))
             else:
                 # 新增
                 self.cursor.execute('''
-                    INSERT INTO personal_kills (server_id, user_id, username, kill_count, month_year)
-                    VALUES (?, ?, ?, 1, ?)
-                ''', (server_id, user_id, username, month_year))
+                    INSERT INTO personal_kills (server_id, user_id, kill_count, month_year)
+                    VALUES (?, ?, 1, ?)
+                ''', (server_id, user_id, month_year))
             
             self.conn.commit()
             return True
         except Exception as e:
-            print(f"增加個人擊殺數錯誤: {e}")
+            logger.error(f"增加個人擊殺數錯誤: {e}")
             return False
     
+    @traced("db")
     def get_personal_kills(self, server_id, user_id, month_year):
         """獲取個人擊殺數"""
         try:
@@ -573,9 +2194,10 @@ class DatabaseManager:
             result = self.cursor.fetchone()
             return result[0] if result else 0
         except Exception as e:
-            print(f"獲取個人擊殺數錯誤: {e}")
+            logger.error(f"獲取個人擊殺數錯誤: {e}")
             return 0
     
+    @traced("db")
     def get_total_personal_kills_last_month(self, server_id, last_month_year):
         """獲取上個月的所有玩家個人總擊殺數量"""
         try:
@@ -587,9 +2209,10 @@ class DatabaseManager:
             total = result[0] if result and result[0] is not None else 0
             return total
         except Exception as e:
-            print(f"獲取上個月個人總擊殺數錯誤: {e}")
+            logger.error(f"獲取上個月個人總擊殺數錯誤: {e}")
             return 0
     
+    @traced("db")
     def get_total_personal_kills_current_month(self, server_id, current_month_year):
         """獲取這個月的所有玩家個人總擊殺數量"""
         try:
@@ -601,9 +2224,10 @@ class DatabaseManager:
             total = result[0] if result and result[0] is not None else 0
             return total
         except Exception as e:
-            print(f"獲取這個月個人總擊殺數錯誤: {e}")
+            logger.error(f"獲取這個月個人總擊殺數錯誤: {e}")
             return 0
     
+    @traced("db")
     def has_personal_monsters_this_month(self, server_id, current_month_year):
         """檢查當前月份是否已有個人怪物"""
         try:
@@ -615,9 +2239,10 @@ class DatabaseManager:
             result = self.cursor.fetchone()
             return result[0] > 0 if result else False
         except Exception as e:
-            print(f"檢查本月個人怪物錯誤: {e}")
+            logger.error(f"檢查本月個人怪物錯誤: {e}")
             return False
     
+    @traced("db")
     def clear_monthly_monsters(self, server_id, month_year):
         """清空指定月份的未擊殺怪物"""
         try:
@@ -629,9 +2254,71 @@ class DatabaseManager:
             self.conn.commit()
             return True
         except Exception as e:
-            print(f"清空月度怪物錯誤: {e}")
+            logger.error(f"清空月度怪物錯誤: {e}")
             return False
     
+    @traced("db")
+    def get_alive_monsters(self, server_id):
+        """列出伺服器中仍存活的怪物名稱"""
+        try:
+            self.cursor.execute('''
+                SELECT name FROM monsters
+                WHERE server_id = ? AND is_alive = 1
+                ORDER BY id
+            ''', (server_id,))
+            return [row[0] for row in self.cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"獲取存活怪物列表錯誤: {e}")
+            return []
+
+    @traced("db")
+    def get_monster_names(self, server_id, limit=500):
+        """列出伺服器過去生成過的怪物名稱（最新的在前）"""
+        try:
+            self.cursor.execute('''
+                SELECT name FROM monsters
+                WHERE server_id = ?
+                ORDER BY id DESC
+                LIMIT ?
+            ''', (server_id, limit))
+            return [row[0] for row in self.cursor.fetchall()]
+        except Exception as e:
+            logger.error(f"獲取怪物名稱錯誤: {e}")
+            return []
+
+    def global_stats(self):
+        """統計各資料表的資料筆數"""
+        stats = {}
+        for table in ("chat_history", "monsters", "monster_attacks", "personal_kills", "users"):
+            try:
+                stats[table] = self.conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+            except Exception as e:
+                logger.error(f"統計資料表 {table} 錯誤: {e}")
+        return stats
+    
+    def format_status(self):
+        """格式化儲存狀態"""
+        stats = self.global_stats()
+        lines = ["**儲存**", "模式：單一資料庫", self.compressor.format_status()]
+        lines.extend(f"{table}：{count} 筆" for table, count in stats.items())
+        return "\n".join(lines)
+    
+    def compression_step(self, batch=100):
+        """壓縮的背景維護（在資料庫執行緒中執行一小步）：沒有工作時回傳 False；
+        需要訓練字典時回傳 (self, 樣本)，由呼叫端在其他執行緒訓練後呼叫 install_dictionary；
+        否則重新壓縮一批記錄並回傳 True"""
+        compressor = self.compressor
+        if compressor.training_due:
+            return self, compressor.training_samples(self.conn)
+        if compressor.recompress_after is not None:
+            compressor.recompress_batch(self.conn, batch)
+            return True
+        return False
+    
+    def install_dictionary(self, data, samples):
+        """儲存背景訓練好的字典"""
+        self.compressor.install_dictionary(self.conn, data, samples)
+    
     def close(self):
         """關閉資料庫連接"""
         try:
@@ -639,85 +2326,1726 @@ class DatabaseManager:
                 # 檢查是否有未提交的更改
                 self.conn.commit()
                 self.conn.close()
-                print("資料庫連接已關閉")
+                logger.info("資料庫連接已關閉")
         except Exception as e:
-            print(f"關閉資料庫連接錯誤: {e}")
+            logger.error(f"關閉資料庫連接錯誤: {e}")
             # 嘗試強制關閉
             try:
                 if hasattr(self.conn, '_close'):
                     self.conn._close()
             except Exception as force_close_error:
-                print(f"強制關閉資料庫連接失敗: {force_close_error}")
+                logger.warning(f"強制關閉資料庫連接失敗: {force_close_error}")
             except:
                 pass
 
-# 創建資料庫管理器實例
-db_manager = DatabaseManager()
+# 依伺服器分割的資料庫：每個伺服器一個檔案（guild）或依雜湊分到固定數量的檔案（bucket）
+# 各分割區各自有連接與損壞修復，寫入不再共用同一把 SQLite 寫入鎖
+class PartitionedDatabaseManager:
+    # 第一個參數為 server_id、需依伺服器分流的方法
+    ROUTED_METHODS = (
+        "add_chat", "get_chat_history", "search_chat_history", "add_monster", "get_monster", "attack_monster",
+        "record_boss_damage", "get_monster_attackers", "set_team_goal", "get_team_goal", "increment_team_kills",
+        "increment_personal_kills", "get_personal_kills", "get_total_personal_kills_last_month",
+        "get_total_personal_kills_current_month", "has_personal_monsters_this_month",
+        "clear_monthly_monsters", "get_alive_monsters", "get_monster_names",
+    )
+    # bucket 模式的分配方式記錄在分割區目錄中，之後不再改變（改變會讓伺服器找不到原本的資料）
+    BUCKET_LAYOUT_FILE = "buckets.json"
 
-# 食物推薦服務（依照台灣當前時間自動判斷餐點，並透過線上資料推薦）
-class FoodRecommendationService:
-    def __init__(self):
-        pass
+    def __init__(self, mode="guild", buckets=16, max_open=64, directory=None):
+        if mode not in ("guild", "bucket"):
+            raise ValueError(f"不支援的資料庫分割模式: {mode}")
+        self.mode = mode
+        self.buckets = buckets
+        self.max_open = max_open
+        self.directory = directory or os.path.join(os.path.dirname(DB_PATH), 'partitions')
+        os.makedirs(self.directory, exist_ok=True)
+        self.db_path = self.directory
+        self.bucket_hash = self._bucket_layout() if mode == "bucket" else None
+        self.handles = OrderedDict()  # 分割區檔名 -> DatabaseManager（LRU 順序）
+        self.opened = 0
+        self.evicted = 0
 
-    def get_food_recommendation(self, meal_type: str) -> str:
-        """
-        透過 OpenAI 線上查詢台灣常見的餐點，再從結果中選擇一個作為推薦。
-        不是寫死在程式裡的隨機菜單。
-        """
-        # 建立提示詞
-        prompt = (
-            f"你是一位非常熟悉台灣飲食文化的美食推薦專家。"
-            f"現在是台灣的{meal_type}時間，請根據台灣人常吃、實際常見的{meal_type}餐點，"
-            f"列出 5 個具體的選項，只要列出食物名稱，以頓號「、」分隔，不要加任何說明或句子。"
-            f"範例輸出格式：雞肉飯、牛肉麵、滷肉飯、水餃、便當。"
+    def _bucket_layout(self):
+        """讀取（第一次時建立）bucket 的分配方式與數量，回傳雜湊方式"""
+        path = os.path.join(self.directory, self.BUCKET_LAYOUT_FILE)
+        try:
+            with open(path, encoding="utf-8") as f:
+                layout = json.load(f)
+        except FileNotFoundError:
+            # 沒有記錄但已有 bucket 檔案：舊版以 ID 直接取餘數分配，沿用以免找不到既有資料
+            legacy = bool(glob.glob(os.path.join(self.directory, "bucket_*.db")))
+            layout = {"hash": "modulo" if legacy else "crc32", "buckets": self.buckets}
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(layout, f)
+            if legacy:
+                logger.warning("既有的 bucket 分割區沿用舊版的 ID 取餘數分配（雪花 ID 的低位元多為 0，分布不均）")
+        if layout["buckets"] != self.buckets:
+            logger.warning(f"DB_PARTITION_BUCKETS={self.buckets} 與既有分割區的 {layout['buckets']} 個不同，沿用既有的數量")
+            self.buckets = layout["buckets"]
+        return layout["hash"]
+
+    def partition_name(self, server_id):
+        """計算伺服器所屬的分割區檔名"""
+        server_id = str(server_id)
+        if self.mode == "guild":
+            return f"guild_{server_id}.db"
+        # 雪花 ID 的低位元是工作程序編號與同一毫秒內的序號，大多為 0，先雜湊再取餘數
+        if self.bucket_hash == "modulo" and server_id.isdigit():
+            key = int(server_id)
+        else:
+            key = zlib.crc32(server_id.encode())
+        return f"bucket_{key % self.buckets:03d}.db"
+
+    def _partition(self, server_id):
+        """取得（必要時開啟）分割區連接，超過上限時關閉最久未使用的連接"""
+        name = self.partition_name(server_id)
+        manager = self.handles.get(name)
+        if manager is not None:
+            self.handles.move_to_end(name)
+            return manager
+        manager = DatabaseManager(os.path.join(self.directory, name))
+        self.handles[name] = manager
+        self.opened += 1
+        while len(self.handles) > self.max_open:
+            old_name, old_manager = self.handles.popitem(last=False)
+            self._close_partition(old_name, old_manager)
+            self.evicted += 1
+        return manager
+
+    @staticmethod
+    def _close_partition(name, manager):
+        try:
+            manager.conn.commit()
+            manager.conn.close()
+            logger.debug("已關閉分割區連接: %s", name)
+        except Exception as e:
+            logger.error(f"關閉分割區 {name} 錯誤: {e}")
+
+    def partition_paths(self):
+        return sorted(glob.glob(os.path.join(self.directory, "*.db")))
+
+    def _query_all(self, sql):
+        """對所有分割區執行唯讀查詢（使用獨立連接，不影響 LRU 連接池）"""
+        for path in self.partition_paths():
+            conn = None
+            try:
+                conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5.0)
+                yield os.path.basename(path), conn.execute(sql).fetchone()
+            except Exception as e:
+                logger.error(f"查詢分割區 {os.path.basename(path)} 錯誤: {e}")
+            finally:
+                if conn:
+                    conn.close()
+
+    def global_stats(self):
+        """跨分割區統計各資料表的資料筆數"""
+        stats = defaultdict(int)
+        sql = (
+            "SELECT (SELECT COUNT(*) FROM chat_history), (SELECT COUNT(*) FROM monsters), "
+            "(SELECT COUNT(*) FROM monster_attacks), (SELECT COUNT(*) FROM personal_kills), "
+            "(SELECT COUNT(*) FROM users)"
+        )
+        for _, row in self._query_all(sql):
+            for table, count in zip(("chat_history", "monsters", "monster_attacks", "personal_kills", "users"), row):
+                stats[table] += count
+        return dict(stats)
+
+    def run_integrity_check(self):
+        """逐一檢查所有分割區，回傳 ok 或異常分割區的結果"""
+        failed = [f"{name}: {row[0]}" for name, row in self._query_all("PRAGMA integrity_check") if row[0] != "ok"]
+        return "ok" if not failed else "；".join(failed)
+
+    def format_status(self):
+        """格式化儲存狀態"""
+        stats = self.global_stats()
+        lines = [
+            "**儲存**",
+            f"模式：依伺服器分割（{'每個伺服器一個檔案' if self.mode == 'guild' else f'{self.buckets} 個雜湊分桶'}）",
+            f"分割區：{len(self.partition_paths())} 個，已開啟 {len(self.handles)}／{self.max_open}（累計開啟 {self.opened}、關閉 {self.evicted}）",
+        ]
+        lines.extend(f"{table}：{count} 筆" for table, count in stats.items())
+        return "\n".join(lines)
+
+    def compression_step(self, batch=100):
+        """對仍開啟的分割區執行一小步壓縮維護（關閉的分割區下次開啟後再重新累積）"""
+        for manager in self.handles.values():
+            if manager.compressor.has_work:
+                return manager.compression_step(batch)
+        return False
+
+    def close(self):
+        """關閉所有分割區連接"""
+        while self.handles:
+            name, manager = self.handles.popitem(last=False)
+            self._close_partition(name, manager)
+        logger.info("所有分割區連接已關閉")
+
+def _routed_method(name):
+    def method(self, server_id, *args, **kwargs):
+        return getattr(self._partition(server_id), name)(server_id, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(DatabaseManager, name).__doc__
+    return method
+
+for _method_name in PartitionedDatabaseManager.ROUTED_METHODS:
+    setattr(PartitionedDatabaseManager, _method_name, _routed_method(_method_name))
+
+def create_db_manager():
+    """依 DB_PARTITION_MODE 建立資料庫管理器（未設定時使用單一資料庫）"""
+    mode = os.getenv('DB_PARTITION_MODE', '').lower()
+    if mode:
+        return PartitionedDatabaseManager(
+            mode=mode,
+            buckets=int(os.getenv('DB_PARTITION_BUCKETS', '16')),
+            max_open=int(os.getenv('DB_MAX_OPEN_PARTITIONS', '64')),
         )
+    return DatabaseManager()
+
+# 非同步儲存層介面：方法與 DatabaseManager 相同（皆以 server_id 為第一個參數），但皆為協程
+class AsyncStorage(ABC):
+    backend = "base"
+    METHODS = PartitionedDatabaseManager.ROUTED_METHODS
+
+    @abstractmethod
+    async def global_stats(self):
+        """統計各資料表的資料筆數"""
+
+    @abstractmethod
+    async def run_integrity_check(self):
+        """執行完整性檢查，正常時回傳 ok"""
+
+    @abstractmethod
+    async def format_status(self):
+        """格式化儲存狀態"""
 
+    @abstractmethod
+    def shutdown(self):
+        """關閉儲存層（事件循環結束後呼叫）"""
+
+# SQLite 儲存層：所有查詢在專用的單一執行緒中執行，不再阻塞事件循環
+class SQLiteStorage(AsyncStorage):
+    backend = "sqlite"
+
+    MAINTENANCE_BATCH = 100  # 背景重新壓縮每次處理的記錄數
+    MAINTENANCE_PAUSE = 0.01  # 兩批之間、或有查詢進行中時，背景維護等待的秒數
+    MAINTENANCE_IDLE_DELAY = 5.0  # 沒有維護工作時，下次檢查前等待的秒數
+
+    def __init__(self, manager):
+        self.manager = manager  # DatabaseManager 或 PartitionedDatabaseManager
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self.inflight = 0  # 進行中（含排隊）的一般查詢數
+        self.maintenance = None
+
+    async def _call(self, name, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        if self.maintenance is None:
+            self.maintenance = loop.create_task(self._maintain())
+        func = getattr(self.manager, name)
+        self.inflight += 1
         try:
-            response = client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是一位熟悉台灣在地餐飲的美食顧問，只用繁體中文回答。",
-                    },
-                    {"role": "user", "content": prompt},
-                ],
+            with metrics.stage("db"):
+                # 複製 contextvars，讓資料庫執行緒中的追蹤沿用目前的指令
+                context = contextvars.copy_context()
+                return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args, **kwargs))
+        finally:
+            self.inflight -= 1
+
+    async def _maintain(self):
+        """低優先順序的背景維護（壓縮字典訓練與重新壓縮）：資料庫執行緒沒有查詢時才送出一小批，
+        一般查詢最多只需等待一批；字典訓練只需要 CPU，放在預設執行緒池"""
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.inflight:
+                await asyncio.sleep(self.MAINTENANCE_PAUSE)
+                continue
+            try:
+                step = await loop.run_in_executor(self.executor, self.manager.compression_step, self.MAINTENANCE_BATCH)
+                if isinstance(step, tuple):
+                    manager, samples = step
+                    data = await loop.run_in_executor(None, manager.compressor.build_dictionary, samples)
+                    await loop.run_in_executor(self.executor, manager.install_dictionary, data, len(samples))
+            except RuntimeError:
+                # 執行緒池已關閉（程式結束中）
+                return
+            except Exception as e:
+                logger.error(f"壓縮背景維護錯誤: {e}")
+                step = False
+            # 讓排隊中的查詢先執行，再送出下一批
+            await asyncio.sleep(self.MAINTENANCE_PAUSE if step else self.MAINTENANCE_IDLE_DELAY)
+
+    async def global_stats(self):
+        return await self._call("global_stats")
+
+    async def run_integrity_check(self):
+        # 完整性檢查使用獨立連接，放在預設執行緒池，避免佔用資料庫執行緒
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, self.manager.run_integrity_check)
+
+    async def format_status(self):
+        return await self._call("format_status")
+
+    def shutdown(self):
+        if self.maintenance is not None and not self.maintenance.done():
+            self.maintenance.cancel()
+        self.executor.shutdown(wait=True)
+        self.manager.close()
+
+def _storage_method(name):
+    async def method(self, server_id, *args, **kwargs):
+        return await self._call(name, server_id, *args, **kwargs)
+    method.__name__ = name
+    method.__doc__ = getattr(DatabaseManager, name).__doc__
+    return method
+
+for _method_name in AsyncStorage.METHODS:
+    setattr(SQLiteStorage, _method_name, _storage_method(_method_name))
+
+# PostgreSQL 儲存層：使用 asyncpg 連接池，多個機器人程序可共用怪物與擊殺狀態
+# asyncpg 會為每個連接快取預先編譯的查詢（prepared statements），重複的查詢不需再次解析
+class PostgresStorage(AsyncStorage):
+    backend = "postgres"
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id BIGINT PRIMARY KEY,
+            username TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id BIGSERIAL PRIMARY KEY,
+            server_id BIGINT,
+            user_id BIGINT,
+            message TEXT,
+            response TEXT,
+            timestamp TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_chat_history_user ON chat_history (server_id, user_id, id);
+        CREATE TABLE IF NOT EXISTS chat_turns (
+            server_id BIGINT,
+            user_id BIGINT,
+            turns BIGINT,
+            PRIMARY KEY (server_id, user_id)
+        );
+        CREATE TABLE IF NOT EXISTS monsters (
+            id BIGSERIAL PRIMARY KEY,
+            server_id BIGINT,
+            name TEXT,
+            tier TEXT,
+            appearance TEXT,
+            max_hp INTEGER,
+            current_hp INTEGER,
+            created_at TIMESTAMP,
+            is_alive INTEGER DEFAULT 1,
+            monster_type TEXT DEFAULT 'personal',
+            UNIQUE(server_id, name)
+        );
+        CREATE TABLE IF NOT EXISTS monster_attacks (
+            id BIGSERIAL PRIMARY KEY,
+            server_id BIGINT,
+            monster_id BIGINT,
+            user_id BIGINT,
+            damage INTEGER,
+            timestamp TIMESTAMP
+        );
+        CREATE INDEX IF NOT EXISTS idx_monster_attacks_monster ON monster_attacks (monster_id);
+        CREATE TABLE IF NOT EXISTS team_goals (
+            id BIGSERIAL PRIMARY KEY,
+            server_id BIGINT,
+            target_count INTEGER,
+            killed_count INTEGER DEFAULT 0,
+            month_year TEXT,
+            created_at TIMESTAMP,
+            UNIQUE(server_id, month_year)
+        );
+        CREATE TABLE IF NOT EXISTS personal_kills (
+            id BIGSERIAL PRIMARY KEY,
+            server_id BIGINT,
+            user_id BIGINT,
+            kill_count INTEGER DEFAULT 0,
+            month_year TEXT,
+            UNIQUE(server_id, user_id, month_year)
+        );
+    '''
+
+    def __init__(self, dsn, min_size=2, max_size=10):
+        if not dsn:
+            raise ValueError("使用 PostgreSQL 儲存層時需要設定 DATABASE_URL 環境變數")
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+        self._pool_lock = asyncio.Lock()
+
+    async def _get_pool(self):
+        """第一次使用時建立連接池與資料表"""
+        if self.pool is not None:
+            return self.pool
+        async with self._pool_lock:
+            if self.pool is None:
+                try:
+                    import asyncpg
+                except ImportError:
+                    raise RuntimeError("使用 PostgreSQL 儲存層需要安裝 asyncpg（pip install asyncpg）")
+                pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+                async with pool.acquire() as conn:
+                    await conn.execute(self.SCHEMA)
+                    try:
+                        # 小青!回憶 使用的三元組索引（需要 pg_trgm 擴充套件的權限）
+                        await conn.execute('''
+                            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+                            CREATE INDEX IF NOT EXISTS idx_chat_history_message_trgm ON chat_history USING gin (message gin_trgm_ops);
+                            CREATE INDEX IF NOT EXISTS idx_chat_history_response_trgm ON chat_history USING gin (response gin_trgm_ops);
+                        ''')
+                    except Exception as e:
+                        logger.warning(f"無法建立 pg_trgm 索引，小青!回憶 將使用全表掃描: {e}")
+                self.pool = pool
+                logger.info("PostgreSQL 連接池已建立")
+        return self.pool
+
+    @staticmethod
+    async def _upsert_user(conn, user_id, username):
+        """記錄用戶最新的名稱（名稱未變時不寫入）"""
+        await conn.execute('''
+            INSERT INTO users (user_id, username) VALUES ($1, $2)
+            ON CONFLICT (user_id) DO UPDATE SET username = EXCLUDED.username
+            WHERE users.username IS DISTINCT FROM EXCLUDED.username
+        ''', user_id, username)
+
+    @traced("db")
+    async def add_chat(self, server_id, user_id, username, message, response):
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    # 累計對話輪數只增不減（第一次記錄時以既有的筆數為起點）
+                    await conn.execute('''
+                        INSERT INTO chat_turns (server_id, user_id, turns)
+                        SELECT $1, $2, COUNT(*) + 1 FROM chat_history WHERE server_id = $1 AND user_id = $2
+                        ON CONFLICT (server_id, user_id) DO UPDATE SET turns = chat_turns.turns + 1
+                    ''', server_id, user_id)
+                    # 只保留該用戶最新的 59 條，加上新的一條共 60 條
+                    await conn.execute('''
+                        DELETE FROM chat_history WHERE id IN (
+                            SELECT id FROM chat_history
+                            WHERE server_id = $1 AND user_id = $2
+                            ORDER BY id DESC
+                            OFFSET 59
+                        )
+                    ''', server_id, user_id)
+                    await self._upsert_user(conn, user_id, username)
+                    await conn.execute('''
+                        INSERT INTO chat_history (server_id, user_id, message, response, timestamp)
+                        VALUES ($1, $2, $3, $4, $5)
+                    ''', server_id, user_id, message, response, datetime.now())
+            logger.debug("成功添加聊天記錄: %s", username)
+        except Exception as e:
+            logger.error(f"添加聊天記錄錯誤: {e}")
+
+    @traced("db")
+    async def get_chat_history(self, server_id, user_id=None, limit=60, block=1):
+        try:
+            pool = await self._get_pool()
+            if user_id:
+                if block > 1:
+                    total = await pool.fetchval(
+                        'SELECT turns FROM chat_turns WHERE server_id = $1 AND user_id = $2', server_id, user_id
+                    )
+                    if total is None:
+                        total = await pool.fetchval(
+                            'SELECT COUNT(*) FROM chat_history WHERE server_id = $1 AND user_id = $2', server_id, user_id
+                        )
+                    limit = DatabaseManager.aligned_limit(total, limit, block)
+                rows = await pool.fetch('''
+                    SELECT u.username, c.message, c.response
+                    FROM chat_history c
+                    LEFT JOIN users u ON u.user_id = c.user_id
+                    WHERE c.server_id = $1 AND c.user_id = $2
+                    ORDER BY c.id DESC
+                    LIMIT $3
+                ''', server_id, user_id, limit)
+            else:
+                rows = await pool.fetch('''
+                    SELECT u.username, c.message, c.response
+                    FROM chat_history c
+                    LEFT JOIN users u ON u.user_id = c.user_id
+                    WHERE c.server_id = $1
+                    ORDER BY c.id DESC
+                    LIMIT $2
+                ''', server_id, limit)
+            return [tuple(row) for row in rows]
+        except Exception as e:
+            logger.error(f"獲取聊天歷史錯誤: {e}")
+            return []
+
+    @traced("db")
+    async def search_chat_history(self, server_id, keyword, limit=5):
+        """在伺服器的對話記錄中搜尋關鍵字（有 pg_trgm 索引時可避免全表掃描）"""
+        try:
+            terms = keyword.split()
+            if not terms:
+                return []
+            pool = await self._get_pool()
+            conditions = " AND ".join(
+                f"(c.message ILIKE ${i + 2} OR c.response ILIKE ${i + 2})" for i in range(len(terms))
             )
-            text = response.choices[0].message.content.strip()
+            patterns = ["%" + re.sub(r"([%_\\])", r"\\\1", term) + "%" for term in terms]
+            if all(len(term) >= 3 for term in terms):
+                scanned, source = None, "chat_history"
+            else:
+                # pg_trgm 索引無法用於少於 3 個字的關鍵字，只逐筆比對最新的 RECALL_SCAN_ROWS 筆記錄
+                scanned = RECALL_SCAN_ROWS
+                source = f"(SELECT * FROM chat_history WHERE server_id = $1 ORDER BY id DESC LIMIT {scanned})"
+            rows = await pool.fetch(f'''
+                SELECT u.username, c.message, c.response, c.timestamp
+                FROM {source} c
+                LEFT JOIN users u ON u.user_id = c.user_id
+                WHERE c.server_id = $1 AND {conditions}
+                ORDER BY c.id DESC
+                LIMIT {int(limit)}
+            ''', server_id, *patterns)
+            return build_recall_results(rows, terms, scanned)
+        except Exception as e:
+            logger.error(f"搜尋聊天記錄錯誤: {e}")
+            return []
 
-            # 將各種分隔符統一，再拆成清單
-            normalized = (
-                text.replace("\n", "、")
-                .replace(",", "、")
-                .replace("，", "、")
+    @traced("db")
+    async def add_monster(self, server_id, name, tier, appearance, max_hp, monster_type='personal'):
+        """新增怪物到資料庫"""
+        try:
+            pool = await self._get_pool()
+            inserted = await pool.fetchval('''
+                INSERT INTO monsters (server_id, name, tier, appearance, max_hp, current_hp, created_at, is_alive, monster_type)
+                VALUES ($1, $2, $3, $4, $5, $5, $6, 1, $7)
+                ON CONFLICT (server_id, name) DO NOTHING
+                RETURNING id
+            ''', server_id, name, tier, appearance, max_hp, datetime.now(), monster_type)
+            if inserted is None:
+                logger.info(f"怪物已存在: {name}")
+                return False
+            logger.info(f"成功新增怪物: {name}")
+            return True
+        except Exception as e:
+            logger.error(f"新增怪物錯誤: {e}")
+            return False
+
+    @traced("db")
+    async def get_monster(self, server_id, name):
+        """獲取怪物資料"""
+        try:
+            pool = await self._get_pool()
+            row = await pool.fetchrow('''
+                SELECT name, tier, appearance, max_hp, current_hp, is_alive
+                FROM monsters
+                WHERE server_id = $1 AND name = $2
+            ''', server_id, name)
+            return tuple(row) if row else None
+        except Exception as e:
+            logger.error(f"獲取怪物資料錯誤: {e}")
+            return None
+
+    @traced("db")
+    async def attack_monster(self, server_id, monster_name, user_id, username, damage):
+        """攻擊怪物並記錄（以單一 UPDATE 扣血，多個程序同時攻擊時擊殺只會發生一次）"""
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    row = await conn.fetchrow('''
+                        UPDATE monsters
+                        SET current_hp = GREATEST(0, current_hp - $3),
+                            is_alive = CASE WHEN current_hp - $3 > 0 THEN 1 ELSE 0 END
+                        WHERE server_id = $1 AND name = $2 AND is_alive = 1
+                        RETURNING id, current_hp
+                    ''', server_id, monster_name, damage)
+                    if row is None:
+                        exists = await conn.fetchval(
+                            'SELECT 1 FROM monsters WHERE server_id = $1 AND name = $2', server_id, monster_name
+                        )
+                        return None, "怪物已經被擊敗了" if exists else "怪物不存在"
+                    monster_id, new_hp = row
+                    await self._upsert_user(conn, user_id, username)
+                    await conn.execute('''
+                        INSERT INTO monster_attacks (server_id, monster_id, user_id, damage, timestamp)
+                        VALUES ($1, $2, $3, $4, $5)
+                    ''', server_id, monster_id, user_id, damage, datetime.now())
+            return new_hp, None
+        except Exception as e:
+            logger.error(f"攻擊怪物錯誤: {e}")
+            return None, str(e)
+
+    @traced("db")
+    async def record_boss_damage(self, server_id, monster_name, damage, attacks):
+        """寫入世界王一次合併的總傷害與各用戶傷害（資料庫錯誤會直接拋出，由呼叫端重試）"""
+        pool = await self._get_pool()
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                row = await conn.fetchrow('''
+                    UPDATE monsters
+                    SET current_hp = GREATEST(0, current_hp - $3),
+                        is_alive = CASE WHEN current_hp - $3 > 0 THEN 1 ELSE 0 END
+                    WHERE server_id = $1 AND name = $2 AND is_alive = 1
+                    RETURNING id, current_hp
+                ''', server_id, monster_name, damage)
+                if row is None:
+                    exists = await conn.fetchval(
+                        'SELECT 1 FROM monsters WHERE server_id = $1 AND name = $2', server_id, monster_name
+                    )
+                    return None, "怪物已經被擊敗了" if exists else "怪物不存在"
+                monster_id, new_hp = row
+                now = datetime.now()
+                for user_id, username, _ in attacks:
+                    await self._upsert_user(conn, user_id, username)
+                await conn.executemany('''
+                    INSERT INTO monster_attacks (server_id, monster_id, user_id, damage, timestamp)
+                    VALUES ($1, $2, $3, $4, $5)
+                ''', [(server_id, monster_id, user_id, user_damage, now) for user_id, _, user_damage in attacks])
+        return new_hp, None
+
+    @traced("db")
+    async def get_monster_attackers(self, server_id, monster_name):
+        """獲取攻擊過怪物的所有用戶"""
+        try:
+            pool = await self._get_pool()
+            rows = await pool.fetch('''
+                SELECT DISTINCT a.user_id, u.username
+                FROM monsters m
+                JOIN monster_attacks a ON a.monster_id = m.id
+                LEFT JOIN users u ON u.user_id = a.user_id
+                WHERE m.server_id = $1 AND m.name = $2
+            ''', server_id, monster_name)
+            return [tuple(row) for row in rows]
+        except Exception as e:
+            logger.error(f"獲取攻擊者列表錯誤: {e}")
+            return []
+
+    @traced("db")
+    async def set_team_goal(self, server_id, target_count, month_year):
+        """設置團隊目標"""
+        try:
+            pool = await self._get_pool()
+            await pool.execute('''
+                INSERT INTO team_goals (server_id, target_count, killed_count, month_year, created_at)
+                VALUES ($1, $2, 0, $3, $4)
+                ON CONFLICT (server_id, month_year) DO UPDATE
+                SET target_count = EXCLUDED.target_count, killed_count = 0, created_at = EXCLUDED.created_at
+            ''', server_id, target_count, month_year, datetime.now())
+            return True
+        except Exception as e:
+            logger.error(f"設置團隊目標錯誤: {e}")
+            return False
+
+    @traced("db")
+    async def get_team_goal(self, server_id, month_year):
+        """獲取團隊目標"""
+        try:
+            pool = await self._get_pool()
+            row = await pool.fetchrow('''
+                SELECT target_count, killed_count
+                FROM team_goals
+                WHERE server_id = $1 AND month_year = $2
+            ''', server_id, month_year)
+            if row:
+                return row[0], row[1]
+            return None, None
+        except Exception as e:
+            logger.error(f"獲取團隊目標錯誤: {e}")
+            return None, None
+
+    @traced("db")
+    async def increment_team_kills(self, server_id, month_year):
+        """增加團隊擊殺數"""
+        try:
+            pool = await self._get_pool()
+            await pool.execute('''
+                UPDATE team_goals
+                SET killed_count = killed_count + 1
+                WHERE server_id = $1 AND month_year = $2
+            ''', server_id, month_year)
+            return True
+        except Exception as e:
+            logger.error(f"增加團隊擊殺數錯誤: {e}")
+            return False
+
+    @traced("db")
+    async def increment_personal_kills(self, server_id, user_id, username, month_year):
+        """增加個人擊殺數"""
+        try:
+            pool = await self._get_pool()
+            async with pool.acquire() as conn:
+                async with conn.transaction():
+                    await self._upsert_user(conn, user_id, username)
+                    await conn.execute('''
+                        INSERT INTO personal_kills (server_id, user_id, kill_count, month_year)
+                        VALUES ($1, $2, 1, $3)
+                        ON CONFLICT (server_id, user_id, month_year) DO UPDATE
+                        SET kill_count = personal_kills.kill_count + 1
+                    ''', server_id, user_id, month_year)
+            return True
+        except Exception as e:
+            logger.error(f"增加個人擊殺數錯誤: {e}")
+            return False
+
+    @traced("db")
+    async def get_personal_kills(self, server_id, user_id, month_year):
+        """獲取個人擊殺數"""
+        try:
+            pool = await self._get_pool()
+            result = await pool.fetchval('''
+                SELECT kill_count FROM personal_kills
+                WHERE server_id = $1 AND user_id = $2 AND month_year = $3
+            ''', server_id, user_id, month_year)
+            return result or 0
+        except Exception as e:
+            logger.error(f"獲取個人擊殺數錯誤: {e}")
+            return 0
+
+    async def _sum_kills(self, server_id, month_year):
+        pool = await self._get_pool()
+        return await pool.fetchval('''
+            SELECT COALESCE(SUM(kill_count), 0) FROM personal_kills
+            WHERE server_id = $1 AND month_year = $2
+        ''', server_id, month_year)
+
+    @traced("db")
+    async def get_total_personal_kills_last_month(self, server_id, last_month_year):
+        """獲取上個月的所有玩家個人總擊殺數量"""
+        try:
+            return await self._sum_kills(server_id, last_month_year)
+        except Exception as e:
+            logger.error(f"獲取上個月個人總擊殺數錯誤: {e}")
+            return 0
+
+    @traced("db")
+    async def get_total_personal_kills_current_month(self, server_id, current_month_year):
+        """獲取這個月的所有玩家個人總擊殺數量"""
+        try:
+            return await self._sum_kills(server_id, current_month_year)
+        except Exception as e:
+            logger.error(f"獲取這個月個人總擊殺數錯誤: {e}")
+            return 0
+
+    @traced("db")
+    async def has_personal_monsters_this_month(self, server_id, current_month_year):
+        """檢查當前月份是否已有個人怪物"""
+        try:
+            pool = await self._get_pool()
+            count = await pool.fetchval('''
+                SELECT COUNT(*) FROM monsters
+                WHERE server_id = $1 AND monster_type = 'personal'
+                AND to_char(created_at, 'YYYY-MM') = $2
+            ''', server_id, current_month_year)
+            return count > 0
+        except Exception as e:
+            logger.error(f"檢查本月個人怪物錯誤: {e}")
+            return False
+
+    @traced("db")
+    async def clear_monthly_monsters(self, server_id, month_year):
+        """清空指定月份的未擊殺怪物"""
+        try:
+            pool = await self._get_pool()
+            await pool.execute('''
+                DELETE FROM monsters
+                WHERE server_id = $1 AND is_alive = 1 AND monster_type = 'personal'
+                AND to_char(created_at, 'YYYY-MM') = $2
+            ''', server_id, month_year)
+            return True
+        except Exception as e:
+            logger.error(f"清空月度怪物錯誤: {e}")
+            return False
+
+    @traced("db")
+    async def get_alive_monsters(self, server_id):
+        """列出伺服器中仍存活的怪物名稱"""
+        try:
+            pool = await self._get_pool()
+            rows = await pool.fetch(
+                'SELECT name FROM monsters WHERE server_id = $1 AND is_alive = 1 ORDER BY id', server_id
             )
-            raw_items = [s for s in normalized.split("、") if s.strip()]
+            return [row[0] for row in rows]
+        except Exception as e:
+            logger.error(f"獲取存活怪物列表錯誤: {e}")
+            return []
 
-            foods = [
-                s.strip(" 　-•*0123456789.、。")
-                for s in raw_items
-                if s.strip(" 　-•*0123456789.、。")
-            ]
+    @traced("db")
+    async def get_monster_names(self, server_id, limit=500):
+        """列出伺服器過去生成過的怪物名稱（最新的在前）"""
+        try:
+            pool = await self._get_pool()
+            rows = await pool.fetch(
+                'SELECT name FROM monsters WHERE server_id = $1 ORDER BY id DESC LIMIT $2', server_id, limit
+            )
+            return [row[0] for row in rows]
+        except Exception as e:
+            logger.error(f"獲取怪物名稱錯誤: {e}")
+            return []
 
-            if foods:
-                return foods[0]
+    async def global_stats(self):
+        stats = {}
+        pool = await self._get_pool()
+        for table in ("chat_history", "monsters", "monster_attacks", "personal_kills", "users"):
+            try:
+                stats[table] = await pool.fetchval(f"SELECT COUNT(*) FROM {table}")
+            except Exception as e:
+                logger.error(f"統計資料表 {table} 錯誤: {e}")
+        return stats
+
+    async def run_integrity_check(self):
+        try:
+            pool = await self._get_pool()
+            await pool.fetchval("SELECT 1")
+            return "ok"
         except Exception as e:
-            print(f"線上食物推薦查詢失敗: {e}")
-
-        # 後備：依餐別給一個泛用建議，避免整個功能壞掉
-        fallback = {
-            "早餐": "簡單的早餐店套餐",
-            "午餐": "附近的便當或簡餐",
-            "晚餐": "一份熱騰騰的家常菜",
-            "點心": "一點輕鬆的小點心",
-        }
-        return fallback.get(meal_type, "隨便吃點喜歡的就好")
+            return f"無法連接 PostgreSQL: {e}"
 
-# 創建食物推薦服務實例
-food_service = FoodRecommendationService()
+    async def format_status(self):
+        stats = await self.global_stats()
+        lines = ["**儲存**", "模式：PostgreSQL"]
+        if self.pool is not None:
+            lines.append(f"連接池：{self.pool.get_size()} 個連接（閒置 {self.pool.get_idle_size()}）")
+        lines.extend(f"{table}：{count} 筆" for table, count in stats.items())
+        return "\n".join(lines)
 
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.terminate()
 
-# 塔羅牌服務
+def create_storage():
+    """依 STORAGE_BACKEND 建立儲存層（sqlite 或 postgres，預設 sqlite）"""
+    backend = os.getenv('STORAGE_BACKEND', 'sqlite').lower()
+    if backend == 'postgres':
+        return PostgresStorage(
+            os.getenv('DATABASE_URL'),
+            min_size=int(os.getenv('DB_POOL_MIN_SIZE', '2')),
+            max_size=int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+        )
+    if backend != 'sqlite':
+        raise ValueError(f"不支援的儲存層: {backend}")
+    return SQLiteStorage(create_db_manager())
+
+# 創建儲存層實例
+storage = create_storage()
+
+# 本機雜湊嵌入：以字元 2～3-gram 的特徵雜湊產生固定維度向量，不需要下載模型或呼叫 API
+# （中文單字太常見，加入後相似度容易被「的」「我」等字主導）
+class HashingEmbedder:
+    name = "local"
+    use_idf = True  # 稀疏特徵：查詢時依用戶記錄的文件頻率加權，降低「什麼」等常見詞的影響
+
+    def __init__(self, dim=1024):
+        self.dim = dim
+        self.tag = f"local-{dim}"  # 長期記憶向量檔的名稱依嵌入方式與維度區分
+
+    def _features(self, text):
+        text = re.sub(r"\s+", " ", (text or "").lower())
+        for n in (2, 3):
+            for i in range(len(text) - n + 1):
+                gram = text[i:i + n]
+                if gram.strip():
+                    yield zlib.crc32(gram.encode("utf-8"))
+
+    def embed(self, texts):
+        """回傳 (len(texts), dim) 的 float32 矩陣（已正規化）"""
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            hashes = np.fromiter(self._features(text), dtype=np.uint32)
+            if hashes.size:
+                # 雜湊的最高位元決定正負號，減少碰撞造成的偏差
+                signs = np.where(hashes >> 31, -1.0, 1.0).astype(np.float32)
+                np.add.at(vectors[row], hashes % self.dim, signs)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-6)
+
+# OpenAI 嵌入 API（結果快取在本機 SQLite，同樣的文字只呼叫一次）
+class OpenAIEmbedder:
+    name = "openai"
+    use_idf = False
+
+    def __init__(self, cache_path, model="text-embedding-3-small", dim=256):
+        self.model = model
+        self.dim = dim
+        self.tag = f"openai-{model}-{dim}"
+        self.cache = sqlite3.connect(cache_path, check_same_thread=False)
+        self.cache.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB)")
+        self.cache.commit()
+
+    def _key(self, text):
+        return hashlib.sha1(f"{self.model}:{self.dim}:{text}".encode("utf-8")).hexdigest()
+
+    def embed(self, texts):
+        keys = [self._key(text) for text in texts]
+        cached = {}
+        for key in set(keys):
+            row = self.cache.execute("SELECT vector FROM embeddings WHERE key = ?", (key,)).fetchone()
+            if row:
+                cached[key] = np.frombuffer(row[0], dtype=np.float32)
+        missing = [(key, text) for key, text in zip(keys, texts) if key not in cached]
+        for key in keys:
+            metrics.record_cache("embedding", key in cached)
+        if missing:
+            with breakers.get("embeddings", self.model).call(), metrics.stage("llm"):
+                response = client.embeddings.create(
+                    model=self.model, input=[text or " " for _, text in missing], dimensions=self.dim
+                )
+            for (key, _), item in zip(missing, response.data):
+                vector = np.asarray(item.embedding, dtype=np.float32)
+                vector /= max(float(np.linalg.norm(vector)), 1e-6)
+                cached[key] = vector
+                self.cache.execute("INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)", (key, vector.tobytes()))
+            self.cache.commit()
+        return np.stack([cached[key] for key in keys])
+
+    def close(self):
+        self.cache.close()
+
+# 長期記憶：每位用戶一組檔案（向量矩陣 .vec、文字 .jsonl 與其位移 .off），向量以 memmap 讀取
+# 聊天時除了最近幾輪對話，再加上與目前訊息最相關的較舊對話
+class VectorMemory:
+    MIN_SCORE = 0.1  # 相似度低於此值的舊對話不放入提示
+    REBUILD_BATCH = 256  # 重新建立向量時每次嵌入的輪數
+
+    def __init__(self, embedder, directory, recent_turns=10, top_k=5, max_open=256):
+        self.embedder = embedder
+        self.directory = directory
+        self.recent_turns = recent_turns
+        self.top_k = top_k
+        self.max_open = max_open
+        self.maps = OrderedDict()  # 用戶 -> (列數, memmap, 各維度的文件頻率)（LRU 順序）
+        self.checked = set()  # 本次啟動已檢查過檔案完整性的用戶
+        self.backfilled = set()  # 本次啟動已確認有長期記憶（或已從聊天記錄匯入）的用戶
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+        self.remembered = 0
+        self.recalled = 0
+        self.imported = 0
+        self.repaired = 0
+        self.rebuilt = 0
+        if embedder:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.embedder is not None
+
+    def _paths(self, server_id, user_id):
+        """向量檔名包含嵌入方式與維度（切換嵌入方式時不會誤用或截掉其他方式的向量）；文字與位移與嵌入方式無關"""
+        base = os.path.join(self.directory, f"{server_id}_{user_id}")
+        return f"{base}.{self.embedder.tag}.vec", base + ".jsonl", base + ".off"
+
+    def _repair(self, server_id, user_id):
+        """寫入途中中斷時檔案的長度會不一致：文字以完整的列為準，截掉不完整的尾端；
+        向量比文字少時（最後寫入向量前中斷，或剛切換嵌入方式）依文字重新建立缺少的向量"""
+        row_bytes = self.embedder.dim * 4
+        vec_path, text_path, offset_path = self._paths(server_id, user_id)
+        sizes = [os.path.getsize(path) if os.path.exists(path) else 0 for path in (vec_path, text_path, offset_path)]
+        vec_size, text_size, offset_size = sizes
+        rows = offset_size // 8
+        text_end = 0
+        if rows:
+            with open(offset_path, "rb") as offset_file, open(text_path, "rb") as text_file:
+                while rows:
+                    # 最後一列的文字必須完整（以換行結尾），否則連同這一列一起捨棄
+                    offset_file.seek((rows - 1) * 8)
+                    text_file.seek(struct.unpack("<Q", offset_file.read(8))[0])
+                    if text_file.readline().endswith(b"\n"):
+                        text_end = text_file.tell()
+                        break
+                    rows -= 1
+        vectors = min(vec_size // row_bytes, rows)
+        expected = (vectors * row_bytes, text_end, rows * 8)
+        truncated = False
+        for path, size, keep in zip((vec_path, text_path, offset_path), sizes, expected):
+            if size > keep:
+                with open(path, "r+b") as f:
+                    f.truncate(keep)
+                truncated = True
+        if truncated or 0 < vectors < rows:
+            self.repaired += 1
+            logger.warning(f"長期記憶檔案不完整，已修復：伺服器 {server_id} 用戶 {user_id}（保留 {rows} 輪）")
+        if vectors < rows:
+            self._rebuild(server_id, user_id, vectors, rows)
+            logger.info(f"已以 {self.embedder.tag} 重新建立長期記憶向量：伺服器 {server_id} 用戶 {user_id}（{rows - vectors} 輪）")
+
+    def _rebuild(self, server_id, user_id, start, stop):
+        """以目前的嵌入方式，為第 start～stop 輪的文字重新建立向量（分批嵌入並寫入向量檔）"""
+        vec_path, text_path, offset_path = self._paths(server_id, user_id)
+        with open(offset_path, "rb") as offset_file:
+            offset_file.seek(start * 8)
+            first = struct.unpack("<Q", offset_file.read(8))[0]
+        with open(text_path, "rb") as text_file, open(vec_path, "ab") as vec_file:
+            text_file.seek(first)
+            for batch_start in range(start, stop, self.REBUILD_BATCH):
+                count = min(self.REBUILD_BATCH, stop - batch_start)
+                messages = [json.loads(text_file.readline())["message"] for _ in range(count)]
+                vec_file.write(self.embedder.embed(messages).astype(np.float32).tobytes())
+                vec_file.flush()
+        self.rebuilt += stop - start
+
+    def _rows(self, server_id, user_id):
+        """用戶已記錄的對話輪數（每次啟動後第一次讀寫前先修復不完整的檔案）"""
+        key = (server_id, user_id)
+        if key not in self.checked:
+            self._repair(server_id, user_id)
+            self.checked.add(key)
+        vec_path = self._paths(server_id, user_id)[0]
+        return os.path.getsize(vec_path) // (self.embedder.dim * 4) if os.path.exists(vec_path) else 0
+
+    def _matrix(self, server_id, user_id):
+        """取得用戶的向量矩陣（memmap，檔案變大時重新映射）與各維度的文件頻率"""
+        key = (server_id, user_id)
+        vec_path = self._paths(server_id, user_id)[0]
+        rows = self._rows(server_id, user_id)
+        cached = self.maps.get(key)
+        if cached and cached[0] == rows:
+            self.maps.move_to_end(key)
+            return cached[1], cached[2]
+        if rows == 0:
+            return None, None
+        matrix = np.memmap(vec_path, dtype=np.float32, mode="r", shape=(rows, self.embedder.dim))
+        # 文件頻率只需計算新增的列
+        known_rows, df = (cached[0], cached[2]) if cached else (0, np.zeros(self.embedder.dim, dtype=np.int64))
+        df = df + np.count_nonzero(matrix[known_rows:], axis=0)
+        self.maps[key] = (rows, matrix, df)
+        self.maps.move_to_end(key)
+        while len(self.maps) > self.max_open:
+            self.maps.popitem(last=False)
+        return matrix, df
+
+    def _append(self, server_id, user_id, turns):
+        """把 (用戶名稱, 訊息, 回應) 依序加到用戶的檔案"""
+        # 以用戶的訊息建立向量（用戶提到的事情才是之後要回想的內容）
+        vectors = self.embedder.embed([message for _, message, _ in turns])
+        self._rows(server_id, user_id)
+        vec_path, text_path, offset_path = self._paths(server_id, user_id)
+        offsets = []
+        with open(text_path, "ab") as text_file:
+            for username, message, response in turns:
+                offsets.append(text_file.tell())
+                line = json.dumps({"username": username, "message": message, "response": response}, ensure_ascii=False)
+                text_file.write(line.encode("utf-8") + b"\n")
+        with open(offset_path, "ab") as offset_file:
+            offset_file.write(struct.pack(f"<{len(offsets)}Q", *offsets))
+        # 最後寫入向量：向量檔的列數決定可搜尋的範圍；寫到一半中斷時，下次啟動由 _repair 截掉不完整的列並補上缺少的向量
+        with open(vec_path, "ab") as vec_file:
+            vec_file.write(vectors.astype(np.float32).tobytes())
+
+    def _remember(self, server_id, user_id, username, message, response):
+        self._append(server_id, user_id, [(username, message, response)])
+        self.remembered += 1
+
+    def _import(self, server_id, user_id, turns):
+        """用戶沒有任何長期記憶時匯入較早的對話（已有記錄時略過，避免重複匯入）"""
+        if not turns or self._rows(server_id, user_id):
+            return
+        self._append(server_id, user_id, turns)
+        self.imported += len(turns)
+
+    def _recall(self, server_id, user_id, query):
+        matrix, df = self._matrix(server_id, user_id)
+        if matrix is None:
+            return []
+        # 最近幾輪已直接放入對話，只在較舊的記錄中搜尋
+        candidates = matrix.shape[0] - self.recent_turns
+        if candidates <= 0:
+            return []
+        query_vector = self.embedder.embed([query])[0]
+        if self.embedder.use_idf:
+            query_vector = query_vector * np.log((matrix.shape[0] + 1) / (df + 1)).astype(np.float32)
+            query_vector /= max(float(np.linalg.norm(query_vector)), 1e-6)
+        scores = np.asarray(matrix[:candidates] @ query_vector)
+        k = min(self.top_k, candidates)
+        top = np.argpartition(-scores, k - 1)[:k]
+        # 依時間先後排列，讓模型看到的對話順序自然
+        top = sorted(int(i) for i in top if scores[i] >= self.MIN_SCORE)
+        _, text_path, offset_path = self._paths(server_id, user_id)
+        turns = []
+        with open(offset_path, "rb") as offset_file, open(text_path, "rb") as text_file:
+            for index in top:
+                offset_file.seek(index * 8)
+                text_file.seek(struct.unpack("<Q", offset_file.read(8))[0])
+                turn = json.loads(text_file.readline())
+                turns.append((turn["username"], turn["message"], turn["response"]))
+        self.recalled += len(turns)
+        return turns
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        with metrics.stage("memory"):
+            context = contextvars.copy_context()
+            return await loop.run_in_executor(self.executor, functools.partial(context.run, func, *args))
+
+    async def backfill(self, server_id, user_id):
+        """用戶還沒有長期記憶時，從聊天記錄匯入較早的對話（啟用長期記憶前的對話也能被取回）"""
+        key = (server_id, user_id)
+        if not self.enabled or key in self.backfilled:
+            return
+        try:
+            if not await self._run(self._rows, server_id, user_id):
+                history = await storage.get_chat_history(server_id, user_id)
+                # 聊天記錄由新到舊，依時間先後寫入
+                await self._run(self._import, server_id, user_id, list(history)[::-1])
+            self.backfilled.add(key)
+        except Exception as e:
+            logger.error(f"匯入長期記憶錯誤: {e}")
+
+    async def remember(self, server_id, user_id, username, message, response):
+        """把一輪對話加入用戶的長期記憶"""
+        if not self.enabled:
+            return
+        try:
+            await self._run(self._remember, server_id, user_id, username, message, response)
+        except Exception as e:
+            logger.error(f"寫入長期記憶錯誤: {e}")
+
+    async def recall(self, server_id, user_id, query):
+        """找出與目前訊息最相關的較舊對話，回傳 (用戶名稱, 訊息, 回應)"""
+        if not self.enabled:
+            return []
+        try:
+            return await self._run(self._recall, server_id, user_id, query)
+        except Exception as e:
+            logger.error(f"讀取長期記憶錯誤: {e}")
+            return []
+
+    def format_status(self):
+        if not self.enabled:
+            return "長期記憶：關閉"
+        return (
+            f"長期記憶：{self.embedder.name} 嵌入（{self.embedder.dim} 維），"
+            f"已映射 {len(self.maps)} 位用戶，本次寫入 {self.remembered} 輪、取回 {self.recalled} 輪、"
+            f"從聊天記錄匯入 {self.imported} 輪、修復 {self.repaired} 位用戶的檔案（重新建立 {self.rebuilt} 輪的向量）"
+        )
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        if isinstance(self.embedder, OpenAIEmbedder):
+            self.embedder.close()
+
+def create_memory():
+    """依 MEMORY_EMBEDDER 建立長期記憶（local、openai 或 off；需要 numpy）"""
+    mode = os.getenv('MEMORY_EMBEDDER', 'local').lower()
+    directory = os.getenv('MEMORY_DIR') or os.path.join(os.path.dirname(DB_PATH), 'memory')
+    embedder = None
+    if mode != 'off' and np is None:
+        logger.warning("未安裝 numpy，長期記憶功能已停用")
+    elif mode == 'local':
+        embedder = HashingEmbedder()
+    elif mode == 'openai':
+        os.makedirs(directory, exist_ok=True)
+        embedder = OpenAIEmbedder(os.path.join(directory, 'embedding_cache.db'))
+    elif mode != 'off':
+        raise ValueError(f"不支援的嵌入方式: {mode}")
+    return VectorMemory(
+        embedder,
+        directory,
+        recent_turns=int(os.getenv('MEMORY_RECENT_TURNS', '10')),
+        top_k=int(os.getenv('MEMORY_TOP_K', '5')),
+    )
+
+# 創建長期記憶實例
+chat_memory = create_memory()
+
+# 背景工作：執行時的回覆頻道與佔位訊息
+class JobAuthor:
+    """從工作內容還原的用戶（重新啟動後沒有原本的 Member 物件）"""
+    __slots__ = ("id", "name")
+
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
+class Job:
+    __slots__ = ("id", "kind", "payload", "channel", "placeholder", "author")
+
+    def __init__(self, job_id, kind, payload, channel, placeholder):
+        self.id = job_id
+        self.kind = kind
+        self.payload = payload
+        self.channel = channel
+        self.placeholder = placeholder
+        self.author = JobAuthor(payload["author_id"], payload["author_name"])
+
+    async def update(self, content):
+        """編輯佔位訊息；無法編輯（例如已被刪除）時改發新訊息"""
+        if self.placeholder is not None:
+            try:
+                return await edit_message(self.placeholder, content)
+            except discord.HTTPException as e:
+                logger.warning(f"無法編輯工作 {self.id} 的佔位訊息: {e}")
+        self.placeholder = await send_message(self.channel, content)
+
+    async def remove_placeholder(self):
+        if self.placeholder is not None:
+            try:
+                await self.placeholder.delete()
+            except discord.HTTPException:
+                pass
+
+# 背景工作佇列：繪圖與故事先寫入 SQLite，再由各類型固定數量的工作協程依優先順序執行
+# 生成呼叫在各類型專用的執行緒池中進行，不與聊天回覆搶事件循環；重新啟動後會接續未完成的工作
+class JobQueue:
+    MAX_ATTEMPTS = 3
+    POSITION_UPDATES = 10  # 只更新排在最前面的佔位訊息，避免大量編輯觸發速率限制
+    POSITION_INTERVAL = 2.0  # 同一類型兩次更新排隊位置的最短間隔（秒），期間的變動合併成一次
+    INTERACTION_TTL = 14 * 60  # 斜線指令的 followup 只在 15 分鐘內有效
+    RETENTION_DAYS = 7
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            priority INTEGER NOT NULL DEFAULT 0,
+            status TEXT NOT NULL DEFAULT 'queued',
+            payload TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL
+        );
+        CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs (kind, status, priority, id);
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue")
+        self.handlers = {}  # 類型 -> (處理協程, 同時執行數)
+        self.pools = {}  # 類型 -> 生成用執行緒池
+        self.wakeups = {}  # 類型 -> asyncio.Event
+        self.live = {}  # 工作 ID -> (頻道, 佔位訊息, 加入時間, 狀態文字)（本次啟動後加入的工作）
+        self.positions = {}  # 工作 ID -> 佔位訊息上顯示的排隊位置
+        self.refreshing = {}  # 類型 -> 更新排隊位置的協程執行期間是否又有變動
+        self.running = defaultdict(int)
+        self.finished = defaultdict(int)  # (類型, 狀態) -> 本次啟動後結束的工作數
+        self.pending = 0  # 本次啟動後加入、尚未結束的工作數
+        self.idle = None
+        self.tasks = []
+        self.started = False
+        self.resumed = 0
+
+    def register(self, kind, handler, concurrency, threads=None):
+        """註冊工作類型：handler(job) 為協程，concurrency 為同時執行數，threads 為生成用執行緒數（預設同 concurrency）"""
+        self.handlers[kind] = (handler, concurrency)
+        self.pools[kind] = ThreadPoolExecutor(max_workers=threads or concurrency, thread_name_prefix=f"job-{kind}")
+
+    # 以下同步方法都在佇列的專用執行緒中執行
+    def _open(self):
+        """開啟資料庫，把上次結束時仍在執行的工作重新排隊，回傳待執行的工作數"""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(self.SCHEMA)
+        now = time.time()
+        self.conn.execute(
+            "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND attempts < ?", (self.MAX_ATTEMPTS,)
+        )
+        self.conn.execute(
+            "UPDATE jobs SET status = 'failed', error = '重試次數過多', finished_at = ? WHERE status = 'running'", (now,)
+        )
+        self.conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (now - self.RETENTION_DAYS * 86400,)
+        )
+        self.conn.commit()
+        return self.conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+    def _insert(self, kind, priority, payload):
+        cursor = self.conn.execute(
+            "INSERT INTO jobs (kind, priority, payload, created_at) VALUES (?, ?, ?, ?)",
+            (kind, priority, json.dumps(payload, ensure_ascii=False), time.time()),
+        )
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def _claim(self, kind):
+        row = self.conn.execute(
+            "SELECT id, payload FROM jobs WHERE kind = ? AND status = 'queued' ORDER BY priority, id LIMIT 1", (kind,)
+        ).fetchone()
+        if row is None:
+            return None
+        self.conn.execute(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, started_at = ? WHERE id = ?", (time.time(), row[0])
+        )
+        self.conn.commit()
+        return row[0], json.loads(row[1])
+
+    def _finish(self, job_id, status, error):
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?", (status, error, time.time(), job_id)
+        )
+        self.conn.commit()
+
+    def _queued(self, kind, limit):
+        return [row[0] for row in self.conn.execute(
+            "SELECT id FROM jobs WHERE kind = ? AND status = 'queued' ORDER BY priority, id LIMIT ?", (kind, limit)
+        )]
+
+    def _counts(self):
+        return self.conn.execute("SELECT kind, status, COUNT(*) FROM jobs GROUP BY kind, status").fetchall()
+
+    async def _call(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(func, *args))
+
+    async def run_blocking(self, kind, func, *args, **kwargs):
+        """在該類型的執行緒池中執行阻塞的生成呼叫（沿用目前的追蹤）"""
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self.pools[kind], functools.partial(context.run, func, *args, **kwargs))
+
+    async def start(self):
+        """開啟佇列並啟動各類型的工作協程（重複呼叫不會重複啟動）"""
+        if self.started:
+            return
+        self.started = True
+        loop = asyncio.get_running_loop()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # 先送出開啟資料庫的呼叫，工作協程的領取會在它之後執行
+        opened = loop.run_in_executor(self.executor, self._open)
+        for kind, (_, concurrency) in self.handlers.items():
+            self.wakeups[kind] = asyncio.Event()
+            for _ in range(concurrency):
+                self.tasks.append(loop.create_task(self._worker(kind)))
+        self.resumed = await opened
+        if self.resumed:
+            logger.info(f"工作佇列中有 {self.resumed} 個未完成的工作，將接續執行")
+
+    async def enqueue(self, kind, payload, priority=0, channel=None, placeholder=None):
+        """加入工作（priority 越小越先執行）；channel 與 placeholder 用於本次啟動期間的回覆與排隊位置"""
+        await self.start()
+        job_id = await self._call(self._insert, kind, priority, payload)
+        self.live[job_id] = (channel, placeholder, time.monotonic(), payload.get("status_text"))
+        self.pending += 1
+        self.idle.clear()
+        self.wakeups[kind].set()
+        self._refresh_positions(kind)
+        return job_id
+
+    async def join(self):
+        """等待本次啟動後加入的工作全部結束"""
+        if self.idle is not None:
+            await self.idle.wait()
+
+    def _refresh_positions(self, kind):
+        """排隊有變動時呼叫：同一類型只有一個更新協程，每 POSITION_INTERVAL 秒最多更新一次"""
+        if kind in self.refreshing:
+            self.refreshing[kind] = True
+            return
+        self.refreshing[kind] = False
+        asyncio.get_running_loop().create_task(self._refresh_loop(kind))
+
+    async def _refresh_loop(self, kind):
+        try:
+            while True:
+                await self._update_positions(kind)
+                await asyncio.sleep(self.POSITION_INTERVAL)
+                if not self.refreshing[kind]:
+                    break
+                self.refreshing[kind] = False
+        finally:
+            del self.refreshing[kind]
+
+    async def _update_positions(self, kind):
+        """把排隊位置編輯到前幾個工作的佔位訊息上（只在位置改變時編輯）"""
+        try:
+            queued = await self._call(self._queued, kind, self.POSITION_UPDATES)
+        except Exception as e:
+            logger.error(f"讀取排隊位置錯誤: {e}")
+            return
+        for position, job_id in enumerate(queued, 1):
+            channel, placeholder, _, status_text = self.live.get(job_id, (None, None, None, None))
+            if placeholder is None or not status_text or self.positions.get(job_id) == position:
+                continue
+            self.positions[job_id] = position
+            try:
+                await edit_message(placeholder, f"{status_text}（排隊中：第 {position} 位）")
+            except discord.HTTPException as e:
+                logger.warning(f"更新排隊位置失敗: {e}")
+
+    async def _prepare(self, job_id, kind, payload):
+        """取得回覆用的頻道與佔位訊息（重新啟動後或斜線指令的 followup 逾時時改用頻道本身）"""
+        channel, placeholder, queued_at, _ = self.live.get(job_id, (None, None, None, None))
+        if channel is None or (isinstance(channel, InteractionChannel) and time.monotonic() - queued_at > self.INTERACTION_TTL):
+            channel = bot.get_channel(payload["channel_id"]) or await bot.fetch_channel(payload["channel_id"])
+            placeholder = channel.get_partial_message(payload["placeholder_id"]) if payload.get("placeholder_id") else None
+        return Job(job_id, kind, payload, channel, placeholder)
+
+    async def _worker(self, kind):
+        handler = self.handlers[kind][0]
+        wakeup = self.wakeups[kind]
+        while True:
+            wakeup.clear()
+            try:
+                claimed = await self._call(self._claim, kind)
+            except Exception as e:
+                logger.error(f"領取工作錯誤: {e}")
+                await asyncio.sleep(5)
+                continue
+            if claimed is None:
+                await wakeup.wait()
+                continue
+            job_id, payload = claimed
+            self.running[kind] += 1
+            self._refresh_positions(kind)
+            status, error = "done", None
+            try:
+                job = await self._prepare(job_id, kind, payload)
+                # 佔位訊息顯示過排隊位置時，開始執行後改回原本的狀態文字
+                if self.positions.pop(job_id, None) and payload.get("status_text"):
+                    await job.update(payload["status_text"])
+                with metrics.trace_message():
+                    metrics.route(f"{kind}_job")
+                    await handler(job)
+            except Exception as e:
+                status, error = "failed", str(e)
+                logger.error(f"工作 {job_id}（{kind}）執行失敗: {e}")
+            finally:
+                self.running[kind] -= 1
+            self.finished[(kind, status)] += 1
+            try:
+                await self._call(self._finish, job_id, status, error)
+            except Exception as e:
+                logger.error(f"更新工作狀態錯誤: {e}")
+            if self.live.pop(job_id, None) is not None:
+                self.pending -= 1
+                if not self.pending:
+                    self.idle.set()
+
+    async def format_status(self):
+        """格式化背景工作狀態"""
+        if not self.started:
+            return "**背景工作**\n尚未啟動"
+        by_kind = defaultdict(dict)
+        for kind, status, count in await self._call(self._counts):
+            by_kind[kind][status] = count
+        lines = ["**背景工作**"]
+        for kind, (_, concurrency) in self.handlers.items():
+            lines.append(
+                f"{kind}：執行中 {self.running[kind]}/{concurrency}，排隊 {by_kind[kind].get('queued', 0)}，"
+                f"本次完成 {self.finished[(kind, 'done')]}、失敗 {self.finished[(kind, 'failed')]}"
+            )
+        if self.resumed:
+            lines.append(f"啟動時接續了 {self.resumed} 個未完成的工作")
+        return "\n".join(lines)
+
+    def shutdown(self):
+        """關閉佇列；執行中的工作保持 running，下次啟動時重新排隊"""
+        for pool in self.pools.values():
+            pool.shutdown(wait=False)
+        self.executor.shutdown(wait=True)
+        if self.conn is not None:
+            self.conn.close()
+
+def create_job_queue():
+    """依 JOB_QUEUE_PATH 建立工作佇列（多程序分片時每個程序使用自己的檔案）"""
+    path = os.getenv('JOB_QUEUE_PATH') or os.path.join(os.path.dirname(DB_PATH), 'jobs.db')
+    if os.getenv('SHARD_IDS'):
+        root, ext = os.path.splitext(path)
+        path = f"{root}_shards_{os.getenv('SHARD_IDS').replace(',', '-')}{ext}"
+    return JobQueue(path)
+
+# 創建背景工作佇列實例（工作類型在處理協程定義後註冊）
+job_queue = create_job_queue()
+
+# 系統健康檢查服務（連線後於背景執行，避免阻塞啟動）
+class HealthCheckService:
+    def __init__(self, db):
+        self.db = db
+        self.results = {}
+        self.started_at = None
+        self.finished_at = None
+        self.running = False
+
+    def _record(self, name, ok, detail):
+        """記錄單項檢查結果"""
+        self.results[name] = {"ok": ok, "detail": detail, "checked_at": datetime.now()}
+        if not ok:
+            logger.warning(f"警告：{name}檢查異常: {detail}")
+
+    def check_disk(self):
+        """檢查磁碟空間"""
+        disk = psutil.disk_usage('.')
+        ok = disk.percent <= 95 and disk.free >= 100 * 1024 * 1024  # 至少 100MB
+        self._record("磁碟", ok, f"使用率 {disk.percent}%，可用 {disk.free / 1024 / 1024:.1f}MB")
+
+    def check_write_permission(self):
+        """檢查當前目錄的寫入權限"""
+        test_file = os.path.join(os.getcwd(), 'test_write.tmp')
+        try:
+            with open(test_file, 'w') as f:
+                f.write('test')
+            os.remove(test_file)
+            self._record("檔案系統", True, "權限正常")
+        except Exception as e:
+            self._record("檔案系統", False, str(e))
+
+    def check_network(self):
+        """檢查網路連接"""
+        try:
+            conn = socket.create_connection(("8.8.8.8", 53), timeout=3)
+            conn.close()
+            self._record("網路", True, "連接正常")
+        except OSError as e:
+            self._record("網路", False, f"連接可能有問題: {e}")
+
+    def check_memory(self):
+        """檢查記憶體使用率"""
+        memory = psutil.virtual_memory()
+        self._record("記憶體", memory.percent <= 95, f"使用率 {memory.percent}%")
+
+    async def check_database(self):
+        """執行完整的資料庫完整性檢查"""
+        try:
+            result = await self.db.run_integrity_check()
+            self._record("資料庫", result == "ok", "完整性檢查通過" if result == "ok" else result)
+        except Exception as e:
+            self._record("資料庫", False, f"無法檢查: {e}")
+
+    def run_all_checks(self):
+        """依序執行所有阻塞式檢查（應在背景執行緒中呼叫）"""
+        checks = [
+            ("磁碟", self.check_disk),
+            ("檔案系統", self.check_write_permission),
+            ("網路", self.check_network),
+            ("記憶體", self.check_memory),
+        ]
+        for name, check in checks:
+            try:
+                check()
+            except Exception as e:
+                self._record(name, False, f"無法檢查: {e}")
+
+    async def run_in_background(self):
+        """在執行緒池中執行所有健康檢查，不阻塞事件循環"""
+        if self.running:
+            return
+        self.running = True
+        self.started_at = datetime.now()
+        try:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.run_all_checks)
+            await self.check_database()
+            self.finished_at = datetime.now()
+            failed = [name for name, r in self.results.items() if not r["ok"]]
+            if failed:
+                logger.info(f"背景健康檢查完成，異常項目: {'、'.join(failed)}")
+            else:
+                logger.info("背景健康檢查完成，所有項目正常")
+        finally:
+            self.running = False
+
+    def format_status(self):
+        """格式化健康檢查結果"""
+        lines = ["**健康檢查**"]
+        if not self.results:
+            lines.append("檢查進行中..." if self.running else "尚未執行")
+            return "\n".join(lines)
+        for name, r in self.results.items():
+            mark = "✅" if r["ok"] else "⚠️"
+            lines.append(f"{mark} {name}：{r['detail']}（{r['checked_at'].strftime('%H:%M:%S')}）")
+        if self.running:
+            lines.append("（重新檢查中...）")
+        return "\n".join(lines)
+
+# 創建健康檢查服務實例
+health_service = HealthCheckService(storage)
+
+# 系統資源快照（整個物件替換，讀取端不需要加鎖）
+class ResourceSnapshot:
+    __slots__ = ("memory_percent", "disk_percent", "disk_free", "sampled_at")
+
+    def __init__(self, memory_percent, disk_percent, disk_free, sampled_at):
+        self.memory_percent = memory_percent
+        self.disk_percent = disk_percent
+        self.disk_free = disk_free
+        self.sampled_at = sampled_at
+
+# 長篇故事門檻：系統資源不足時只接受此字數以內的故事
+LONG_STORY_WORD_COUNT = 3000
+
+# 系統資源監控服務（背景定期取樣，熱路徑只讀取快照）
+class ResourceMonitor:
+    def __init__(self, interval=30, memory_limit=90, disk_free_limit=100 * 1024 * 1024):
+        self.interval = interval
+        self.memory_limit = memory_limit  # 記憶體使用率上限（%）
+        self.disk_free_limit = disk_free_limit  # 可用磁碟空間下限（bytes）
+        self.snapshot = None
+        self.shed_count = 0
+        self._last_reason = None
+
+    def sample(self):
+        """取樣一次系統資源（阻塞呼叫，應在背景執行緒中執行）"""
+        memory = psutil.virtual_memory()
+        disk = psutil.disk_usage('.')
+        return ResourceSnapshot(memory.percent, disk.percent, disk.free, datetime.now())
+
+    def pressure_reason(self, snapshot=None):
+        """若系統資源不足則回傳原因，否則回傳 None"""
+        snapshot = snapshot or self.snapshot
+        if snapshot is None:
+            return None
+        if snapshot.memory_percent > self.memory_limit:
+            return f"記憶體使用率 {snapshot.memory_percent}%"
+        if snapshot.disk_free < self.disk_free_limit:
+            return f"可用磁碟空間 {snapshot.disk_free / 1024 / 1024:.1f}MB"
+        return None
+
+    def should_shed(self):
+        """供熱路徑呼叫：資源不足時回傳原因並計數"""
+        reason = self.pressure_reason()
+        if reason:
+            self.shed_count += 1
+        return reason
+
+    async def run(self):
+        """背景取樣循環"""
+        loop = asyncio.get_running_loop()
+        while not bot.is_closed():
+            try:
+                snapshot = await loop.run_in_executor(None, self.sample)
+                self.snapshot = snapshot
+                reason = self.pressure_reason(snapshot)
+                # 只在狀態改變時輸出，避免重複訊息
+                if reason != self._last_reason:
+                    if reason:
+                        logger.warning(f"警告：系統資源不足（{reason}），暫停長篇故事與繪圖")
+                    elif self._last_reason:
+                        logger.info("系統資源已恢復正常")
+                    self._last_reason = reason
+            except Exception as e:
+                logger.error(f"系統資源取樣錯誤: {e}")
+            await asyncio.sleep(self.interval)
+
+    def format_status(self):
+        """格式化系統資源狀態"""
+        snapshot = self.snapshot
+        if snapshot is None:
+            return "**系統資源**\n尚未取樣"
+        lines = [
+            "**系統資源**",
+            f"記憶體使用率：{snapshot.memory_percent}%",
+            f"磁碟使用率：{snapshot.disk_percent}%（可用 {snapshot.disk_free / 1024 / 1024:.1f}MB）",
+            f"取樣時間：{snapshot.sampled_at.strftime('%H:%M:%S')}",
+            f"已拒絕的高負載請求：{self.shed_count} 次",
+        ]
+        if self._last_reason:
+            lines.append(f"⚠️ 降載中：{self._last_reason}")
+        return "\n".join(lines)
+
+# 創建系統資源監控實例
+resource_monitor = ResourceMonitor()
+
+async def build_status_report():
+    """組合 小青!狀態 指令的回報內容"""
+    sections = [
+        health_service.format_status(),
+        resource_monitor.format_status(),
+        loop_watchdog.format_report(),
+        format_shard_status(),
+        await storage.format_status(),
+        chat_memory.format_status(),
+        await job_queue.format_status(),
+        chat_coalescer.format_status(),
+        outbound.format_status(),
+        edit_throttle.format_status(),
+        world_bosses.format_status(),
+        hedged_llm.format_status(),
+        breakers.format_status(),
+        model_router.format_status(),
+        await cache_footprint.format_report(),
+    ]
+    return "\n\n".join(sections)
+
+# 食物推薦服務（依照台灣當前時間自動判斷餐點，並透過線上資料推薦）
+class FoodRecommendationService:
+    # 本機備援菜單：線上查詢逾時或失敗時依權重抽選（權重越高越常被推薦）
+    LOCAL_MENU = {
+        "早餐": (
+            ("蛋餅", 5), ("飯糰", 4), ("蘿蔔糕", 3), ("燒餅油條", 3), ("鮪魚三明治", 3), ("鐵板麵", 3),
+            ("蔥抓餅加蛋", 3), ("漢堡蛋", 3), ("豆漿配燒餅", 2), ("肉包配豆漿", 2), ("鹹粥", 2), ("厚片吐司", 2),
+        ),
+        "午餐": (
+            ("雞腿便當", 5), ("滷肉飯", 5), ("排骨便當", 4), ("牛肉麵", 4), ("雞肉飯", 4), ("自助餐", 4),
+            ("水餃", 3), ("乾麵配貢丸湯", 3), ("炒飯", 3), ("咖哩飯", 2), ("鍋燒意麵", 2), ("蚵仔麵線", 2),
+        ),
+        "晚餐": (
+            ("火鍋", 4), ("家常菜", 4), ("牛肉麵", 3), ("熱炒", 3), ("滷味", 3), ("拉麵", 3),
+            ("鐵板燒", 2), ("鹽酥雞", 2), ("麻油雞", 2), ("羊肉爐", 2), ("壽司", 2), ("義大利麵", 2),
+        ),
+        "點心": (
+            ("珍珠奶茶", 5), ("雞排", 4), ("豆花", 3), ("地瓜球", 3), ("車輪餅", 3), ("蔥油餅", 3),
+            ("臭豆腐", 2), ("仙草凍", 2), ("芒果冰", 2), ("蚵仔煎", 2), ("肉圓", 2), ("烤香腸", 2),
+        ),
+    }
+
+    def __init__(self):
+        pass
+
+    def local_recommendation(self, meal_type: str) -> str:
+        """從本機備援菜單依權重抽選一道餐點"""
+        menu = self.LOCAL_MENU.get(meal_type, self.LOCAL_MENU["點心"])
+        foods, weights = zip(*menu)
+        return random.choices(foods, weights=weights)[0]
+
+    async def get_food_recommendation(self, meal_type: str) -> str:
+        """
+        透過 OpenAI 線上查詢台灣常見的餐點，再從結果中選擇一個作為推薦。
+        線上查詢超過期限或失敗時，改從本機備援菜單抽選。
+        """
+
+        # 建立提示詞
+        prompt = (
+            f"你是一位非常熟悉台灣飲食文化的美食推薦專家。"
+            f"現在是台灣的{meal_type}時間，請根據台灣人常吃、實際常見的{meal_type}餐點，"
+            f"列出 5 個具體的選項，只要列出食物名稱，以頓號「、」分隔，不要加任何說明或句子。"
+            f"範例輸出格式：雞肉飯、牛肉麵、滷肉飯、水餃、便當。"
+        )
+
+        try:
+            response = await hedged_llm.complete(
+                "food",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "你是一位熟悉台灣在地餐飲的美食顧問，只用繁體中文回答。",
+                    },
+                    {"role": "user", "content": prompt},
+                ],
+            )
+            if response is None:
+                return self.local_recommendation(meal_type)
+            text = response.choices[0].message.content.strip()
+
+            # 將各種分隔符統一，再拆成清單
+            normalized = (
+                text.replace("\n", "、")
+                .replace(",", "、")
+                .replace("，", "、")
+            )
+            raw_items = [s for s in normalized.split("、") if s.strip()]
+
+            foods = [
+                s.strip(" 　-•*0123456789.、。")
+                for s in raw_items
+                if s.strip(" 　-•*0123456789.、。")
+            ]
+
+            if foods:
+                return foods[0]
+        except Exception as e:
+            logger.warning(f"線上食物推薦查詢失敗: {e}")
+
+        # 後備：從本機菜單抽選，避免整個功能壞掉
+        return self.local_recommendation(meal_type)
+
+# 創建食物推薦服務實例
+food_service = FoodRecommendationService()
+
+
+# 塔羅牌服務
 class TarotService:
     def __init__(self):
         self.tarot_cards = [
@@ -869,6 +4197,21 @@ tarot_service = TarotService()
 
 # 故事生成服務
 class StoryService:
+    # 固定的系統提示：每次請求完全相同，可命中提示快取
+    SYSTEM_PROMPT = """你是一位專業的故事創作者，擅長創作各種類型的故事。請用繁體中文回答。
+創作時請遵守以下要求：
+1. 故事要有完整的起承轉合結構，包含：
+   - 開端：介紹背景和主要角色
+   - 發展：情節推進和衝突建立
+   - 高潮：最緊張或關鍵的時刻
+   - 結局：問題解決和故事收尾
+2. 角色塑造要生動立體，有明確的性格特點
+3. 情節要吸引人，有衝突和轉折，避免平淡
+4. 結尾要有意義或啟發性
+5. 用繁體中文撰寫
+6. 分段清楚，便於閱讀
+7. 可以加入對話、描寫、內心獨白等豐富故事內容"""
+
     def __init__(self):
         self.story_types = {
             "愛情": ["浪漫", "溫馨", "感人", "甜蜜", "虐心", "純愛", "成熟", "青春"],
@@ -905,33 +4248,155 @@ class StoryService:
         return word_count, story_type
     
     def generate_story_prompt(self, word_count, story_type):
-        """生成故事提示詞"""
+        """生成故事提示詞（固定的寫作要求在 SYSTEM_PROMPT，這裡只放每次不同的部分）"""
         # 選擇該類型的相關關鍵詞
         keywords = self.story_types.get(story_type, ["現代", "生活"])
         selected_keywords = random.sample(keywords, min(3, len(keywords)))
         
-        prompt = f"""請創作一個{word_count}字的{story_type}故事，要求：
-1. 字數必須達到{word_count}字，不能少於{word_count-200}字
-2. 故事類型：{story_type}，包含{', '.join(selected_keywords)}等元素
-3. 故事要有完整的起承轉合結構，包含：
-   - 開端：介紹背景和主要角色
-   - 發展：情節推進和衝突建立
-   - 高潮：最緊張或關鍵的時刻
-   - 結局：問題解決和故事收尾
-4. 角色塑造要生動立體，有明確的性格特點
-5. 情節要吸引人，有衝突和轉折，避免平淡
-6. 結尾要有意義或啟發性
-7. 用繁體中文撰寫
-8. 分段清楚，便於閱讀
-9. 可以加入對話、描寫、內心獨白等豐富故事內容
-
-請開始創作，確保字數達到{word_count}字："""
+        prompt = f"""請創作一個{word_count}字的{story_type}故事，包含{', '.join(selected_keywords)}等元素。
+字數必須達到{word_count}字，不能少於{word_count-200}字，請開始創作："""
         
         return prompt
 
+    # 長篇故事：先產生大綱與角色設定，再由各段平行撰寫
+    SECTION_WORDS = int(os.getenv('STORY_SECTION_WORDS', '1500'))  # 每段的目標字數，超過這個字數的故事才分段
+    MAX_SECTIONS = 8
+    MIN_SECTION_RATIO = 0.85  # 段落字數低於目標的這個比例時重寫該段
+    SECTION_RETRIES = 1
+
+    @staticmethod
+    def count_words(text):
+        """計算字數（不含空白與標點符號）"""
+        return sum(1 for ch in text if unicodedata.category(ch)[0] not in "PZC")
+
+    def plan_sections(self, word_count):
+        """依字數決定分段數（1 表示一次生成整篇故事）"""
+        if word_count <= self.SECTION_WORDS:
+            return 1
+        return min(self.MAX_SECTIONS, -(-word_count // self.SECTION_WORDS))
+
+    def generate_outline_prompt(self, word_count, story_type, sections):
+        """生成長篇故事大綱的提示詞（要求 JSON 格式）"""
+        keywords = self.story_types.get(story_type, ["現代", "生活"])
+        selected_keywords = random.sample(keywords, min(3, len(keywords)))
+        return f"""請為故事設計大綱，依序涵蓋開端、發展、高潮與結局，每段都要有具體的情節推進。
+請只回傳以下 JSON 格式，不要加任何說明，全部使用繁體中文：
+{{"title": "故事標題", "setting": "時代與場景設定", "characters": [{{"name": "角色名稱", "description": "外貌、性格與動機"}}], "sections": ["第 1 段的情節摘要", "第 2 段的情節摘要"]}}
+故事類型：{story_type}，包含{', '.join(selected_keywords)}等元素，全長約{word_count}字。
+故事要分成 {sections} 段，sections 必須剛好有 {sections} 項。"""
+
+    def parse_outline(self, text, sections):
+        """解析大綱 JSON，格式不符或段數不對時回傳 None"""
+        match = re.search(r"\{.*\}", text or "", re.S)
+        if not match:
+            return None
+        try:
+            outline = json.loads(match.group(0))
+        except ValueError:
+            return None
+        if not isinstance(outline, dict) or not isinstance(outline.get("sections"), list):
+            return None
+        summaries = [str(summary) for summary in outline["sections"] if summary]
+        if len(summaries) != sections:
+            return None
+        characters = [c for c in outline.get("characters") or [] if isinstance(c, dict) and c.get("name")]
+        return {
+            "title": str(outline.get("title") or ""),
+            "setting": str(outline.get("setting") or ""),
+            "characters": characters,
+            "sections": summaries,
+        }
+
+    def generate_section_prompt(self, outline, index, section_words, story_type, short_by=0):
+        """生成第 index 段的提示詞（附上完整大綱與角色設定，讓平行撰寫的段落保持一致）
+        同一篇故事各段的提示詞前半部完全相同，只有最後指定段落的部分不同，可共用提示快取"""
+        total = len(outline["sections"])
+        characters = "\n".join(f"- {c['name']}：{c.get('description', '')}" for c in outline["characters"]) or "- （自行安排）"
+        plan = "\n".join(f"{i + 1}. {summary}" for i, summary in enumerate(outline["sections"]))
+        if index == 0:
+            position = "這是故事的開頭，請自然地介紹背景與主要角色。"
+        elif index == total - 1:
+            position = "這是故事的最後一段，請承接上一段的情節並完整收尾。"
+        else:
+            position = "請直接承接上一段的情節，不要重新介紹角色，也不要提前寫出結局。"
+        retry = f"\n上一次撰寫的版本少了約{short_by}字，請寫得更詳細。" if short_by else ""
+        return f"""以下是一篇{story_type}故事的設定與大綱，故事共 {total} 段，每段分開撰寫。
+故事標題：{outline['title']}
+場景設定：{outline['setting']}
+角色設定：
+{characters}
+全篇大綱：
+{plan}
+只寫指定段落的正文，不要加標題、段落編號或任何說明，用繁體中文撰寫，可以加入對話、描寫與內心獨白。
+
+請撰寫第 {index + 1} 段，本段約{section_words}字，不能少於{int(section_words * self.MIN_SECTION_RATIO)}字。{position}{retry}"""
+
 # 創建故事服務實例
 story_service = StoryService()
 
+# 怪物名稱的本機產生器：以字元馬可夫鏈學習內建名稱與伺服器過去的怪物名稱，
+# 產生不出新名稱時改用「階級前綴＋怪物本體」的文法組合
+class MonsterNameGenerator:
+    SEED_NAMES = (
+        "史萊姆", "哥布林", "骷髏兵", "石像鬼", "狼人", "吸血鬼", "九尾狐", "饕餮", "窮奇", "檮杌",
+        "混沌", "畢方", "貔貅", "白澤", "夜叉", "羅剎", "山魈", "魍魎", "魑魅", "水鬼",
+        "殭屍", "獨角獸", "奇美拉", "蛇髮女妖", "巨魔", "食人魔", "地精", "巴哈姆特", "利維坦", "九頭蛇",
+        "火焰蜥蜴", "冰霜巨人", "暗影刺客", "沼澤巨鱷", "雷鳥", "月光狼", "岩石傀儡", "幽靈騎士", "深淵魔龍", "毒霧蜘蛛",
+    )
+    PREFIXES = {
+        "低階": ("小", "幼", "迷你", "軟綿", "野生", "迷路"),
+        "中階": ("狂暴", "鐵甲", "暗影", "赤焰", "寒霜", "劇毒"),
+        "高階": ("深淵", "遠古", "魔王", "混沌", "天災", "不滅"),
+    }
+    CORES = ("史萊姆", "哥布林", "巨狼", "蜥蜴", "蝙蝠", "傀儡", "蜘蛛", "魔像", "巨鱷", "妖狐", "石像鬼", "魔龍", "骷髏", "亡靈")
+    MIN_LENGTH = 2
+    MAX_LENGTH = 6
+
+    def _chain(self, names):
+        """建立一階與二階的字元轉移表（^ 為開頭、$ 為結尾）"""
+        chain = defaultdict(list)
+        for name in names:
+            padded = f"^^{name}$"
+            for i in range(2, len(padded)):
+                chain[padded[i - 2:i]].append(padded[i])
+                chain[padded[i - 1]].append(padded[i])
+        return chain
+
+    def _walk(self, chain):
+        state, name = "^^", ""
+        while len(name) <= self.MAX_LENGTH:
+            # 隨機在二階與一階之間切換，兼顧通順與新鮮感
+            options = chain.get(state) if random.random() < 0.5 else None
+            options = options or chain[state[-1]]
+            ch = random.choice(options)
+            if ch == "$":
+                return name
+            name += ch
+            state = state[-1] + ch
+        return None
+
+    def generate(self, tier, past_names=(), taken=(), attempts=50):
+        """產生一個未在訓練資料與 taken 中出現過的怪物名稱"""
+        known = set(self.SEED_NAMES) | set(past_names) | set(taken)
+        chain = self._chain(self.SEED_NAMES + tuple(past_names))
+        prefixes = self.PREFIXES.get(tier, ("神秘",))
+        for _ in range(attempts):
+            name = self._walk(chain)
+            if not name or not self.MIN_LENGTH <= len(name) <= self.MAX_LENGTH:
+                continue
+            if len(name) <= 3 and random.random() < 0.5:
+                name = random.choice(prefixes) + name
+            if name not in known:
+                return name
+        for _ in range(attempts):
+            name = random.choice(prefixes) + random.choice(self.CORES)
+            if name not in known:
+                return name
+        return f"{tier}怪物"
+
+# 創建怪物名稱產生器實例
+monster_names = MonsterNameGenerator()
+
 # 怪物生成服務
 class MonsterService:
     def __init__(self):
@@ -941,14 +4406,20 @@ class MonsterService:
             "高階": {"hp_range": (30, 40), "description": "只有資深勇者才能挑戰的強大怪物"}
         }
     
-    async def generate_monster(self):
-        """生成隨機怪物名稱（低階、中階、高階各一隻）"""
-        monsters = []
-        
-        for tier_name, tier_info in self.tiers.items():
-            try:
-                # 使用OpenAI生成怪物名稱
-                prompt = f"""請創造一個{tier_name}怪物的名稱，要求：
+    async def generate_monster(self, server_id):
+        """生成隨機怪物名稱（低階、中階、高階各一隻，同時向 OpenAI 查詢）"""
+        past_names = await storage.get_monster_names(server_id)
+        taken = set()
+        return list(await asyncio.gather(*(
+            self._generate_tier(tier_name, past_names, taken) for tier_name in self.tiers
+        )))
+
+    async def _generate_tier(self, tier_name, past_names, taken):
+        """生成一個階級的怪物；超過期限或失敗時改用本機產生器"""
+        name = ""
+        try:
+            # 使用OpenAI生成怪物名稱
+            prompt = f"""請創造一個{tier_name}怪物的名稱，要求：
 1. 請先上網查詢各種神話、傳說、遊戲、動漫中的怪物資料
 2. 基於這些資料，創造一個有趣且獨特的{tier_name}怪物名稱
 3. 怪物名稱要簡短且容易記憶（2-6個字）
@@ -957,21 +4428,19 @@ class MonsterService:
 
 名稱：[怪物名稱]"""
 
-                response = client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {"role": "system", "content": "你是一位擅長創造幻想生物的遊戲設計師，請用繁體中文回答。"},
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-                
+            response = await hedged_llm.complete(
+                "monster",
+                messages=[
+                    {"role": "system", "content": "你是一位擅長創造幻想生物的遊戲設計師，請用繁體中文回答。"},
+                    {"role": "user", "content": prompt}
+                ]
+            )
+            
+            if response is not None:
                 result = response.choices[0].message.content.strip()
                 
                 # 解析結果
-                lines = result.split('\n')
-                name = ""
-                
-                for line in lines:
+                for line in result.split('\n'):
                     if '名稱：' in line or '名称：' in line:
                         name = line.split('：', 1)[1].strip()
                         break
@@ -983,66 +4452,880 @@ class MonsterService:
                     # 移除可能的標記
                     name = name.replace('名稱：', '').replace('名称：', '').strip()
                 
-                if not name or len(name) > 10:
-                    # 後備方案
-                    name = f"{tier_name}怪物"
-                
-                monsters.append({
-                    "tier": tier_name,
-                    "name": name
-                })
-                    
-            except Exception as e:
-                print(f"生成{tier_name}怪物失敗: {e}")
-                # 後備方案
-                monsters.append({
-                    "tier": tier_name,
-                    "name": f"{tier_name}怪物"
-                })
+        except Exception as e:
+            logger.warning(f"生成{tier_name}怪物失敗: {e}")
+        
+        if not name or len(name) > 10 or name in past_names or name in taken:
+            # 後備方案：本機產生器（避開伺服器已有的名稱）
+            name = monster_names.generate(tier_name, past_names, taken)
+        taken.add(name)
         
-        return monsters
+        return {
+            "tier": tier_name,
+            "name": name
+        }
 
 # 創建怪物服務實例
 monster_service = MonsterService()
 
-# 設定固定的 system prompt
-SYSTEM_PROMPT = """你的名字叫"小青"，是一位來自台灣的智能陪伴機器人，你的專長領域是 CBT 認知行為療法。
-你的溝通方式親切、真誠，就像和一位好友或家人交談一樣。
-你注重聆聽用戶的個人故事和情感，用一種充滿同理心且不帶任何評判的方式回應。
-你提供的是針對性的建議，幫助用戶解決問題。
-你努力控制自己的回應，模仿現實生活中的對話節奏。
-你確保交流的過程親近且易於理解，避免使用冗長的解釋或條列式資訊，每次回覆會盡量控制在50字以內，並且排版易於閱讀，使得溝通更加流暢和舒適。
+# 世界王的傷害分片：依用戶 ID 分到固定的分片累加，合併時整組換新，寫入資料庫期間的攻擊不受影響
+class BossShard:
+    __slots__ = ("damage", "by_user")
+
+    def __init__(self):
+        self.damage = 0
+        self.by_user = {}  # 用戶 ID -> [名稱, 尚未寫入的傷害]
+
+    def add(self, user_id, username, damage):
+        self.damage += damage
+        entry = self.by_user.get(user_id)
+        if entry is None:
+            self.by_user[user_id] = [username, damage]
+        else:
+            entry[0] = username
+            entry[1] += damage
+
+# 一隻進行中的世界王：攻擊只更新記憶體中的分片，血量為資料庫中的血量扣掉尚未寫入的傷害
+class WorldBoss:
+    def __init__(self, server_id, name, max_hp, current_hp, channel, shards=16):
+        self.server_id = server_id
+        self.name = name
+        self.max_hp = max_hp
+        self.committed_hp = current_hp  # 最近一次合併後資料庫中的血量
+        self.pending = 0  # 已計入血量、尚未寫入資料庫的傷害
+        self.shards = [BossShard() for _ in range(shards)]
+        self.totals = {}  # 用戶 ID -> [名稱, 累計傷害]
+        self.recent = deque(maxlen=3)
+        self.attacks = 0
+        self.killer = None
+        self.channel = channel
+        self.bar_message = None
+        self.wake = asyncio.Event()
+        self.task = None
+
+    @property
+    def hp(self):
+        return max(0, self.committed_hp - self.pending)
+
+    def attack(self, user_id, username, damage):
+        """記錄一次攻擊（不等待資料庫），回傳實際造成的傷害；已被擊敗時回傳 None"""
+        hp = self.hp
+        if hp <= 0:
+            return None
+        dealt = min(damage, hp)
+        self.shards[user_id % len(self.shards)].add(user_id, username, dealt)
+        self.pending += dealt
+        self.attacks += 1
+        total = self.totals.setdefault(user_id, [username, 0])
+        total[0] = username
+        total[1] += dealt
+        self.recent.append((username, dealt))
+        if dealt == hp:
+            # 最後一擊：立即合併，讓擊殺公告不必等到下一個合併週期
+            self.killer = (user_id, username)
+            self.wake.set()
+        return dealt
+
+    def drain(self):
+        """取出所有分片的傷害，回傳 (總傷害, [(用戶 ID, 名稱, 傷害), ...])"""
+        shards, self.shards = self.shards, [BossShard() for _ in self.shards]
+        damage = sum(shard.damage for shard in shards)
+        attacks = [
+            (user_id, username, user_damage)
+            for shard in shards for user_id, (username, user_damage) in shard.by_user.items()
+        ]
+        return damage, attacks
+
+    def restore(self, attacks):
+        """寫入失敗時把傷害放回分片，下次合併重試"""
+        for user_id, username, user_damage in attacks:
+            self.shards[user_id % len(self.shards)].add(user_id, username, user_damage)
+
+    def commit(self, new_hp, damage):
+        self.committed_hp = new_hp
+        self.pending -= damage
+
+    def render(self):
+        """血條訊息內容"""
+        hp = self.hp
+        filled = round(20 * hp / self.max_hp) if self.max_hp else 0
+        lines = [
+            f"🌋 **世界王 {self.name}**",
+            f"`{'█' * filled}{'░' * (20 - filled)}` {hp} / {self.max_hp} HP（{hp * 100 / max(self.max_hp, 1):.1f}%）",
+            f"參戰人數：{len(self.totals)}　攻擊次數：{self.attacks}",
+        ]
+        if self.recent:
+            lines.append("最近攻擊：" + "、".join(f"{username} -{damage}" for username, damage in self.recent))
+        if hp > 0:
+            lines.append(f"全伺服器一起使用「小青!{self.name}(空格)(傷害值)」攻擊！")
+        else:
+            lines.append("世界王倒下了！")
+        return "\n".join(lines)
+
+# 世界王管理：每個伺服器同時最多一隻，合併協程每 merge_interval 秒把傷害一次寫入資料庫，
+# 資料庫以 is_alive = 1 為條件扣血，擊殺只會被公告一次
+class WorldBossManager:
+    TIER = "世界王"  # 存在 monsters.tier 欄位，重新啟動後可從資料庫辨識世界王
+
+    def __init__(self, shards=16, merge_interval=1.0, hp_per_member=50):
+        self.shards = shards
+        self.merge_interval = merge_interval
+        self.hp_per_member = hp_per_member
+        self.bosses = {}  # 伺服器 ID -> WorldBoss
+        self.counts = {"attacks": 0, "merges": 0, "rows": 0, "retries": 0, "kills": 0}
+
+    def get(self, server_id, name=None):
+        boss = self.bosses.get(server_id)
+        if boss is None or (name is not None and boss.name != name):
+            return None
+        return boss
+
+    def start(self, server_id, name, max_hp, current_hp, channel):
+        """開始追蹤一隻世界王（同步建立，避免同時攻擊時重複建立）"""
+        boss = self.get(server_id, name)
+        if boss is not None:
+            return boss
+        boss = WorldBoss(server_id, name, max_hp, current_hp, channel, self.shards)
+        self.bosses[server_id] = boss
+        boss.task = asyncio.get_running_loop().create_task(self._run(boss))
+        return boss
+
+    def attack(self, boss, user_id, username, damage):
+        dealt = boss.attack(user_id, username, damage)
+        if dealt is not None:
+            self.counts["attacks"] += 1
+        return dealt
+
+    async def _run(self, boss):
+        try:
+            # 召喚或重新啟動後第一次被攻擊時發送血條訊息，之後都以編輯更新
+            try:
+                boss.bar_message = await send_message(boss.channel, boss.render())
+            except discord.HTTPException as e:
+                logger.warning(f"無法發送世界王 {boss.name} 的血條: {e}")
+            while True:
+                try:
+                    await asyncio.wait_for(boss.wake.wait(), timeout=self.merge_interval)
+                except asyncio.TimeoutError:
+                    pass
+                boss.wake.clear()
+                if not await self.merge(boss):
+                    break
+        except Exception:
+            logger.exception(f"世界王 {boss.name} 合併時發生錯誤")
+        finally:
+            if self.bosses.get(boss.server_id) is boss:
+                del self.bosses[boss.server_id]
+
+    async def merge(self, boss):
+        """把分片中的傷害寫入資料庫並更新血條，回傳 False 表示世界王已結束"""
+        damage, attacks = boss.drain()
+        if not damage:
+            return True
+        try:
+            new_hp, error = await storage.record_boss_damage(boss.server_id, boss.name, damage, attacks)
+        except Exception as e:
+            logger.error(f"寫入世界王傷害錯誤，稍後重試: {e}")
+            boss.restore(attacks)
+            self.counts["retries"] += 1
+            return True
+        if error:
+            # 其他程序已擊敗或怪物已被刪除
+            logger.info(f"世界王 {boss.name} 已結束: {error}")
+            return False
+        self.counts["merges"] += 1
+        self.counts["rows"] += len(attacks)
+        boss.commit(new_hp, damage)
+        if boss.bar_message is not None:
+            edit_throttle.schedule(boss.bar_message, boss.render())
+        if new_hp > 0:
+            return True
+        self.counts["kills"] += 1
+        await self._announce_kill(boss, attacks)
+        return False
+
+    async def _announce_kill(self, boss, attacks):
+        """只有把血量寫到 0 的那次合併會執行：更新擊殺統計並公告傷害排行"""
+        # 多個程序共用資料庫時，最後一擊可能不在本程序，改以本次合併傷害最高的玩家計算
+        killer_id, killer_name = boss.killer or max(attacks, key=lambda attack: attack[2])[:2]
+        taiwan_now = datetime.utcnow() + timedelta(hours=8)
+        current_month_year = taiwan_now.strftime('%Y-%m')
+        await storage.increment_personal_kills(boss.server_id, killer_id, killer_name, current_month_year)
+        await storage.increment_team_kills(boss.server_id, current_month_year)
+        target_count, killed_count = await storage.get_team_goal(boss.server_id, current_month_year)
+
+        try:
+            praise_response = await chat_completion(
+                feature="praise",
+                messages=[
+                    {"role": "system", "content": "你是一位遊戲旁白，擅長創作熱血的誇獎句子。"},
+                    {"role": "user", "content": f"請為全伺服器一起擊敗世界王「{boss.name}」的勇者們創作一句簡短的誇獎句子（30字內），要熱血且鼓舞人心，用繁體中文回答。"}
+                ]
+            )
+            praise_text = praise_response.choices[0].message.content.strip()
+        except Exception:
+            praise_text = "真是太厲害了！"
+
+        ranking = sorted(boss.totals.values(), key=lambda total: total[1], reverse=True)[:5]
+        response = f"🎉 世界王 **{boss.name}** 被擊敗了！\n\n{praise_text}\n\n"
+        response += f"最後一擊：**{killer_name}**\n"
+        response += f"參戰人數：{len(boss.totals)}　攻擊次數：{boss.attacks}\n\n**傷害排行**\n"
+        response += "\n".join(f"{rank}. {username}：{damage} 點" for rank, (username, damage) in enumerate(ranking, 1))
+        if target_count is not None:
+            response += f"\n\n團隊已擊殺：{killed_count} / {target_count} 隻"
+        await post_message(boss.channel, response)
+
+    def format_status(self):
+        counts = self.counts
+        bosses = "、".join(f"{boss.name} {boss.hp}/{boss.max_hp}" for boss in self.bosses.values()) or "無"
+        return (
+            f"**世界王**\n進行中：{bosses}\n{self.shards} 個分片、每 {self.merge_interval:g}s 合併：攻擊 {counts['attacks']} 次、"
+            f"合併寫入 {counts['merges']} 次（{counts['rows']} 筆攻擊記錄）、重試 {counts['retries']} 次、擊殺 {counts['kills']} 隻"
+        )
+
+# 創建世界王管理實例（WORLD_BOSS_SHARDS 為傷害分片數，WORLD_BOSS_MERGE_INTERVAL 為寫入資料庫的間隔秒數，
+# WORLD_BOSS_HP_PER_MEMBER 為每位伺服器成員提供的血量）
+world_bosses = WorldBossManager(
+    shards=int(os.getenv('WORLD_BOSS_SHARDS', '16')),
+    merge_interval=float(os.getenv('WORLD_BOSS_MERGE_INTERVAL', '1.0')),
+    hp_per_member=int(os.getenv('WORLD_BOSS_HP_PER_MEMBER', '50')),
+)
+
+# 設定固定的 system prompt
+SYSTEM_PROMPT = """你的名字叫"小青"，是一位來自台灣的智能陪伴機器人，你的專長領域是 CBT 認知行為療法。
+你的溝通方式親切、真誠，就像和一位好友或家人交談一樣。
+你注重聆聽用戶的個人故事和情感，用一種充滿同理心且不帶任何評判的方式回應。
+你提供的是針對性的建議，幫助用戶解決問題。
+你努力控制自己的回應，模仿現實生活中的對話節奏。
+你確保交流的過程親近且易於理解，避免使用冗長的解釋或條列式資訊，每次回覆會盡量控制在50字以內，並且排版易於閱讀，使得溝通更加流暢和舒適。
 你會像一個朋友那樣與用戶對話，遠離任何維基百科式的表達方式，也完全不會使用表情符號。"""
 
+# 對話歷史視窗每幾輪才移動一次起點（1 表示每輪都移動）
+CHAT_HISTORY_BLOCK = int(os.getenv('CHAT_HISTORY_BLOCK', '10'))
+
+def format_recalled_turns(recalled):
+    """把長期記憶取回的較早對話整理成一則參考訊息"""
+    lines = ["以下是這位用戶與你較早的相關對話，供你參考："]
+    for username, user_msg, bot_response in recalled:
+        lines.append(f"{username}: {user_msg}")
+        lines.append(f"小青: {bot_response}")
+    return "\n".join(lines)
+
+# OpenAI 斷路器開啟時的本機回覆（不寫入對話記錄）
+LOCAL_CHAT_REPLIES = (
+    "小青現在有點連不上線，不過我有看到你的訊息。先深呼吸一下，等等再跟我說說好嗎？",
+    "我這邊暫時卡住了，沒辦法好好回你。你願意先把現在的感覺寫下來，等一下再一起聊聊嗎？",
+    "小青的腦袋暫時轉不過來，抱歉讓你等。先喝口水休息一下，我很快就回來。",
+)
+
+# 聊天連發合併：同一用戶在短時間內連續 @小青 的訊息合併成一輪對話（只查詢、呼叫模型、寫入一次）
+class ChatTurn:
+    """一次送給模型的對話：包含這一波合併的訊息與執行中的任務"""
+    __slots__ = ("burst", "messages", "task", "committed")
+
+    def __init__(self, burst, messages):
+        self.burst = burst
+        self.messages = messages
+        self.task = None
+        self.committed = False
+
+    @property
+    def content(self):
+        """合併後的訊息內容（略過空白的提及）"""
+        return "\n".join(text for _, text in self.messages if text) or "你好"
+
+    def commit(self):
+        """取得回應後呼叫：之後不會再被新訊息取消，這一輪的訊息從待處理中移除"""
+        if not self.committed:
+            self.committed = True
+            del self.burst.pending[:len(self.messages)]
+
+class ChatBurst:
+    __slots__ = ("pending", "generation", "turn")
+
+    def __init__(self):
+        self.pending = []  # 尚未回覆的 (訊息, 內容)
+        self.generation = 0  # 每收到一則訊息加一，用來判斷自己是不是最後一則
+        self.turn = None
+
+class ChatCoalescer:
+    def __init__(self, window=1.0):
+        self.window = window
+        self.bursts = {}  # (伺服器, 用戶) -> ChatBurst
+        self.received = 0
+        self.turns = 0
+        self.superseded = 0
+
+    async def submit(self, message, content, run_turn):
+        """加入一則訊息並等待視窗結束；只有這一波最後一則訊息會送出合併後的對話並等待回覆"""
+        self.received += 1
+        key = (message.guild.id, message.author.id)
+        burst = self.bursts.get(key)
+        if burst is None:
+            burst = self.bursts[key] = ChatBurst()
+        turn = burst.turn
+        if turn and not turn.committed and not turn.task.done():
+            # 還沒取得回應的請求已經過時：取消後與新訊息一起重新送出
+            turn.task.cancel()
+            self.superseded += 1
+        burst.pending.append((message, content))
+        burst.generation += 1
+        generation = burst.generation
+        if self.window > 0:
+            await asyncio.sleep(self.window)
+        if burst.generation != generation:
+            # 視窗內還有更新的訊息，由最後一則一起回覆
+            return
+        turn = burst.turn = ChatTurn(burst, list(burst.pending))
+        turn.task = asyncio.get_running_loop().create_task(run_turn(turn))
+        self.turns += 1
+        # 被取消時不把 CancelledError 傳給訊息處理
+        await asyncio.wait({turn.task})
+        if not turn.task.cancelled():
+            turn.commit()
+        if burst.turn is turn and not burst.pending:
+            del self.bursts[key]
+
+    def format_status(self):
+        return (
+            f"**聊天連發合併**\n視窗 {self.window:g}s：收到 {self.received} 則、送出 {self.turns} 輪對話，"
+            f"取消過時的請求 {self.superseded} 次，等待中 {len(self.bursts)} 位用戶"
+        )
+
+# 創建聊天連發合併實例（CHAT_COALESCE_WINDOW 為等待後續訊息的秒數，0 表示不等待）
+chat_coalescer = ChatCoalescer(window=float(os.getenv('CHAT_COALESCE_WINDOW', '1.0')))
+
+async def run_chat_turn(turn):
+    """以合併後的訊息進行一輪聊天：取得歷史與長期記憶、呼叫模型、寫入記錄並回覆"""
+    message = turn.messages[-1][0]
+    content = turn.content
+    try:
+        async with message.channel.typing():
+            # 第一次使用長期記憶的用戶先從聊天記錄匯入，較早的對話才取得回來
+            await chat_memory.backfill(message.guild.id, message.author.id)
+            
+            # 獲取該用戶的歷史對話記錄（啟用長期記憶時只取最近幾輪）
+            # 視窗起點每 CHAT_HISTORY_BLOCK 輪才移動一次，讓前面的提示內容在多次請求間保持不變
+            chat_history = await storage.get_chat_history(
+                message.guild.id,
+                message.author.id,
+                limit=chat_memory.recent_turns if chat_memory.enabled else 60,
+                block=CHAT_HISTORY_BLOCK
+            )
+            
+            # 從長期記憶取回與目前訊息最相關的較舊對話（已在最近對話中的略過）
+            recent_turns = {(user_msg, bot_response) for _, user_msg, bot_response in chat_history}
+            recalled = [
+                old_turn for old_turn in await chat_memory.recall(message.guild.id, message.author.id, content)
+                if (old_turn[1], old_turn[2]) not in recent_turns
+            ]
+            
+            # 構建包含歷史記錄的系統提示（固定的系統提示在最前面）
+            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+            
+            # 添加歷史對話記錄：最近的對話從舊到新，只會在後面追加
+            for username, user_msg, bot_response in chat_history[::-1]:
+                messages.append({"role": "user", "content": f"{username}: {user_msg}"})
+                messages.append({"role": "assistant", "content": bot_response})
+            
+            # 每次都不同的相關舊對話放在最後，不影響前面可快取的部分
+            if recalled:
+                messages.append({"role": "system", "content": format_recalled_turns(recalled)})
+            
+            # 添加當前用戶的消息
+            messages.append({"role": "user", "content": f"{message.author.name}: {content}"})
+            
+            # 調用 OpenAI API（非同步客戶端；被新訊息取代時取消任務，進行中的 HTTP 請求也會一併中斷）
+            response = await async_chat_completion(feature="chat", messages=messages)
+        
+        # 獲取 AI 回應；之後的寫入與回覆不再被取消
+        ai_response = response.choices[0].message.content
+        turn.commit()
+        
+        # 儲存對話記錄並寫入長期記憶
+        await asyncio.gather(
+            storage.add_chat(
+                message.guild.id,
+                message.author.id,
+                message.author.name,
+                content,
+                ai_response
+            ),
+            chat_memory.remember(message.guild.id, message.author.id, message.author.name, content, ai_response)
+        )
+        
+        # 發送回應
+        await send_message(message.channel, f"{message.author.mention} {ai_response}")
+        
+    except CircuitOpenError:
+        # OpenAI 不穩定時直接用本機回覆，不等待逾時
+        turn.commit()
+        await send_message(message.channel, f"{message.author.mention} {random.choice(LOCAL_CHAT_REPLIES)}")
+    except Exception as e:
+        turn.commit()
+        logger.error(f"處理聊天時發生錯誤: {e}")
+        await send_message(message.channel, f"{message.author.mention} 發生錯誤：{str(e)}")
+
+# 訊息預先過濾：在追蹤與路由之前，只用幾次屬性比較丟棄與小青無關的訊息
+class MessagePrefilter:
+    def __init__(self, allowlists=None):
+        self.allowlists = allowlists or {}  # 伺服器 ID -> 允許的頻道 ID（未列出的伺服器不限制）
+
+    @staticmethod
+    def parse_allowlists(spec):
+        """解析 CHANNEL_ALLOWLIST（格式：伺服器ID:頻道ID,頻道ID;伺服器ID:頻道ID）"""
+        allowlists = {}
+        for entry in spec.split(';'):
+            if not entry.strip():
+                continue
+            guild_id, _, channel_ids = entry.partition(':')
+            allowlists[int(guild_id)] = frozenset(int(channel_id) for channel_id in channel_ids.split(',') if channel_id.strip())
+        return allowlists
+
+    def channel_allowed(self, guild_id, channel):
+        allowed = self.allowlists.get(guild_id)
+        if allowed is None:
+            return True
+        # 討論串依所屬頻道判斷
+        return channel.id in allowed or getattr(channel, 'parent_id', None) in allowed
+
+    def reject_reason(self, message):
+        """回傳丟棄原因；需要處理時回傳 None（判斷過程不建立新物件）"""
+        if message.author.id == bot.user.id:
+            return "self"
+        if message.guild is None:
+            return "dm"
+        # 沒有提及任何人、也不是文字前綴指令的訊息佔絕大多數，最先判斷
+        if not (message.mentions or message.mention_everyone or (PREFIX_COMMANDS and message.content.startswith('小青!'))):
+            return "irrelevant"
+        if not self.channel_allowed(message.guild.id, message.channel):
+            return "channel"
+        return None
+
+# 創建訊息預先過濾實例
+message_filter = MessagePrefilter(MessagePrefilter.parse_allowlists(os.getenv('CHANNEL_ALLOWLIST', '')))
+
+# 兩代輪替的集合：新鍵放在目前這一代，每 window 秒（或超過 max_entries 筆）輪替一次並丟棄最舊的一代，
+# 記憶體上限固定，鍵至少保留 window 秒
+class RotatingSet:
+    def __init__(self, window, max_entries=100000):
+        self.window = window
+        self.max_entries = max_entries
+        self.current = set()
+        self.previous = set()
+        self.rotated_at = time.monotonic()
+
+    def __len__(self):
+        return len(self.current) + len(self.previous)
+
+    def add(self, key):
+        """加入鍵；已經存在時回傳 False"""
+        now = time.monotonic()
+        if now - self.rotated_at >= self.window or len(self.current) >= self.max_entries:
+            # 超過兩個視窗沒有輪替時，上一代也已經過期
+            self.previous = self.current if now - self.rotated_at < 2 * self.window else set()
+            self.current = set()
+            self.rotated_at = now
+        if key in self.current or key in self.previous:
+            return False
+        self.current.add(key)
+        return True
+
+# 重複訊息過濾：閘道恢復連線後重送的事件以訊息 ID 判斷；
+# 設定 DEDUP_CONTENT_WINDOW 時，同一用戶在同一頻道短時間內送出的相同內容也視為重複（誤按兩次送出）
+class MessageDeduplicator:
+    def __init__(self, id_window=600.0, content_window=0.0):
+        self.ids = RotatingSet(id_window)
+        self.contents = RotatingSet(content_window) if content_window > 0 else None
+
+    def duplicate_reason(self, message):
+        """回傳丟棄原因；第一次看到的訊息回傳 None 並記住"""
+        if not self.ids.add(message.id):
+            return "duplicate_id"
+        if self.contents is not None:
+            digest = hashlib.blake2b(
+                f"{message.channel.id}:{message.author.id}:{message.content}".encode("utf-8"), digest_size=8
+            ).digest()
+            if not self.contents.add(digest):
+                return "duplicate_content"
+        return None
+
+# 創建重複訊息過濾實例（DEDUP_ID_WINDOW 為記住訊息 ID 的秒數，DEDUP_CONTENT_WINDOW 為 0 時不比對內容）
+message_dedup = MessageDeduplicator(
+    id_window=float(os.getenv('DEDUP_ID_WINDOW', '600')),
+    content_window=float(os.getenv('DEDUP_CONTENT_WINDOW', '0')),
+)
+
+# 斜線指令樹：套用相同的頻道白名單
+class XiaoqingCommandTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction):
+        if interaction.guild_id is None or message_filter.channel_allowed(interaction.guild_id, interaction.channel):
+            return True
+        metrics.record_rejected("channel")
+        if interaction.type == discord.InteractionType.application_command:
+            await interaction.response.send_message("小青沒有在這個頻道提供服務喔！", ephemeral=True)
+        return False
+
 # 創建 Discord 機器人實例
+# 功能指令也以斜線指令提供；PREFIX_COMMANDS=off 時停用「小青!」文字前綴，
+# 不再需要特權的 message_content intent（@小青 提及的訊息仍會帶有內容）
+PREFIX_COMMANDS = os.getenv('PREFIX_COMMANDS', 'on').lower() != 'off'
+
 intents = discord.Intents.default()
-intents.message_content = True
+intents.message_content = PREFIX_COMMANDS
 # 注意：如需使用 role.members 或 guild.members，需要在 Discord 開發者門戶啟用 SERVER MEMBERS INTENT
 # intents.members = True  # 啟用 members intent 以獲取身分組成員
-bot = commands.Bot(command_prefix='小青!', intents=intents)
+
+# discord.py 快取設定檔：訊息快取上限、成員快取範圍，以及啟動時是否載入完整成員列表
+CACHE_PROFILES = {
+    # 不快取訊息與成員，記憶體只隨伺服器、頻道與身分組數量成長
+    "minimal": {"max_messages": None, "member_cache": "none", "chunk_guilds_at_startup": False},
+    # 預設：少量訊息快取，只快取語音頻道中的成員
+    "balanced": {"max_messages": 100, "member_cache": "voice", "chunk_guilds_at_startup": False},
+    # discord.py 預設值（啟用 members intent 時會快取並在啟動時載入所有成員）
+    "full": {"max_messages": 1000, "member_cache": "intents", "chunk_guilds_at_startup": None},
+}
+
+def cache_options(profile, intents):
+    """依快取設定檔產生 discord.py Client 參數（CACHE_MAX_MESSAGES 可覆寫訊息快取上限，0 表示停用）"""
+    if profile not in CACHE_PROFILES:
+        raise ValueError(f"不支援的快取設定檔: {profile}")
+    settings = CACHE_PROFILES[profile]
+    if settings["member_cache"] == "intents":
+        member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+    else:
+        member_cache_flags = discord.MemberCacheFlags.none()
+        member_cache_flags.voice = settings["member_cache"] == "voice" and intents.voice_states
+    max_messages = settings["max_messages"]
+    if os.getenv('CACHE_MAX_MESSAGES'):
+        max_messages = int(os.getenv('CACHE_MAX_MESSAGES')) or None
+    chunk_guilds_at_startup = settings["chunk_guilds_at_startup"]
+    return {
+        "max_messages": max_messages,
+        "member_cache_flags": member_cache_flags,
+        "chunk_guilds_at_startup": intents.members if chunk_guilds_at_startup is None else chunk_guilds_at_startup,
+    }
+
+CACHE_PROFILE = os.getenv('CACHE_PROFILE', 'balanced').lower()
+BOT_CACHE_OPTIONS = cache_options(CACHE_PROFILE, intents)
+
+# 分片設定：由分片監督程序透過環境變數指定，未設定時以單一程序執行
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '0'))
+SHARD_IDS = [int(shard_id) for shard_id in os.getenv('SHARD_IDS', '').split(',') if shard_id.strip()]
+
+if SHARD_COUNT:
+    bot = commands.AutoShardedBot(
+        command_prefix='小青!',
+        intents=intents,
+        shard_count=SHARD_COUNT,
+        shard_ids=SHARD_IDS or None,
+        tree_cls=XiaoqingCommandTree,
+        http_trace=channel_rate_limits.trace_config(),
+        **BOT_CACHE_OPTIONS,
+    )
+else:
+    bot = commands.Bot(
+        command_prefix='小青!', intents=intents, tree_cls=XiaoqingCommandTree,
+        http_trace=channel_rate_limits.trace_config(), **BOT_CACHE_OPTIONS,
+    )
+
+# 身分組成員追蹤：只記錄指定身分組的成員 ID，不需要快取或載入整個成員列表
+class RoleMemberTracker:
+    def __init__(self, ttl=6 * 3600):
+        self.ttl = ttl
+        self.members = {}  # (伺服器 ID, 身分組 ID) -> (更新時間, 成員 ID 集合)
+
+    async def count(self, guild, role):
+        """回傳擁有身分組的成員數（無法取得時為 0）"""
+        # 成員已完整快取（full 設定檔）或沒有 members intent 時，只能使用快取中的成員
+        if BOT_CACHE_OPTIONS["member_cache_flags"].joined or not bot.intents.members:
+            return len(role.members)
+        key = (guild.id, role.id)
+        cached = self.members.get(key)
+        if cached and time.monotonic() - cached[0] < self.ttl:
+            return len(cached[1])
+        try:
+            # 以 HTTP 分頁逐批讀取成員，只保留擁有身分組的成員 ID
+            member_ids = {member.id async for member in guild.fetch_members(limit=None) if member.get_role(role.id)}
+        except Exception as e:
+            logger.warning(f"讀取伺服器成員失敗: {e}")
+            return len(cached[1]) if cached else 0
+        self.members[key] = (time.monotonic(), member_ids)
+        return len(member_ids)
+
+    def discard(self, guild_id, user_id):
+        """成員離開伺服器時移除"""
+        for (tracked_guild_id, _), (_, member_ids) in self.members.items():
+            if tracked_guild_id == guild_id:
+                member_ids.discard(user_id)
+
+# 創建身分組成員追蹤實例
+role_tracker = RoleMemberTracker()
+
+# 快取記憶體估算：每種快取抽樣部分物件計算深層大小，再依數量推算
+# 抽樣在事件循環中進行（快取只會在事件循環中變動），計算深層大小則在執行緒中進行
+# 注意：直接讀取 discord.py 2.3.x 的內部屬性（guild._members、_channels、_roles、_threads 與
+# client._connection._users 這個 WeakValueDictionary）以避免複製整個快取，升級 discord.py 時需確認這些屬性仍存在
+class CacheFootprint:
+    SAMPLE_SIZE = 200
+    MAX_DEPTH = 6
+    # 指向共用物件或其他快取的屬性不計入（避免把整個伺服器或連線狀態算進單一物件）
+    SHARED_ATTRS = frozenset((
+        "_state", "_client", "_http", "http", "_connection", "loop", "guild", "_guild", "channel", "_user",
+        "_members", "_channels", "_roles", "_threads", "_voice_states", "emojis", "stickers",
+    ))
+    OPAQUE_TYPES = (type, types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType)
+
+    def __init__(self, client):
+        self.client = client
+
+    def _deep_size(self, obj, seen, depth=0):
+        if id(obj) in seen or isinstance(obj, self.OPAQUE_TYPES):
+            return 0
+        seen.add(id(obj))
+        size = sys.getsizeof(obj, 0)
+        if depth >= self.MAX_DEPTH or isinstance(obj, (str, bytes, int, float)):
+            return size
+        if isinstance(obj, dict):
+            children = list(obj.keys()) + list(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            children = list(obj)
+        else:
+            children = [
+                getattr(obj, name, None)
+                for cls in type(obj).__mro__
+                for name in getattr(cls, '__slots__', ())
+                if name not in self.SHARED_ATTRS
+            ]
+            # 先複製成列表再過濾：在執行緒中計算時，事件循環仍可能修改物件
+            children += [value for name, value in list(getattr(obj, '__dict__', {}).items()) if name not in self.SHARED_ATTRS]
+        return size + sum(self._deep_size(child, seen, depth + 1) for child in children)
+
+    def estimate(self, count, sample):
+        """依抽樣物件的平均深層大小推算 count 個物件的總位元組"""
+        sample = list({id(obj): obj for obj in sample}.values())
+        if not count or not sample:
+            return 0
+        seen = set()
+        return sum(self._deep_size(obj, seen) for obj in sample) * count / len(sample)
+
+    @staticmethod
+    def _reservoir(objects, k):
+        """從可迭代物件隨機抽出 k 個（蓄水池抽樣 Algorithm L）：以 islice 跳過不抽的物件，不建立完整列表"""
+        iterator = iter(objects)
+        sample = list(itertools.islice(iterator, k))
+        if len(sample) < k or not k:
+            return sample
+        # random.random() 可能為 0，改用 (0, 1] 的亂數避免 log(0)
+        weight = math.exp(math.log(1.0 - random.random()) / k)
+        while weight < 1.0:
+            skip = int(math.log(1.0 - random.random()) / math.log(1.0 - weight))
+            item = next(itertools.islice(iterator, skip, None), iterator)
+            if item is iterator:
+                break
+            sample[random.randrange(k)] = item
+            weight *= math.exp(math.log(1.0 - random.random()) / k)
+        return sample
+
+    def _sample(self, objects, count):
+        return count, self._reservoir(objects, min(self.SAMPLE_SIZE, count))
+
+    def _sample_per_guild(self, mappings):
+        """各伺服器的子快取：以 len 計數，依大小加權抽樣（不建立完整列表）"""
+        sizes = [len(mapping) for mapping in mappings]
+        total = sum(sizes)
+        if not total:
+            return 0, []
+        picks = defaultdict(int)
+        for index in random.choices(range(len(mappings)), weights=sizes, k=min(self.SAMPLE_SIZE, total)):
+            picks[index] += 1
+        sample = []
+        for index, count in picks.items():
+            sample += self._reservoir(mappings[index].values(), min(count, sizes[index]))
+        return total, sample
+
+    def categories(self):
+        """各類快取的 (名稱, 物件數, 抽樣物件)（伺服器本身不含成員、頻道等子快取）；須在事件循環中呼叫"""
+        client = self.client
+        guilds = client.guilds
+        # 用戶快取是 WeakValueDictionary，逐一取值很慢：從底層 dict 抽出弱參照後再取值
+        users = client._connection._users
+        user_count, user_refs = self._sample(users.data.values(), len(users))
+        user_sample = [user for user in (ref() for ref in user_refs) if user is not None]
+        emojis, stickers = client.emojis, client.stickers
+        messages = client.cached_messages
+        # 伺服器的子快取以 discord.py 內部的 dict 存放，直接讀取可避免複製數十萬個成員
+        rows = [
+            ("伺服器",) + self._sample(guilds, len(guilds)),
+            ("頻道",) + self._sample_per_guild([guild._channels for guild in guilds]),
+            ("討論串",) + self._sample_per_guild([guild._threads for guild in guilds]),
+            ("身分組",) + self._sample_per_guild([guild._roles for guild in guilds]),
+            ("成員",) + self._sample_per_guild([guild._members for guild in guilds]),
+            ("用戶", user_count, user_sample),
+            ("表情與貼圖",) + self._sample(itertools.chain(emojis, stickers), len(emojis) + len(stickers)),
+            ("訊息",) + self._sample(messages, len(messages)),
+            ("身分組成員追蹤",) + self._sample(
+                (member_ids for _, member_ids in role_tracker.members.values()), len(role_tracker.members)
+            ),
+        ]
+        return rows
+
+    def measure(self, categories):
+        """依抽樣結果估計各類快取的大小（可在執行緒中執行），回傳 (常駐記憶體位元組, [(類型, 物件數, 估計位元組)])"""
+        rss = psutil.Process().memory_info().rss
+        return rss, [(name, count, self.estimate(count, sample)) for name, count, sample in categories]
+
+    def report(self):
+        """在目前的執行緒抽樣並估計（測試用）"""
+        return self.measure(self.categories())
+
+    async def format_report(self):
+        """格式化快取記憶體用量（抽樣在事件循環中進行，深層大小在執行緒中計算，不阻塞事件循環）"""
+        loop = asyncio.get_running_loop()
+        rss, rows = await loop.run_in_executor(None, self.measure, self.categories())
+        flags = BOT_CACHE_OPTIONS["member_cache_flags"]
+        member_cache = "、".join(name for name, enabled in flags if enabled) or "不快取"
+        max_messages = BOT_CACHE_OPTIONS["max_messages"]
+        lines = [
+            "**快取記憶體（估計）**",
+            f"設定檔：{CACHE_PROFILE}（訊息快取 {max_messages or 0} 則，成員快取：{member_cache}，"
+            f"啟動時載入成員：{'是' if BOT_CACHE_OPTIONS['chunk_guilds_at_startup'] else '否'}）",
+            f"常駐記憶體：{rss / 1024 / 1024:.1f}MB",
+        ]
+        accounted = 0
+        for name, count, size in rows:
+            if not count:
+                continue
+            accounted += size
+            lines.append(f"{name}：{count} 個，約 {size / 1024 / 1024:.2f}MB")
+        lines.append(f"其他（程式、函式庫與未分類）：約 {max(0, rss - accounted) / 1024 / 1024:.1f}MB")
+        return "\n".join(lines)
+
+# 創建快取記憶體估算實例
+cache_footprint = CacheFootprint(bot)
+
+def format_shard_status():
+    """格式化目前程序負責的分片狀態"""
+    if not SHARD_COUNT:
+        return "**分片**\n單一程序模式"
+    owned = "、".join(str(shard_id) for shard_id in (SHARD_IDS or range(SHARD_COUNT)))
+    lines = ["**分片**", f"本程序負責：{owned}（共 {SHARD_COUNT} 個分片）"]
+    for shard_id, latency in bot.latencies:
+        lines.append(f"分片 {shard_id}：延遲 {latency * 1000:.0f}ms")
+    return "\n".join(lines)
+
+# 分片監督程序：啟動多個工作程序，各自負責一段分片，並自動重啟崩潰的程序
+class ShardSupervisor:
+    def __init__(self, shard_count, workers, max_backoff=60, stable_after=120):
+        self.shard_count = shard_count
+        self.workers = min(workers, shard_count)
+        self.max_backoff = max_backoff
+        self.stable_after = stable_after  # 執行超過此秒數即視為穩定，重設退避
+        self.processes = {}  # 工作程序編號 -> (Popen, 啟動時間)
+        self.failures = defaultdict(int)
+        self.restart_at = {}
+        self.stopping = False
+
+    def shard_ranges(self):
+        """把分片平均切成連續區段"""
+        base, extra = divmod(self.shard_count, self.workers)
+        ranges = []
+        start = 0
+        for index in range(self.workers):
+            size = base + (1 if index < extra else 0)
+            ranges.append(list(range(start, start + size)))
+            start += size
+        return ranges
+
+    def _spawn(self, index, shard_ids):
+        env = os.environ.copy()
+        env['SHARD_COUNT'] = str(self.shard_count)
+        env['SHARD_IDS'] = ",".join(str(shard_id) for shard_id in shard_ids)
+        if os.getenv('METRICS_PORT'):
+            env['METRICS_PORT'] = str(int(os.getenv('METRICS_PORT')) + index)
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        self.processes[index] = (process, time.monotonic())
+        logger.info(f"已啟動工作程序 {index}（PID {process.pid}），分片：{env['SHARD_IDS']}")
+
+    def _handle_signal(self, signum, frame):
+        logger.info("收到停止訊號，正在關閉所有工作程序...")
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self._handle_signal)
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        ranges = self.shard_ranges()
+        for index, shard_ids in enumerate(ranges):
+            self._spawn(index, shard_ids)
+
+        while not self.stopping:
+            now = time.monotonic()
+            for index, (process, started) in list(self.processes.items()):
+                if process.poll() is None:
+                    continue
+                if index not in self.restart_at:
+                    # 穩定執行一段時間後才崩潰，重設退避時間
+                    if now - started > self.stable_after:
+                        self.failures[index] = 0
+                    self.failures[index] += 1
+                    delay = min(2 ** self.failures[index], self.max_backoff)
+                    self.restart_at[index] = now + delay
+                    logger.warning(f"工作程序 {index} 已結束（代碼 {process.returncode}），{delay} 秒後重新啟動")
+                elif now >= self.restart_at[index]:
+                    del self.restart_at[index]
+                    self._spawn(index, ranges[index])
+            time.sleep(1)
+
+        for process, _ in self.processes.values():
+            if process.poll() is None:
+                process.terminate()
+        for process, _ in self.processes.values():
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        logger.info("所有工作程序已關閉")
 
 # 機器人準備就緒時的事件
 @bot.event
 async def on_ready():
-    print(f'{bot.user} 已成功啟動！')
-    print(f'機器人ID: {bot.user.id}')
-    print(f'連接的伺服器數量: {len(bot.guilds)}')
+    logger.info(f'{bot.user} 已成功啟動！')
+    logger.info(f'機器人ID: {bot.user.id}')
+    logger.info(f'連接的伺服器數量: {len(bot.guilds)}')
     
     # 顯示機器人所在的所有伺服器
     if bot.guilds:
-        print('\n機器人目前在以下伺服器：')
+        logger.info('機器人目前在以下伺服器：')
         for guild in bot.guilds:
-            print(f'  {guild.name} ({guild.id})')
+            logger.info(f'  {guild.name} ({guild.id})')
     else:
-        print('機器人目前不在任何伺服器中')
-    print()
+        logger.info('機器人目前不在任何伺服器中')
     
-    # 檢查記憶體使用情況
-    try:
-        memory = psutil.virtual_memory()
-        print(f"記憶體使用率: {memory.percent}%")
-    except Exception as e:
-        print(f"無法檢查記憶體使用情況: {e}")
+    # 重新連線時 on_ready 會再次觸發，背景任務只需啟動一次
+    if hasattr(bot, '_background_tasks_started'):
+        return
+    bot._background_tasks_started = True
+    
+    # 完整健康檢查（磁碟、網路、資料庫完整性等）改在背景執行
+    bot.loop.create_task(health_service.run_in_background())
+    
+    # 同步斜線指令（多程序分片時只由負責分片 0 的程序同步）
+    if not SHARD_IDS or 0 in SHARD_IDS:
+        bot.loop.create_task(sync_app_commands())
+    
+    # 啟動系統資源背景取樣
+    bot.loop.create_task(resource_monitor.run())
+    
+    # 啟動背景工作佇列（接續上次未完成的繪圖與故事）
+    bot.loop.create_task(job_queue.start())
+    
+    # 啟動事件循環監控
+    loop_watchdog.start(bot.loop)
+    
+    # 設定 METRICS_PORT 時啟動本機 Prometheus 指標端點
+    metrics_port = os.getenv('METRICS_PORT')
+    if metrics_port:
+        bot.loop.create_task(metrics.serve_prometheus(int(metrics_port)))
     
     # 啟動每月清空怪物的背景任務
     async def monthly_cleanup_task():
@@ -1067,92 +5350,52 @@ async def on_ready():
                 # 為所有伺服器清空上個月的未擊殺個人怪物
                 for guild in bot.guilds:
                     try:
-                        db_manager.clear_monthly_monsters(str(guild.id), last_month_year)
+                        await storage.clear_monthly_monsters(guild.id, last_month_year)
                     except Exception as e:
-                        print(f"清空伺服器 {guild.id} 的月度怪物時發生錯誤: {e}")
+                        logger.error(f"清空伺服器 {guild.id} 的月度怪物時發生錯誤: {e}")
                 
                 # 每小時檢查一次
                 await asyncio.sleep(3600)
             except Exception as e:
-                print(f"月度清理任務發生錯誤: {e}")
+                logger.error(f"月度清理任務發生錯誤: {e}")
                 await asyncio.sleep(3600)
     
     # 啟動背景任務
     bot.loop.create_task(monthly_cleanup_task())
 
+# 成員離開伺服器時更新身分組成員追蹤（需要 members intent）
+@bot.event
+async def on_raw_member_remove(payload):
+    role_tracker.discard(payload.guild_id, payload.user.id)
+
 # 監聽所有訊息
 @bot.event
 async def on_message(message):
+    # 無關的訊息在預先過濾就丟棄，不進入追蹤與路由；重送或重複的訊息在任何查詢與 API 呼叫前丟棄
+    reason = message_filter.reject_reason(message) or message_dedup.duplicate_reason(message)
+    if reason:
+        metrics.record_rejected(reason)
+        return
+    with metrics.trace_message():
+        await handle_message(message)
+
+async def handle_message(message):
     # 忽略機器人自己的訊息
     if message.author == bot.user:
         return
 
-    # 定期檢查系統資源
-    try:
-        if hasattr(bot, '_last_resource_check'):
-            if datetime.now() - bot._last_resource_check > timedelta(minutes=5):
-                memory = psutil.virtual_memory()
-                if memory.percent > 90:
-                    print(f"警告：記憶體使用率過高 ({memory.percent}%)")
-                bot._last_resource_check = datetime.now()
-        else:
-            bot._last_resource_check = datetime.now()
-    except Exception as e:
-        print(f"檢查系統資源時發生錯誤: {e}")
-
     # 檢查是否為 @小青 提及
     if bot.user.mentioned_in(message):
+        metrics.route("chat")
         # 移除 @小青 提及，獲取純文字內容
         content = message.content.replace(f'<@{bot.user.id}>', '').replace(f'<@!{bot.user.id}>', '').strip()
         
-        # 如果內容為空，提供預設問候語
-        if not content:
-            content = "你好"
-        
-        # 處理一般聊天
-        try:
-            async with message.channel.typing():
-                # 獲取該用戶的歷史對話記錄
-                chat_history = db_manager.get_chat_history(
-                    str(message.guild.id),
-                    str(message.author.id)
-                )
-                
-                # 構建包含歷史記錄的系統提示
-                messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-                
-                # 添加歷史對話記錄
-                for username, user_msg, bot_response in chat_history[::-1]:  # 反轉順序，從舊到新
-                    messages.append({"role": "user", "content": f"{username}: {user_msg}"})
-                    messages.append({"role": "assistant", "content": bot_response})
-                
-                # 添加當前用戶的消息
-                messages.append({"role": "user", "content": f"{message.author.name}: {content}"})
-                
-                # 調用 OpenAI API
-                response = client.chat.completions.create(
-                    model="gpt-5.1",
-                    messages=messages
-                )
-            
-            # 獲取 AI 回應
-            ai_response = response.choices[0].message.content
-            
-            # 儲存對話記錄
-            db_manager.add_chat(
-                str(message.guild.id),
-                str(message.author.id),
-                message.author.name,
-                content,
-                ai_response
-            )
-            
-            # 發送回應
-            await message.channel.send(f"{message.author.mention} {ai_response}")
-            
-        except Exception as e:
-            print(f"處理聊天時發生錯誤: {e}")
-            await message.channel.send(f"{message.author.mention} 發生錯誤：{str(e)}")
+        # 連續的訊息合併成一輪對話（內容為空時以預設問候語回應）
+        await chat_coalescer.submit(message, content, run_chat_turn)
+        return
+
+    # 文字前綴指令（PREFIX_COMMANDS=off 時只提供斜線指令）
+    if not PREFIX_COMMANDS:
         return
 
     # 檢查是否為特殊功能命令（小青!前綴）
@@ -1160,496 +5403,677 @@ async def on_message(message):
         # 提取命令內容（移除 "小青!" 前綴）
         content_after_prefix = message.content[3:].strip()
 
-        # 檢查是否為食物推薦查詢（依台灣時間判斷餐點）
-        if '吃什麼' in content_after_prefix:
-            try:
-                # 取得台灣當前時間（UTC+8）
-                taiwan_now = datetime.utcnow() + timedelta(hours=8)
-                hour = taiwan_now.hour
-
-                # 根據台灣時間判斷餐別
-                if 5 <= hour < 11:
-                    meal_type = "早餐"
-                elif 11 <= hour < 14:
-                    meal_type = "午餐"
-                elif 17 <= hour < 21:
-                    meal_type = "晚餐"
-                else:
-                    meal_type = "點心"
-
-                # 發送思考中訊息
-                loading_msg = await message.channel.send(
-                    f"{message.author.mention} 小青先幫你看一下現在台灣時間是幾點，再想想要吃什麼～"
-                )
-
-                # 取得推薦食物（透過線上查詢台灣常見餐點）
-                recommended_food = food_service.get_food_recommendation(meal_type)
-
-                # 組合回覆內容
-                reply = (
-                    f"現在台灣時間大約是 {taiwan_now.strftime('%H:%M')}，"
-                    f"算是{meal_type}時段。\n"
-                    f"小青推薦你可以吃 **{recommended_food}** ！"
-                )
+        # 檢查是否為狀態查詢
+        if content_after_prefix == '狀態':
+            metrics.route("status")
+            await send_message(message.channel, f"{message.author.mention}\n{await build_status_report()}")
+            return
 
-                # 儲存對話記錄
-                db_manager.add_chat(
-                    str(message.guild.id),
-                    str(message.author.id),
-                    message.author.name,
-                    content_after_prefix,
-                    reply
-                )
+        # 檢查是否為效能統計查詢
+        if content_after_prefix.lower() == 'stats':
+            metrics.route("stats")
+            await send_message(message.channel, f"{message.author.mention}\n{metrics.format_stats()}")
+            return
 
-                # 編輯訊息顯示推薦
-                await loading_msg.edit(content=f"{message.author.mention} {reply}")
+        # 檢查是否為回憶搜尋（在本伺服器的對話記錄中搜尋關鍵字）
+        if content_after_prefix.startswith('回憶'):
+            metrics.route("recall")
+            keyword = content_after_prefix[2:].strip()
+            if not keyword:
+                await send_message(message.channel, f"{message.author.mention} 請輸入要回憶的關鍵字，例如：小青!回憶 冒險故事")
                 return
+            await run_recall(message.channel, message.guild, message.author, keyword)
+            return
+
+        # 檢查是否為食物推薦查詢（依台灣時間判斷餐點）
+        if '吃什麼' in content_after_prefix:
+            metrics.route("food")
+            await run_food(message.channel, message.guild, message.author, content_after_prefix)
+            return
 
-            except Exception as e:
-                await message.channel.send(
-                    f"{message.author.mention} 抱歉，食物推薦功能發生錯誤：{str(e)}"
-                )
-                return
-        
-        
         # 檢查是否為塔羅牌查詢
         tarot_keywords = ['塔羅', '抽牌', '占卜', '運勢', '預測']
         is_tarot_query = any(keyword in content_after_prefix for keyword in tarot_keywords)
         
         if is_tarot_query:
-            # 塔羅牌資料
-            tarot_cards = [
-                {'name': '愚者 The Fool', 'upright': '新的開始、冒險、純真', 'reversed': '魯莽、不負責任、過度冒險'},
-                {'name': '魔術師 The Magician', 'upright': '創造力、技能、意志力', 'reversed': '技能不足、機會錯失、缺乏準備'},
-                {'name': '女祭司 The High Priestess', 'upright': '直覺、神秘、內在知識', 'reversed': '隱藏動機、表面性、缺乏理解'},
-                {'name': '女皇 The Empress', 'upright': '豐收、母性、創造力', 'reversed': '依賴、過度保護、缺乏成長'},
-                {'name': '皇帝 The Emperor', 'upright': '權威、領導、穩定', 'reversed': '專制、僵化、缺乏彈性'},
-                {'name': '教皇 The Hierophant', 'upright': '傳統、教育、精神指導', 'reversed': '反叛、非傳統、質疑權威'},
-                {'name': '戀人 The Lovers', 'upright': '愛情、和諧、選擇', 'reversed': '不協調、價值觀衝突、分離'},
-                {'name': '戰車 The Chariot', 'upright': '勝利、意志力、決心', 'reversed': '缺乏方向、衝突、失敗'},
-                {'name': '力量 Strength', 'upright': '勇氣、耐心、控制', 'reversed': '軟弱、自我懷疑、缺乏信心'},
-                {'name': '隱者 The Hermit', 'upright': '內省、孤獨、尋找', 'reversed': '孤立、拒絕幫助、迷失方向'},
-                {'name': '命運之輪 Wheel of Fortune', 'upright': '變化、機會、命運', 'reversed': '壞運氣、阻力、不必要變化'},
-                {'name': '正義 Justice', 'upright': '公平、真理、誠實', 'reversed': '不公、謊言、不平衡'},
-                {'name': '倒吊人 The Hanged Man', 'upright': '犧牲、暫停、新視角', 'reversed': '停滯、無效犧牲、缺乏進展'},
-                {'name': '死神 Death', 'upright': '結束、轉變、新開始', 'reversed': '抗拒改變、停滯、無法放手'},
-                {'name': '節制 Temperance', 'upright': '平衡、調和、耐心', 'reversed': '不平衡、過度、缺乏和諧'},
-                {'name': '惡魔 The Devil', 'upright': '束縛、物質主義、慾望', 'reversed': '釋放、打破束縛、克服誘惑'},
-                {'name': '高塔 The Tower', 'upright': '突然改變、混亂、啟示', 'reversed': '避免災難、延遲改變、恐懼'},
-                {'name': '星星 The Star', 'upright': '希望、信心、靈感', 'reversed': '失望、缺乏信心、悲觀'},
-                {'name': '月亮 The Moon', 'upright': '直覺、潛意識、恐懼', 'reversed': '釋放恐懼、隱藏真相、內在混亂'},
-                {'name': '太陽 The Sun', 'upright': '快樂、成功、活力', 'reversed': '暫時憂鬱、缺乏信心、過度樂觀'},
-                {'name': '審判 Judgement', 'upright': '重生、內在呼喚、釋放', 'reversed': '自我懷疑、拒絕改變、缺乏清晰'},
-                {'name': '世界 The World', 'upright': '完成、成就、旅行', 'reversed': '未完成、缺乏閉合、延遲'},
-                {'name': '權杖王牌 Ace of Wands', 'upright': '新機會、靈感、潛力', 'reversed': '延遲、缺乏能量、錯失機會'},
-                {'name': '權杖二 Two of Wands', 'upright': '計劃、決策、發現', 'reversed': '缺乏計劃、過度分析、恐懼'},
-                {'name': '權杖三 Three of Wands', 'upright': '擴張、視野、冒險', 'reversed': '延遲、挫折、缺乏方向'},
-                {'name': '權杖四 Four of Wands', 'upright': '慶祝、和諧、團結', 'reversed': '缺乏支持、衝突、過渡'},
-                {'name': '權杖五 Five of Wands', 'upright': '競爭、衝突、挑戰', 'reversed': '避免衝突、內部鬥爭、缺乏競爭'},
-                {'name': '權杖六 Six of Wands', 'upright': '勝利、成功、自信', 'reversed': '驕傲、缺乏信心、延遲成功'},
-                {'name': '權杖七 Seven of Wands', 'upright': '防禦、堅持、挑戰', 'reversed': '過度防禦、放棄、缺乏準備'},
-                {'name': '權杖八 Eight of Wands', 'upright': '快速行動、進展、訊息', 'reversed': '延遲、混亂、缺乏方向'},
-                {'name': '權杖九 Nine of Wands', 'upright': '堅持、防禦、準備', 'reversed': '疲憊、防禦性、缺乏準備'},
-                {'name': '權杖十 Ten of Wands', 'upright': '負擔、責任、壓力', 'reversed': '釋放負擔、缺乏責任、過度承擔'},
-                {'name': '權杖侍者 Page of Wands', 'upright': '探索、熱情、自由', 'reversed': '缺乏方向、延遲、缺乏熱情'},
-                {'name': '權杖騎士 Knight of Wands', 'upright': '行動、冒險、衝動', 'reversed': '延遲、缺乏方向、魯莽'},
-                {'name': '權杖皇后 Queen of Wands', 'upright': '熱情、獨立、活力', 'reversed': '缺乏信心、依賴、缺乏熱情'},
-                {'name': '權杖國王 King of Wands', 'upright': '領導、熱情、冒險', 'reversed': '衝動、缺乏耐心、專制'},
-                {'name': '聖杯王牌 Ace of Cups', 'upright': '愛、情感、直覺', 'reversed': '情感封閉、缺乏愛、不安全感'},
-                {'name': '聖杯二 Two of Cups', 'upright': '夥伴關係、和諧、愛', 'reversed': '分離、不和諧、缺乏愛'},
-                {'name': '聖杯三 Three of Cups', 'upright': '慶祝、友誼、快樂', 'reversed': '過度放縱、孤獨、缺乏慶祝'},
-                {'name': '聖杯四 Four of Cups', 'upright': '冥想、內省、重新評估', 'reversed': '新的機會、行動、重新參與'},
-                {'name': '聖杯五 Five of Cups', 'upright': '失望、悲傷、遺憾', 'reversed': '接受、希望、新開始'},
-                {'name': '聖杯六 Six of Cups', 'upright': '懷舊、純真、回憶', 'reversed': '活在過去、缺乏成長、天真'},
-                {'name': '聖杯七 Seven of Cups', 'upright': '選擇、幻想、機會', 'reversed': '清晰、現實、缺乏選擇'},
-                {'name': '聖杯八 Eight of Cups', 'upright': '離開、尋找、放棄', 'reversed': '猶豫、恐懼、缺乏行動'},
-                {'name': '聖杯九 Nine of Cups', 'upright': '滿足、願望實現、快樂', 'reversed': '物質主義、缺乏滿足、過度放縱'},
-                {'name': '聖杯十 Ten of Cups', 'upright': '和諧、家庭、圓滿', 'reversed': '家庭衝突、缺乏和諧、不完整'},
-                {'name': '聖杯侍者 Page of Cups', 'upright': '創意、訊息、機會', 'reversed': '缺乏創意、壞消息、錯失機會'},
-                {'name': '聖杯騎士 Knight of Cups', 'upright': '浪漫、提議、創意', 'reversed': '不切實際、缺乏行動、情感不穩定'},
-                {'name': '聖杯皇后 Queen of Cups', 'upright': '同情、直覺、關懷', 'reversed': '情感依賴、缺乏邊界、過度敏感'},
-                {'name': '聖杯國王 King of Cups', 'upright': '情感平衡、智慧、同理心', 'reversed': '情感不平衡、缺乏控制、冷漠'},
-                {'name': '寶劍王牌 Ace of Swords', 'upright': '清晰、真理、突破', 'reversed': '混亂、謊言、缺乏清晰'},
-                {'name': '寶劍二 Two of Swords', 'upright': '決策、平衡、僵局', 'reversed': '優柔寡斷、缺乏平衡、釋放'},
-                {'name': '寶劍三 Three of Swords', 'upright': '心痛、悲傷、背叛', 'reversed': '治癒、寬恕、釋放痛苦'},
-                {'name': '寶劍四 Four of Swords', 'upright': '休息、恢復、冥想', 'reversed': '缺乏休息、過度工作、重新開始'},
-                {'name': '寶劍五 Five of Swords', 'upright': '衝突、失敗、損失', 'reversed': '和解、寬恕、避免衝突'},
-                {'name': '寶劍六 Six of Swords', 'upright': '過渡、改變、離開', 'reversed': '停滯、缺乏改變、回歸'},
-                {'name': '寶劍七 Seven of Swords', 'upright': '策略、秘密、逃避', 'reversed': '誠實、面對問題、缺乏策略'},
-                {'name': '寶劍八 Eight of Swords', 'upright': '限制、恐懼、無助', 'reversed': '釋放、面對恐懼、新視角'},
-                {'name': '寶劍九 Nine of Swords', 'upright': '焦慮、恐懼、噩夢', 'reversed': '釋放恐懼、希望、內在平靜'},
-                {'name': '寶劍十 Ten of Swords', 'upright': '結束、痛苦、背叛', 'reversed': '恢復、新開始、釋放痛苦'},
-                {'name': '寶劍侍者 Page of Swords', 'upright': '新想法、訊息、學習', 'reversed': '缺乏想法、壞消息、缺乏學習'},
-                {'name': '寶劍騎士 Knight of Swords', 'upright': '行動、衝動、挑戰', 'reversed': '延遲、缺乏方向、魯莽'},
-                {'name': '寶劍皇后 Queen of Swords', 'upright': '獨立、清晰、智慧', 'reversed': '冷酷、缺乏同情、過度分析'},
-                {'name': '寶劍國王 King of Swords', 'upright': '權威、清晰、真理', 'reversed': '專制、缺乏同情、濫用權力'},
-                {'name': '錢幣王牌 Ace of Pentacles', 'upright': '機會、繁榮、新開始', 'reversed': '錯失機會、缺乏繁榮、延遲'},
-                {'name': '錢幣二 Two of Pentacles', 'upright': '平衡、適應、優先級', 'reversed': '不平衡、缺乏適應、混亂'},
-                {'name': '錢幣三 Three of Pentacles', 'upright': '團隊合作、技能、成長', 'reversed': '缺乏合作、技能不足、缺乏成長'},
-                {'name': '錢幣四 Four of Pentacles', 'upright': '安全、節儉、保護', 'reversed': '貪婪、缺乏安全、過度保護'},
-                {'name': '錢幣五 Five of Pentacles', 'upright': '貧困、困難、孤立', 'reversed': '恢復、希望、新機會'},
-                {'name': '錢幣六 Six of Pentacles', 'upright': '分享、慷慨、幫助', 'reversed': '自私、不平衡、依賴'},
-                {'name': '錢幣七 Seven of Pentacles', 'upright': '耐心、等待、投資', 'reversed': '焦躁、失望、回報不足'},
-                {'name': '錢幣八 Eight of Pentacles', 'upright': '努力、專注、學習', 'reversed': '疏忽、缺乏專注、半途而廢'},
-                {'name': '錢幣九 Nine of Pentacles', 'upright': '獨立、成就、享受', 'reversed': '依賴、失敗、孤獨'},
-                {'name': '錢幣十 Ten of Pentacles', 'upright': '財富、家庭、傳承', 'reversed': '損失、家庭糾紛、破產'},
-                {'name': '錢幣侍者 Page of Pentacles', 'upright': '學習、機會、成長', 'reversed': '懶惰、錯失機會、缺乏目標'},
-                {'name': '錢幣騎士 Knight of Pentacles', 'upright': '勤奮、責任、穩定', 'reversed': '拖延、固執、缺乏彈性'},
-                {'name': '錢幣皇后 Queen of Pentacles', 'upright': '實際、溫暖、照顧', 'reversed': '過度保護、物質主義、忽略自我'},
-                {'name': '錢幣國王 King of Pentacles', 'upright': '富有、穩重、成功', 'reversed': '貪婪、固執、失敗'}
-            ]
-            
-            card = random.choice(tarot_cards)
-            is_upright = random.choice([True, False])
-            position = '正位' if is_upright else '逆位'
-            meaning = card['upright'] if is_upright else card['reversed']
-
+            metrics.route("tarot")
             # 取得用戶問題（去除「塔羅牌」關鍵字後的內容）
             question = content_after_prefix.split('塔羅牌', 1)[-1].strip()
-            # 發送loading訊息
-            loading_msg = await message.channel.send(f"{message.author.mention} 小青正在為你解讀牌卡意思")
-            if question:
-                prompt = (
-                    f"你是一位專業塔羅牌解讀師。請根據用戶的問題，結合抽到的塔羅牌與正逆位，給出100到150字之間的詳細解讀，內容要有同理心、具體、貼近生活，並用繁體中文回答。\n"
-                    f"用戶的問題：{question}\n"
-                    f"抽到的牌：{card['name']} {position}\n"
-                    f"這張牌的基本意義：{meaning}\n"
-                    f"請開始詳細解讀（100-150字）："
-                )
-                response = client.chat.completions.create(
-                    model="gpt-5.1",
-                    messages=[{"role": "system", "content": "你是一位專業塔羅牌解讀師，請用繁體中文回答。"},
-                              {"role": "user", "content": prompt}]
-                )
-                ai_reply = response.choices[0].message.content
-                reply = f"{message.author.mention} 你抽到的塔羅牌是：{card['name']}（{position}）\n\n{ai_reply}"
-            else:
-                reply = f"{message.author.mention} 你抽到的塔羅牌是：{card['name']}（{position}）\n解釋：{meaning}"
-            
-            db_manager.add_chat(
-                str(message.guild.id),
-                str(message.author.id),
-                message.author.name,
-                content_after_prefix,
-                reply
-            )
-            await loading_msg.edit(content=f"{message.author.mention} {reply}")
+            await run_tarot(message.channel, message.guild, message.author, content_after_prefix, question)
+            return
+        
+        # 檢查是否為召喚世界王命令
+        if content_after_prefix == '世界王':
+            metrics.route("world_boss_spawn")
+            await run_world_boss_spawn(message.channel, message.guild, message.author)
             return
         
         # 檢查是否為生成怪物命令
         if '生成怪物' in content_after_prefix:
-            try:
-                # 發送生成中訊息
-                loading_msg = await message.channel.send(f"{message.author.mention} 獸潮正在來襲，請稍等...")
-                
-                # 獲取台灣時間
-                taiwan_now = datetime.utcnow() + timedelta(hours=8)
-                current_month_year = taiwan_now.strftime('%Y-%m')
-                last_month_year = (taiwan_now.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
-                
-                # 清空上個月的未擊殺個人怪物
-                db_manager.clear_monthly_monsters(str(message.guild.id), last_month_year)
-                
-                # 清空當前月份的未擊殺個人怪物（如果有的話，重新生成）
-                db_manager.clear_monthly_monsters(str(message.guild.id), current_month_year)
-                
-                # 獲取身分組ID為1448281984949293138的成員數量
-                role_id = 1448281984949293138
-                role = message.guild.get_role(role_id)
-                if not role:
-                    await loading_msg.edit(content=f"{message.author.mention} 找不到指定的身分組（ID: {role_id}）")
-                    return
-                
-                # 計算擁有該身分組的成員數量
-                member_count = 0
-                
-                # 嘗試獲取成員數量（需要啟用 SERVER MEMBERS INTENT）
-                try:
-                    # 方法1：使用 role.members（需要 members intent）
-                    try:
-                        member_count = len(role.members)
-                        if member_count > 0:
-                            print(f"使用 role.members 獲得的成員數量: {member_count}")
-                    except AttributeError:
-                        print("無法使用 role.members（需要啟用 SERVER MEMBERS INTENT）")
-                        # 如果沒有 members intent，嘗試其他方法
-                        try:
-                            # 嘗試使用 guild.members（也需要 members intent）
-                            if hasattr(message.guild, 'members') and message.guild.members:
-                                # 確保成員已載入
-                                if not message.guild.chunked:
-                                    print("正在載入伺服器成員...")
-                                    try:
-                                        await message.guild.chunk()
-                                    except Exception:
-                                        pass
-                                
-                                member_count = sum(1 for member in message.guild.members if role in member.roles)
-                                print(f"通過遍歷成員獲得的數量: {member_count}")
-                        except Exception as e:
-                            print(f"獲取成員數量失敗: {e}")
-                except Exception as e:
-                    print(f"獲取成員數量時發生錯誤: {e}")
-                
-                # 如果無法獲取成員數量，使用預設值
-                if member_count == 0:
-                    print("警告：無法獲取身分組成員數量（需要啟用 SERVER MEMBERS INTENT），使用預設值 1")
-                    member_count = 1  # 使用預設值，避免計算錯誤
-                    await message.channel.send(
-                        f"{message.author.mention} ⚠️ 注意：無法獲取身分組成員數量（需在 Discord 開發者門戶啟用 SERVER MEMBERS INTENT），將使用預設值進行計算。"
-                    )
-                
-                # 獲取上個月的個人總擊殺數量
-                last_month_total_kills = db_manager.get_total_personal_kills_last_month(
-                    str(message.guild.id),
-                    last_month_year
-                )
-                
-                # 如果上個月擊殺數為0，則以1計算
-                kill_multiplier = last_month_total_kills if last_month_total_kills > 0 else 1
-                
-                # 計算基礎血量：人數*3*2*(上個月個人總擊殺數量，若為0則以1計算)
-                base_hp = member_count * 3 * 2 * kill_multiplier
-                
-                # 定義階級倍數：低階*1，中階*2，高階*3
-                tier_multipliers = {
-                    "低階": 1,
-                    "中階": 2,
-                    "高階": 3
-                }
-                
-                print(f"上個月個人總擊殺數: {last_month_total_kills}, 倍數: {kill_multiplier}, 基礎血量: {base_hp}")
-                
-                # 獲取這個月的個人總擊殺數量
-                current_month_total_kills = db_manager.get_total_personal_kills_current_month(
-                    str(message.guild.id),
-                    current_month_year
-                )
-                
-                # 檢查是否為本月第一次輸入指令（團隊目標）
-                target_count, killed_count = db_manager.get_team_goal(str(message.guild.id), current_month_year)
-                
-                if target_count is None:
-                    # 本月第一次，設置團隊目標：人數*2
-                    team_target = member_count * 2
-                    db_manager.set_team_goal(str(message.guild.id), team_target, current_month_year)
-                    target_count = team_target
-                    killed_count = 0
-                
-                # 生成三隻怪物
-                monsters = await monster_service.generate_monster()
-                
-                # 將怪物存入資料庫，根據階級計算不同血量
-                for monster in monsters:
-                    tier = monster["tier"]
-                    tier_multiplier = tier_multipliers.get(tier, 1)
-                    monster_hp = base_hp * tier_multiplier
-                    
-                    db_manager.add_monster(
-                        str(message.guild.id),
-                        monster["name"],
-                        tier,
-                        "",  # 不再顯示外型
-                        monster_hp,
-                        'personal'
-                    )
-                    
-                    # 在怪物資料中添加血量資訊，方便後續顯示
-                    monster["hp"] = monster_hp
-                
-                # 統一顯示完整格式
-                # 格式化台灣時間
-                taiwan_time_str = taiwan_now.strftime('%Y年%m月%d日 %H:%M')
-                
-                response_text = f"**{taiwan_time_str}**\n\n"
-                response_text += f"當前玩家人數：{member_count}\n"
-                response_text += f"上個月個人總擊殺量：{last_month_total_kills}\n"
-                response_text += f"這個月個人總擊殺量：{current_month_total_kills}\n\n"
-                response_text += "**個人目標**\n"
-                
-                # 按照低中高階順序顯示
-                tier_order = ["低階", "中階", "高階"]
-                for tier in tier_order:
-                    for monster in monsters:
-                        if monster['tier'] == tier:
-                            response_text += f"{tier}怪物：{monster['name']}（血量：{monster['hp']}）\n"
-                            break
-                
-                response_text += "\n**團隊目標**\n"
-                response_text += f"已擊殺數量：{killed_count} / {target_count}\n\n"
-                
-                response_text += "使用「小青!(怪物名稱)(空格)(傷害值)」來攻擊怪物！"
-                
-                # 編輯訊息
-                await loading_msg.edit(content=f"{message.author.mention} {response_text}")
-                return
-                
-            except Exception as e:
-                await message.channel.send(f"{message.author.mention} 生成怪物時發生錯誤：{str(e)}")
-                import traceback
-                traceback.print_exc()
-                return
+            metrics.route("monster_spawn")
+            await run_monster_spawn(message.channel, message.guild, message.author)
+            return
         
         # 檢查是否為攻擊怪物命令（格式：小青!(怪物名稱) (數字)）
-        # 嘗試解析命令
-        import re
         attack_match = re.match(r'^(.+?)\s+(\d+)$', content_after_prefix)
         if attack_match:
+            metrics.route("attack")
             monster_name = attack_match.group(1).strip()
             damage = int(attack_match.group(2))
-            
-            try:
-                # 檢查怪物是否存在
-                monster_data = db_manager.get_monster(str(message.guild.id), monster_name)
-                
-                if not monster_data:
-                    await message.channel.send(f"{message.author.mention} 找不到名為「{monster_name}」的怪物。")
-                    return
-                
-                # 攻擊怪物
-                new_hp, error = db_manager.attack_monster(
-                    str(message.guild.id),
-                    monster_name,
-                    str(message.author.id),
-                    message.author.name,
-                    damage
-                )
-                
-                if error:
-                    await message.channel.send(f"{message.author.mention} {error}")
-                    return
-                
-                # 構建回應
-                if new_hp > 0:
-                    response = f"{message.author.mention} 對 **{monster_name}** 造成了 **{damage}** 點傷害！\n"
-                    response += f"剩餘血量：**{new_hp}** HP"
-                    await message.channel.send(response)
-                else:
-                    # 怪物被擊敗
-                    # 獲取台灣時間和當前月份
-                    taiwan_now = datetime.utcnow() + timedelta(hours=8)
-                    current_month_year = taiwan_now.strftime('%Y-%m')
-                    
-                    # 增加個人擊殺數（只計算最後一擊的玩家）
-                    db_manager.increment_personal_kills(
-                        str(message.guild.id),
-                        str(message.author.id),
-                        message.author.name,
-                        current_month_year
-                    )
-                    
-                    # 增加團隊擊殺數
-                    db_manager.increment_team_kills(str(message.guild.id), current_month_year)
-                    
-                    # 獲取統計數據
-                    personal_kills = db_manager.get_personal_kills(
-                        str(message.guild.id),
-                        str(message.author.id),
-                        current_month_year
-                    )
-                    target_count, killed_count = db_manager.get_team_goal(
-                        str(message.guild.id),
-                        current_month_year
-                    )
-                    
-                    # 生成誇獎句子
-                    try:
-                        praise_prompt = f"請為擊敗怪物「{monster_name}」的勇者們創作一句簡短的誇獎句子（30字內），要熱血且鼓舞人心，用繁體中文回答。"
-                        praise_response = client.chat.completions.create(
-                            model="gpt-4o-mini",
-                            messages=[
-                                {"role": "system", "content": "你是一位遊戲旁白，擅長創作熱血的誇獎句子。"},
-                                {"role": "user", "content": praise_prompt}
-                            ]
-                        )
-                        praise_text = praise_response.choices[0].message.content.strip()
-                    except:
-                        praise_text = "真是太厲害了！"
-                    
-                    response = f"🎉 **{monster_name}** 被擊敗了！\n\n"
-                    response += f"{praise_text}\n\n"
-                    response += f"**統計資訊**\n"
-                    response += f"個人擊殺數：{personal_kills} 隻\n"
-                    response += f"團隊已擊殺：{killed_count} / {target_count} 隻"
-                    
-                    await message.channel.send(response)
-                
-                return
-                
-            except Exception as e:
-                await message.channel.send(f"{message.author.mention} 攻擊怪物時發生錯誤：{str(e)}")
-                return
+            await run_attack(message.channel, message.guild, message.author, monster_name, damage)
+            return
         
         # 檢查是否為故事生成查詢
         story_keywords = ['說', '字', '故事']
         is_story_query = any(keyword in content_after_prefix for keyword in story_keywords) and '字' in content_after_prefix and '故事' in content_after_prefix
         
         if is_story_query:
+            metrics.route("story")
+            # 提取故事資訊
+            word_count, story_type = story_service.extract_story_info(content_after_prefix)
+            await run_story(message.channel, message.guild, message.author, content_after_prefix, word_count, story_type)
+            return
+
+    # 處理其他命令
+    await bot.process_commands(message)
+
+# 各指令的處理流程（文字前綴指令與斜線指令共用，channel 只需提供 send 與 typing）
+async def run_recall(channel, guild, author, keyword):
+    """在本伺服器的對話記錄中搜尋關鍵字"""
+    results = await storage.search_chat_history(guild.id, keyword)
+    # 沒有索引可用的關鍵字只搜尋了最新的一部分記錄，讓用戶知道範圍
+    scanned = getattr(results, "scanned", None)
+    note = f"（這個關鍵字無法使用索引，只搜尋了最近 {scanned} 則對話）" if scanned else ""
+    if not results:
+        await send_message(channel, f"{author.mention} 小青想不起來有關「{keyword}」的對話…{note}")
+        return
+    lines = [f"{author.mention} 小青想起了這些關於「{keyword}」的對話：{note}"]
+    for username, from_bot, snippet, timestamp in results:
+        speaker = f"小青回覆 {username}" if from_bot else username
+        lines.append(f"• [{str(timestamp)[:16]}] {speaker}：{snippet}")
+    await send_message(channel, "\n".join(lines))
+
+async def run_food(channel, guild, author, request_text):
+    """依台灣時間推薦餐點"""
+    try:
+        # 取得台灣當前時間（UTC+8）
+        taiwan_now = datetime.utcnow() + timedelta(hours=8)
+        hour = taiwan_now.hour
+
+        # 根據台灣時間判斷餐別
+        if 5 <= hour < 11:
+            meal_type = "早餐"
+        elif 11 <= hour < 14:
+            meal_type = "午餐"
+        elif 17 <= hour < 21:
+            meal_type = "晚餐"
+        else:
+            meal_type = "點心"
+
+        # 發送思考中訊息
+        loading_msg = await send_message(channel, 
+            f"{author.mention} 小青先幫你看一下現在台灣時間是幾點，再想想要吃什麼～"
+        )
+
+        # 取得推薦食物（透過線上查詢台灣常見餐點）
+        recommended_food = await food_service.get_food_recommendation(meal_type)
+
+        # 組合回覆內容
+        reply = (
+            f"現在台灣時間大約是 {taiwan_now.strftime('%H:%M')}，"
+            f"算是{meal_type}時段。\n"
+            f"小青推薦你可以吃 **{recommended_food}** ！"
+        )
+
+        # 儲存對話記錄
+        await storage.add_chat(
+            guild.id,
+            author.id,
+            author.name,
+            request_text,
+            reply
+        )
+
+        # 編輯訊息顯示推薦
+        await edit_message(loading_msg, f"{author.mention} {reply}")
+        return
+
+    except Exception as e:
+        await send_message(channel, 
+            f"{author.mention} 抱歉，食物推薦功能發生錯誤：{str(e)}"
+        )
+        return
+
+# 塔羅牌解讀的固定系統提示（放在最前面，可命中提示快取）
+TAROT_SYSTEM_PROMPT = (
+    "你是一位專業塔羅牌解讀師，請用繁體中文回答。"
+    "請根據用戶的問題，結合抽到的塔羅牌與正逆位，給出100到150字之間的詳細解讀，內容要有同理心、具體、貼近生活。"
+)
+
+async def run_tarot(channel, guild, author, request_text, question):
+    """抽一張塔羅牌，有問題時由模型解讀"""
+    # 塔羅牌資料
+    tarot_cards = [
+        {'name': '愚者 The Fool', 'upright': '新的開始、冒險、純真', 'reversed': '魯莽、不負責任、過度冒險'},
+        {'name': '魔術師 The Magician', 'upright': '創造力、技能、意志力', 'reversed': '技能不足、機會錯失、缺乏準備'},
+        {'name': '女祭司 The High Priestess', 'upright': '直覺、神秘、內在知識', 'reversed': '隱藏動機、表面性、缺乏理解'},
+        {'name': '女皇 The Empress', 'upright': '豐收、母性、創造力', 'reversed': '依賴、過度保護、缺乏成長'},
+        {'name': '皇帝 The Emperor', 'upright': '權威、領導、穩定', 'reversed': '專制、僵化、缺乏彈性'},
+        {'name': '教皇 The Hierophant', 'upright': '傳統、教育、精神指導', 'reversed': '反叛、非傳統、質疑權威'},
+        {'name': '戀人 The Lovers', 'upright': '愛情、和諧、選擇', 'reversed': '不協調、價值觀衝突、分離'},
+        {'name': '戰車 The Chariot', 'upright': '勝利、意志力、決心', 'reversed': '缺乏方向、衝突、失敗'},
+        {'name': '力量 Strength', 'upright': '勇氣、耐心、控制', 'reversed': '軟弱、自我懷疑、缺乏信心'},
+        {'name': '隱者 The Hermit', 'upright': '內省、孤獨、尋找', 'reversed': '孤立、拒絕幫助、迷失方向'},
+        {'name': '命運之輪 Wheel of Fortune', 'upright': '變化、機會、命運', 'reversed': '壞運氣、阻力、不必要變化'},
+        {'name': '正義 Justice', 'upright': '公平、真理、誠實', 'reversed': '不公、謊言、不平衡'},
+        {'name': '倒吊人 The Hanged Man', 'upright': '犧牲、暫停、新視角', 'reversed': '停滯、無效犧牲、缺乏進展'},
+        {'name': '死神 Death', 'upright': '結束、轉變、新開始', 'reversed': '抗拒改變、停滯、無法放手'},
+        {'name': '節制 Temperance', 'upright': '平衡、調和、耐心', 'reversed': '不平衡、過度、缺乏和諧'},
+        {'name': '惡魔 The Devil', 'upright': '束縛、物質主義、慾望', 'reversed': '釋放、打破束縛、克服誘惑'},
+        {'name': '高塔 The Tower', 'upright': '突然改變、混亂、啟示', 'reversed': '避免災難、延遲改變、恐懼'},
+        {'name': '星星 The Star', 'upright': '希望、信心、靈感', 'reversed': '失望、缺乏信心、悲觀'},
+        {'name': '月亮 The Moon', 'upright': '直覺、潛意識、恐懼', 'reversed': '釋放恐懼、隱藏真相、內在混亂'},
+        {'name': '太陽 The Sun', 'upright': '快樂、成功、活力', 'reversed': '暫時憂鬱、缺乏信心、過度樂觀'},
+        {'name': '審判 Judgement', 'upright': '重生、內在呼喚、釋放', 'reversed': '自我懷疑、拒絕改變、缺乏清晰'},
+        {'name': '世界 The World', 'upright': '完成、成就、旅行', 'reversed': '未完成、缺乏閉合、延遲'},
+        {'name': '權杖王牌 Ace of Wands', 'upright': '新機會、靈感、潛力', 'reversed': '延遲、缺乏能量、錯失機會'},
+        {'name': '權杖二 Two of Wands', 'upright': '計劃、決策、發現', 'reversed': '缺乏計劃、過度分析、恐懼'},
+        {'name': '權杖三 Three of Wands', 'upright': '擴張、視野、冒險', 'reversed': '延遲、挫折、缺乏方向'},
+        {'name': '權杖四 Four of Wands', 'upright': '慶祝、和諧、團結', 'reversed': '缺乏支持、衝突、過渡'},
+        {'name': '權杖五 Five of Wands', 'upright': '競爭、衝突、挑戰', 'reversed': '避免衝突、內部鬥爭、缺乏競爭'},
+        {'name': '權杖六 Six of Wands', 'upright': '勝利、成功、自信', 'reversed': '驕傲、缺乏信心、延遲成功'},
+        {'name': '權杖七 Seven of Wands', 'upright': '防禦、堅持、挑戰', 'reversed': '過度防禦、放棄、缺乏準備'},
+        {'name': '權杖八 Eight of Wands', 'upright': '快速行動、進展、訊息', 'reversed': '延遲、混亂、缺乏方向'},
+        {'name': '權杖九 Nine of Wands', 'upright': '堅持、防禦、準備', 'reversed': '疲憊、防禦性、缺乏準備'},
+        {'name': '權杖十 Ten of Wands', 'upright': '負擔、責任、壓力', 'reversed': '釋放負擔、缺乏責任、過度承擔'},
+        {'name': '權杖侍者 Page of Wands', 'upright': '探索、熱情、自由', 'reversed': '缺乏方向、延遲、缺乏熱情'},
+        {'name': '權杖騎士 Knight of Wands', 'upright': '行動、冒險、衝動', 'reversed': '延遲、缺乏方向、魯莽'},
+        {'name': '權杖皇后 Queen of Wands', 'upright': '熱情、獨立、活力', 'reversed': '缺乏信心、依賴、缺乏熱情'},
+        {'name': '權杖國王 King of Wands', 'upright': '領導、熱情、冒險', 'reversed': '衝動、缺乏耐心、專制'},
+        {'name': '聖杯王牌 Ace of Cups', 'upright': '愛、情感、直覺', 'reversed': '情感封閉、缺乏愛、不安全感'},
+        {'name': '聖杯二 Two of Cups', 'upright': '夥伴關係、和諧、愛', 'reversed': '分離、不和諧、缺乏愛'},
+        {'name': '聖杯三 Three of Cups', 'upright': '慶祝、友誼、快樂', 'reversed': '過度放縱、孤獨、缺乏慶祝'},
+        {'name': '聖杯四 Four of Cups', 'upright': '冥想、內省、重新評估', 'reversed': '新的機會、行動、重新參與'},
+        {'name': '聖杯五 Five of Cups', 'upright': '失望、悲傷、遺憾', 'reversed': '接受、希望、新開始'},
+        {'name': '聖杯六 Six of Cups', 'upright': '懷舊、純真、回憶', 'reversed': '活在過去、缺乏成長、天真'},
+        {'name': '聖杯七 Seven of Cups', 'upright': '選擇、幻想、機會', 'reversed': '清晰、現實、缺乏選擇'},
+        {'name': '聖杯八 Eight of Cups', 'upright': '離開、尋找、放棄', 'reversed': '猶豫、恐懼、缺乏行動'},
+        {'name': '聖杯九 Nine of Cups', 'upright': '滿足、願望實現、快樂', 'reversed': '物質主義、缺乏滿足、過度放縱'},
+        {'name': '聖杯十 Ten of Cups', 'upright': '和諧、家庭、圓滿', 'reversed': '家庭衝突、缺乏和諧、不完整'},
+        {'name': '聖杯侍者 Page of Cups', 'upright': '創意、訊息、機會', 'reversed': '缺乏創意、壞消息、錯失機會'},
+        {'name': '聖杯騎士 Knight of Cups', 'upright': '浪漫、提議、創意', 'reversed': '不切實際、缺乏行動、情感不穩定'},
+        {'name': '聖杯皇后 Queen of Cups', 'upright': '同情、直覺、關懷', 'reversed': '情感依賴、缺乏邊界、過度敏感'},
+        {'name': '聖杯國王 King of Cups', 'upright': '情感平衡、智慧、同理心', 'reversed': '情感不平衡、缺乏控制、冷漠'},
+        {'name': '寶劍王牌 Ace of Swords', 'upright': '清晰、真理、突破', 'reversed': '混亂、謊言、缺乏清晰'},
+        {'name': '寶劍二 Two of Swords', 'upright': '決策、平衡、僵局', 'reversed': '優柔寡斷、缺乏平衡、釋放'},
+        {'name': '寶劍三 Three of Swords', 'upright': '心痛、悲傷、背叛', 'reversed': '治癒、寬恕、釋放痛苦'},
+        {'name': '寶劍四 Four of Swords', 'upright': '休息、恢復、冥想', 'reversed': '缺乏休息、過度工作、重新開始'},
+        {'name': '寶劍五 Five of Swords', 'upright': '衝突、失敗、損失', 'reversed': '和解、寬恕、避免衝突'},
+        {'name': '寶劍六 Six of Swords', 'upright': '過渡、改變、離開', 'reversed': '停滯、缺乏改變、回歸'},
+        {'name': '寶劍七 Seven of Swords', 'upright': '策略、秘密、逃避', 'reversed': '誠實、面對問題、缺乏策略'},
+        {'name': '寶劍八 Eight of Swords', 'upright': '限制、恐懼、無助', 'reversed': '釋放、面對恐懼、新視角'},
+        {'name': '寶劍九 Nine of Swords', 'upright': '焦慮、恐懼、噩夢', 'reversed': '釋放恐懼、希望、內在平靜'},
+        {'name': '寶劍十 Ten of Swords', 'upright': '結束、痛苦、背叛', 'reversed': '恢復、新開始、釋放痛苦'},
+        {'name': '寶劍侍者 Page of Swords', 'upright': '新想法、訊息、學習', 'reversed': '缺乏想法、壞消息、缺乏學習'},
+        {'name': '寶劍騎士 Knight of Swords', 'upright': '行動、衝動、挑戰', 'reversed': '延遲、缺乏方向、魯莽'},
+        {'name': '寶劍皇后 Queen of Swords', 'upright': '獨立、清晰、智慧', 'reversed': '冷酷、缺乏同情、過度分析'},
+        {'name': '寶劍國王 King of Swords', 'upright': '權威、清晰、真理', 'reversed': '專制、缺乏同情、濫用權力'},
+        {'name': '錢幣王牌 Ace of Pentacles', 'upright': '機會、繁榮、新開始', 'reversed': '錯失機會、缺乏繁榮、延遲'},
+        {'name': '錢幣二 Two of Pentacles', 'upright': '平衡、適應、優先級', 'reversed': '不平衡、缺乏適應、混亂'},
+        {'name': '錢幣三 Three of Pentacles', 'upright': '團隊合作、技能、成長', 'reversed': '缺乏合作、技能不足、缺乏成長'},
+        {'name': '錢幣四 Four of Pentacles', 'upright': '安全、節儉、保護', 'reversed': '貪婪、缺乏安全、過度保護'},
+        {'name': '錢幣五 Five of Pentacles', 'upright': '貧困、困難、孤立', 'reversed': '恢復、希望、新機會'},
+        {'name': '錢幣六 Six of Pentacles', 'upright': '分享、慷慨、幫助', 'reversed': '自私、不平衡、依賴'},
+        {'name': '錢幣七 Seven of Pentacles', 'upright': '耐心、等待、投資', 'reversed': '焦躁、失望、回報不足'},
+        {'name': '錢幣八 Eight of Pentacles', 'upright': '努力、專注、學習', 'reversed': '疏忽、缺乏專注、半途而廢'},
+        {'name': '錢幣九 Nine of Pentacles', 'upright': '獨立、成就、享受', 'reversed': '依賴、失敗、孤獨'},
+        {'name': '錢幣十 Ten of Pentacles', 'upright': '財富、家庭、傳承', 'reversed': '損失、家庭糾紛、破產'},
+        {'name': '錢幣侍者 Page of Pentacles', 'upright': '學習、機會、成長', 'reversed': '懶惰、錯失機會、缺乏目標'},
+        {'name': '錢幣騎士 Knight of Pentacles', 'upright': '勤奮、責任、穩定', 'reversed': '拖延、固執、缺乏彈性'},
+        {'name': '錢幣皇后 Queen of Pentacles', 'upright': '實際、溫暖、照顧', 'reversed': '過度保護、物質主義、忽略自我'},
+        {'name': '錢幣國王 King of Pentacles', 'upright': '富有、穩重、成功', 'reversed': '貪婪、固執、失敗'}
+    ]
+
+    card = random.choice(tarot_cards)
+    is_upright = random.choice([True, False])
+    position = '正位' if is_upright else '逆位'
+    meaning = card['upright'] if is_upright else card['reversed']
+
+    # 發送loading訊息
+    loading_msg = await send_message(channel, f"{author.mention} 小青正在為你解讀牌卡意思")
+    if question:
+        # 固定的解讀要求放在系統提示，每次不同的牌與問題放在最後
+        prompt = (
+            f"抽到的牌：{card['name']} {position}\n"
+            f"這張牌的基本意義：{meaning}\n"
+            f"用戶的問題：{question}"
+        )
+        try:
+            # 在執行緒中等待解讀，不阻塞事件循環（斜線指令 defer 後同樣在這裡等待）
+            response = await chat_completion(
+                feature="tarot",
+                messages=[{"role": "system", "content": TAROT_SYSTEM_PROMPT},
+                          {"role": "user", "content": prompt}]
+            )
+            ai_reply = response.choices[0].message.content
+        except Exception as e:
+            # 無法取得解讀時，改用牌義組成本機解讀
+            logger.warning(f"塔羅牌解讀失敗，改用本機解讀: {e}")
+            ai_reply = (
+                f"關於「{question}」，{card['name']}以{position}出現，代表{meaning}。"
+                f"小青現在沒辦法細細解讀，先把這幾個關鍵字放在心上，想想它們和你的處境有什麼關聯。"
+            )
+        reply = f"{author.mention} 你抽到的塔羅牌是：{card['name']}（{position}）\n\n{ai_reply}"
+    else:
+        reply = f"{author.mention} 你抽到的塔羅牌是：{card['name']}（{position}）\n解釋：{meaning}"
+
+    await storage.add_chat(
+        guild.id,
+        author.id,
+        author.name,
+        request_text,
+        reply
+    )
+    await edit_message(loading_msg, f"{author.mention} {reply}")
+
+async def run_monster_spawn(channel, guild, author):
+    """清空舊怪物並生成本月的三隻怪物"""
+    try:
+        # 發送生成中訊息
+        loading_msg = await send_message(channel, f"{author.mention} 獸潮正在來襲，請稍等...")
+
+        # 獲取台灣時間
+        taiwan_now = datetime.utcnow() + timedelta(hours=8)
+        current_month_year = taiwan_now.strftime('%Y-%m')
+        last_month_year = (taiwan_now.replace(day=1) - timedelta(days=1)).strftime('%Y-%m')
+
+        # 清空上個月的未擊殺個人怪物
+        await storage.clear_monthly_monsters(guild.id, last_month_year)
+
+        # 清空當前月份的未擊殺個人怪物（如果有的話，重新生成）
+        await storage.clear_monthly_monsters(guild.id, current_month_year)
+
+        # 獲取身分組ID為1448281984949293138的成員數量
+        role_id = 1448281984949293138
+        role = guild.get_role(role_id)
+        if not role:
+            await edit_message(loading_msg, f"{author.mention} 找不到指定的身分組（ID: {role_id}）")
+            return
+
+        # 計算擁有該身分組的成員數量（只追蹤成員 ID，不載入整個成員列表）
+        member_count = await role_tracker.count(guild, role)
+
+        # 如果無法獲取成員數量，使用預設值
+        if member_count == 0:
+            logger.warning("警告：無法獲取身分組成員數量（需要啟用 SERVER MEMBERS INTENT），使用預設值 1")
+            member_count = 1  # 使用預設值，避免計算錯誤
+            await send_message(channel, 
+                f"{author.mention} ⚠️ 注意：無法獲取身分組成員數量（需在 Discord 開發者門戶啟用 SERVER MEMBERS INTENT），將使用預設值進行計算。"
+            )
+
+        # 獲取上個月的個人總擊殺數量
+        last_month_total_kills = await storage.get_total_personal_kills_last_month(
+            guild.id,
+            last_month_year
+        )
+
+        # 如果上個月擊殺數為0，則以1計算
+        kill_multiplier = last_month_total_kills if last_month_total_kills > 0 else 1
+
+        # 計算基礎血量：人數*3*2*(上個月個人總擊殺數量，若為0則以1計算)
+        base_hp = member_count * 3 * 2 * kill_multiplier
+
+        # 定義階級倍數：低階*1，中階*2，高階*3
+        tier_multipliers = {
+            "低階": 1,
+            "中階": 2,
+            "高階": 3
+        }
+
+        logger.info(f"上個月個人總擊殺數: {last_month_total_kills}, 倍數: {kill_multiplier}, 基礎血量: {base_hp}")
+
+        # 獲取這個月的個人總擊殺數量
+        current_month_total_kills = await storage.get_total_personal_kills_current_month(
+            guild.id,
+            current_month_year
+        )
+
+        # 檢查是否為本月第一次輸入指令（團隊目標）
+        target_count, killed_count = await storage.get_team_goal(guild.id, current_month_year)
+
+        if target_count is None:
+            # 本月第一次，設置團隊目標：人數*2
+            team_target = member_count * 2
+            await storage.set_team_goal(guild.id, team_target, current_month_year)
+            target_count = team_target
+            killed_count = 0
+
+        # 生成三隻怪物
+        monsters = await monster_service.generate_monster(guild.id)
+
+        # 將怪物存入資料庫，根據階級計算不同血量
+        for monster in monsters:
+            tier = monster["tier"]
+            tier_multiplier = tier_multipliers.get(tier, 1)
+            monster_hp = base_hp * tier_multiplier
+
+            await storage.add_monster(
+                guild.id,
+                monster["name"],
+                tier,
+                "",  # 不再顯示外型
+                monster_hp,
+                'personal'
+            )
+
+            # 在怪物資料中添加血量資訊，方便後續顯示
+            monster["hp"] = monster_hp
+
+        # 統一顯示完整格式
+        # 格式化台灣時間
+        taiwan_time_str = taiwan_now.strftime('%Y年%m月%d日 %H:%M')
+
+        response_text = f"**{taiwan_time_str}**\n\n"
+        response_text += f"當前玩家人數：{member_count}\n"
+        response_text += f"上個月個人總擊殺量：{last_month_total_kills}\n"
+        response_text += f"這個月個人總擊殺量：{current_month_total_kills}\n\n"
+        response_text += "**個人目標**\n"
+
+        # 按照低中高階順序顯示
+        tier_order = ["低階", "中階", "高階"]
+        for tier in tier_order:
+            for monster in monsters:
+                if monster['tier'] == tier:
+                    response_text += f"{tier}怪物：{monster['name']}（血量：{monster['hp']}）\n"
+                    break
+
+        response_text += "\n**團隊目標**\n"
+        response_text += f"已擊殺數量：{killed_count} / {target_count}\n\n"
+
+        response_text += "使用「小青!(怪物名稱)(空格)(傷害值)」來攻擊怪物！"
+
+        # 編輯訊息
+        await edit_message(loading_msg, f"{author.mention} {response_text}")
+        return
+
+    except Exception as e:
+        await send_message(channel, f"{author.mention} 生成怪物時發生錯誤：{str(e)}")
+        logger.exception("生成怪物時發生錯誤")
+        return
+
+async def run_world_boss_spawn(channel, guild, author):
+    """召喚全伺服器共同攻擊的世界王（同時最多一隻）"""
+    try:
+        boss = world_bosses.get(guild.id)
+        if boss is not None:
+            await send_message(channel, f"{author.mention} 世界王 **{boss.name}** 還在肆虐中，先一起打倒它吧！")
+            return
+
+        # 斜線指令的 followup 只能在 15 分鐘內編輯，血條改發到頻道本身
+        board = channel.interaction.channel if isinstance(channel, InteractionChannel) else channel
+        past_names = await storage.get_monster_names(guild.id)
+        name = monster_names.generate("高階", past_names)
+        max_hp = max(1, guild.member_count or 1) * world_bosses.hp_per_member
+        if not await storage.add_monster(guild.id, name, WorldBossManager.TIER, "", max_hp, 'world_boss'):
+            await send_message(channel, f"{author.mention} 世界王召喚失敗，請稍後再試。")
+            return
+
+        # 血條訊息由世界王的合併協程發送
+        world_bosses.start(guild.id, name, max_hp, max_hp, board)
+        if board is not channel:
+            await send_message(channel, f"{author.mention} 召喚了世界王 **{name}**！")
+    except Exception as e:
+        await send_message(channel, f"{author.mention} 召喚世界王時發生錯誤：{str(e)}")
+        logger.exception("召喚世界王時發生錯誤")
+
+async def run_attack(channel, guild, author, monster_name, damage):
+    """攻擊怪物，擊敗時更新擊殺統計"""
+    try:
+        # 世界王：只累加到記憶體中的分片，由合併協程寫入資料庫並更新血條
+        boss = world_bosses.get(guild.id, monster_name)
+        if boss is None:
+            # 檢查怪物是否存在
+            monster_data = await storage.get_monster(guild.id, monster_name)
+
+            if not monster_data:
+                await post_message(channel, f"{author.mention} 找不到名為「{monster_name}」的怪物。")
+                return
+
+            if monster_data[1] == WorldBossManager.TIER and monster_data[5]:
+                # 重新啟動後第一次被攻擊：從資料庫中的血量繼續
+                board = channel.interaction.channel if isinstance(channel, InteractionChannel) else channel
+                boss = world_bosses.start(guild.id, monster_name, monster_data[3], monster_data[4], board)
+
+        if boss is not None:
+            dealt = world_bosses.attack(boss, author.id, author.name, damage)
+            if dealt is None:
+                await post_message(channel, f"{author.mention} 怪物已經被擊敗了")
+            elif isinstance(channel, InteractionChannel):
+                # 斜線指令需要回覆才能結束「思考中」；文字指令只更新血條，不另外發訊息
+                await send_message(channel, f"{author.mention} 對世界王 **{monster_name}** 造成了 **{dealt}** 點傷害！")
+            return
+
+        # 攻擊怪物
+        new_hp, error = await storage.attack_monster(
+            guild.id,
+            monster_name,
+            author.id,
+            author.name,
+            damage
+        )
+
+        if error:
+            await post_message(channel, f"{author.mention} {error}")
+            return
+
+        # 構建回應
+        if new_hp > 0:
+            response = f"{author.mention} 對 **{monster_name}** 造成了 **{damage}** 點傷害！\n"
+            response += f"剩餘血量：**{new_hp}** HP"
+            await post_message(channel, response)
+        else:
+            # 怪物被擊敗
+            # 獲取台灣時間和當前月份
+            taiwan_now = datetime.utcnow() + timedelta(hours=8)
+            current_month_year = taiwan_now.strftime('%Y-%m')
+
+            # 增加個人擊殺數（只計算最後一擊的玩家）
+            await storage.increment_personal_kills(
+                guild.id,
+                author.id,
+                author.name,
+                current_month_year
+            )
+
+            # 增加團隊擊殺數
+            await storage.increment_team_kills(guild.id, current_month_year)
+
+            # 獲取統計數據
+            personal_kills = await storage.get_personal_kills(
+                guild.id,
+                author.id,
+                current_month_year
+            )
+            target_count, killed_count = await storage.get_team_goal(
+                guild.id,
+                current_month_year
+            )
+
+            # 生成誇獎句子
             try:
-                # 提取故事資訊
-                word_count, story_type = story_service.extract_story_info(content_after_prefix)
-                
-                # 檢查字數限制（避免生成過長的故事）
-                if word_count > 10000:
-                    await message.channel.send(f"{message.author.mention} 抱歉，故事字數不能超過一千字，請重新指定較少的字數。")
-                    return
-                
-                # 發送生成中訊息
-                search_msg = await message.channel.send(f"{message.author.mention} 小青正在創作{word_count}字的{story_type}故事，請稍等一下...")
-                
-                # 生成故事提示詞
-                story_prompt = story_service.generate_story_prompt(word_count, story_type)
-                
-                # 調用 OpenAI API 生成故事
-                response = client.chat.completions.create(
-                    model="gpt-4o-mini",
+                praise_prompt = f"請為擊敗怪物「{monster_name}」的勇者們創作一句簡短的誇獎句子（30字內），要熱血且鼓舞人心，用繁體中文回答。"
+                praise_response = await chat_completion(
+                    feature="praise",
                     messages=[
-                        {"role": "system", "content": "你是一位專業的故事創作者，擅長創作各種類型的故事。請用繁體中文回答。"},
-                        {"role": "user", "content": story_prompt}
-                    ],
-                    max_tokens=16000  # 大幅增加 token 限制以生成更長的故事
-                )
-                
-                # 獲取生成的故事
-                generated_story = response.choices[0].message.content
-                
-                # 構建故事訊息
-                story_message = f"**{story_type}故事**\n\n{generated_story}\n\n---\n*字數：約{word_count}字*"
-                
-                # 儲存對話記錄
-                db_manager.add_chat(
-                    str(message.guild.id),
-                    str(message.author.id),
-                    message.author.name,
-                    content_after_prefix,
-                    story_message
+                        {"role": "system", "content": "你是一位遊戲旁白，擅長創作熱血的誇獎句子。"},
+                        {"role": "user", "content": praise_prompt}
+                    ]
                 )
-                
-                # 編輯訊息顯示故事
-                await search_msg.edit(content=f"{message.author.mention} {story_message}")
-                return
-            
-            except Exception as e:
-                await message.channel.send(f"{message.author.mention} 抱歉，故事生成失敗：{str(e)}")
-                return
+                praise_text = praise_response.choices[0].message.content.strip()
+            except:
+                praise_text = "真是太厲害了！"
 
-    # 處理其他命令
-    await bot.process_commands(message)
+            response = f"🎉 **{monster_name}** 被擊敗了！\n\n"
+            response += f"{praise_text}\n\n"
+            response += f"**統計資訊**\n"
+            response += f"個人擊殺數：{personal_kills} 隻\n"
+            response += f"團隊已擊殺：{killed_count} / {target_count} 隻"
+
+            await post_message(channel, response)
+
+        return
+
+    except Exception as e:
+        await post_message(channel, f"{author.mention} 攻擊怪物時發生錯誤：{str(e)}")
+        return
+
+async def run_story(channel, guild, author, request_text, word_count, story_type):
+    """檢查後把故事加入背景工作佇列"""
+    try:
+        # 檢查字數限制（避免生成過長的故事）
+        if word_count > 10000:
+            await send_message(channel, f"{author.mention} 抱歉，故事字數不能超過一千字，請重新指定較少的字數。")
+            return
+
+        # 系統資源不足時暫停長篇故事
+        pressure = resource_monitor.should_shed() if word_count > LONG_STORY_WORD_COUNT else None
+        if pressure:
+            await send_message(channel, 
+                f"{author.mention} 小青現在有點忙不過來（{pressure}），暫時只能寫 {LONG_STORY_WORD_COUNT} 字以內的故事，請稍後再試！"
+            )
+            return
+
+        # OpenAI 不穩定時不排入佇列
+        if all(breakers.rejecting("chat", model) for model in model_router.policies["story"]["models"]):
+            await send_message(channel, f"{author.mention} 小青的靈感暫時連不上（OpenAI 服務不穩定），請稍後再試！")
+            return
+
+        # 發送生成中訊息（排隊時會在後面加上排隊位置）
+        status_text = f"{author.mention} 小青正在創作{word_count}字的{story_type}故事，請稍等一下..."
+        search_msg = await send_message(channel, status_text)
+
+        # 短篇故事優先，長篇故事不會擋住後面的短篇
+        await job_queue.enqueue(
+            "story",
+            {
+                "guild_id": guild.id,
+                "channel_id": channel.id,
+                "author_id": author.id,
+                "author_name": author.name,
+                "placeholder_id": search_msg.id,
+                "status_text": status_text,
+                "request_text": request_text,
+                "word_count": word_count,
+                "story_type": story_type,
+            },
+            priority=1 if word_count > LONG_STORY_WORD_COUNT else 0,
+            channel=channel,
+            placeholder=search_msg,
+        )
+
+    except Exception as e:
+        await send_message(channel, f"{author.mention} 抱歉，故事生成失敗：{str(e)}")
+        return
+
+async def story_completion(prompt, max_tokens, **kwargs):
+    """在故事專用的執行緒池中調用 OpenAI API，回傳生成的文字"""
+    response = await job_queue.run_blocking(
+        "story",
+        create_chat_completion,
+        feature="story",
+        messages=[
+            {"role": "system", "content": StoryService.SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        max_tokens=max_tokens,
+        **kwargs
+    )
+    return response.choices[0].message.content or ""
+
+async def write_story_section(outline, index, section_words, story_type):
+    """撰寫一段故事；字數不足時只重寫這一段，保留較長的版本"""
+    best, best_count = "", 0
+    for attempt in range(story_service.SECTION_RETRIES + 1):
+        prompt = story_service.generate_section_prompt(outline, index, section_words, story_type, section_words - best_count if attempt else 0)
+        text = (await story_completion(prompt, section_words * 2 + 500)).strip()
+        count = story_service.count_words(text)
+        if count > best_count:
+            best, best_count = text, count
+        if best_count >= section_words * story_service.MIN_SECTION_RATIO:
+            break
+        logger.info(f"故事第 {index + 1} 段只有 {best_count} 字（目標 {section_words} 字）")
+    return best
+
+async def write_story(word_count, story_type):
+    """生成故事，回傳 (標題, 內容)：短篇一次生成，長篇先產生大綱再平行撰寫各段"""
+    sections = story_service.plan_sections(word_count)
+    if sections > 1:
+        outline_text = await story_completion(
+            story_service.generate_outline_prompt(word_count, story_type, sections),
+            1500,
+            response_format={"type": "json_object"}
+        )
+        outline = story_service.parse_outline(outline_text, sections)
+        if outline:
+            section_words = -(-word_count // sections)
+            parts = await asyncio.gather(*(
+                write_story_section(outline, index, section_words, story_type) for index in range(sections)
+            ))
+            return outline["title"], "\n\n".join(parts)
+        logger.warning("故事大綱格式不符，改為一次生成整篇故事")
+    story_prompt = story_service.generate_story_prompt(word_count, story_type)
+    return None, await story_completion(story_prompt, 16000)  # 大幅增加 token 限制以生成更長的故事
+
+async def story_job(job):
+    """背景工作：生成故事並編輯佔位訊息"""
+    payload = job.payload
+    author = job.author
+    word_count = payload["word_count"]
+    story_type = payload["story_type"]
+    try:
+        # 生成故事
+        title, generated_story = await write_story(word_count, story_type)
+
+        # 構建故事訊息（字數在本機計算）
+        heading = f"**{story_type}故事：{title}**" if title else f"**{story_type}故事**"
+        story_message = f"{heading}\n\n{generated_story}\n\n---\n*字數：{story_service.count_words(generated_story)}字*"
+
+        # 儲存對話記錄
+        await storage.add_chat(
+            payload["guild_id"],
+            author.id,
+            author.name,
+            payload["request_text"],
+            story_message
+        )
+
+        # 編輯訊息顯示故事（超過 Discord 字數上限的部分接著發送）
+        chunks = split_message(f"{author.mention} {story_message}")
+        await job.update(chunks[0])
+        for chunk in chunks[1:]:
+            await send_message(job.channel, chunk)
+
+    except Exception as e:
+        await send_message(job.channel, f"{author.mention} 抱歉，故事生成失敗：{str(e)}")
+        raise
 
 # 繪圖相關功能
 async def generate_image(prompt):
     try:
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1024x1024",
-            quality="hd",
-            style="vivid",
-            n=1,
-        )
+        with breakers.get("images", "dall-e-3").call(), metrics.stage("llm"):
+            response = await job_queue.run_blocking(
+                "draw",
+                client.images.generate,
+                model="dall-e-3",
+                prompt=prompt,
+                size="1024x1024",
+                quality="hd",
+                style="vivid",
+                n=1,
+            )
         return response.data[0].url
     except Exception as e:
-        print(f"生成圖片時發生錯誤: {e}")
+        logger.error(f"生成圖片時發生錯誤: {e}")
         raise e
 
 async def download_image(url):
@@ -1657,10 +6081,10 @@ async def download_image(url):
         async with session.get(url) as response:
             if response.status == 200:
                 try:
-                    # 檢查磁碟空間
-                    total, used, free = shutil.disk_usage('.')
-                    if free < 50 * 1024 * 1024:  # 少於 50MB
-                        raise Exception(f"磁碟空間不足，可用空間: {free / 1024 / 1024:.1f}MB")
+                    # 檢查磁碟空間（讀取背景監控的快照）
+                    snapshot = resource_monitor.snapshot
+                    if snapshot and snapshot.disk_free < 50 * 1024 * 1024:  # 少於 50MB
+                        raise Exception(f"磁碟空間不足，可用空間: {snapshot.disk_free / 1024 / 1024:.1f}MB")
                     
                     # 檢查臨時目錄權限
                     temp_dir = tempfile.gettempdir()
@@ -1679,10 +6103,10 @@ async def download_image(url):
                         if not os.path.exists(tmp_file.name):
                             raise Exception("臨時文件創建失敗")
                         
-                        print(f"成功下載圖片到: {tmp_file.name}")
+                        logger.debug("成功下載圖片到: %s", tmp_file.name)
                         return tmp_file.name
                 except Exception as e:
-                    print(f"創建臨時文件失敗: {e}")
+                    logger.warning(f"創建臨時文件失敗: {e}")
                     raise Exception(f"無法創建臨時文件: {e}")
             else:
                 raise Exception(f"下載圖片失敗: {response.status}")
@@ -1690,25 +6114,52 @@ async def download_image(url):
 # 修改繪圖命令
 @bot.command(name='draw')
 async def draw(ctx, *, prompt):
-    wait_msg = None
+    metrics.route("draw")
+    await run_draw(ctx.channel, ctx.author, prompt)
+
+async def run_draw(channel, author, prompt):
+    """檢查後把繪圖加入背景工作佇列"""
+    # 系統資源不足時暫停高畫質繪圖
+    pressure = resource_monitor.should_shed()
+    if pressure:
+        await send_message(channel, f"{author.mention} 小青現在有點忙不過來（{pressure}），繪圖功能暫停一下，請稍後再試！")
+        return
+    
+    # OpenAI 不穩定時不排入佇列
+    if breakers.rejecting("images", "dall-e-3"):
+        await send_message(channel, f"{author.mention} 小青的畫筆暫時連不上（OpenAI 服務不穩定），請稍後再試！")
+        return
+    
+    try:
+        # 發送等待消息（排隊時會在後面加上排隊位置）
+        status_text = f"{author.mention} 小青正在畫畫～請稍等一下！"
+        wait_msg = await send_message(channel, status_text)
+        await job_queue.enqueue(
+            "draw",
+            {
+                "channel_id": channel.id,
+                "author_id": author.id,
+                "author_name": author.name,
+                "placeholder_id": wait_msg.id,
+                "status_text": status_text,
+                "prompt": prompt,
+            },
+            channel=channel,
+            placeholder=wait_msg,
+        )
+    except Exception as e:
+        logger.error(f"繪圖命令執行錯誤: {e}")
+        await send_message(channel, f"{author.mention} 繪圖時發生錯誤：{str(e)}")
+
+async def draw_job(job):
+    """背景工作：生成圖片並上傳到頻道"""
+    channel = job.channel
+    author = job.author
+    prompt = job.payload["prompt"]
     image_path = None
+    
     try:
-        async with ctx.typing():
-            # 發送等待消息
-            wait_msg = await ctx.send(f"{ctx.author.mention} 小青正在畫畫～請稍等一下！")
-            
-            # 檢查系統資源
-            try:
-                memory = psutil.virtual_memory()
-                if memory.percent > 90:
-                    print(f"警告：記憶體使用率過高 ({memory.percent}%)")
-                
-                disk = psutil.disk_usage('.')
-                if disk.free < 100 * 1024 * 1024:  # 少於 100MB
-                    print(f"警告：磁碟空間不足 ({disk.free / 1024 / 1024:.1f}MB)")
-            except Exception as e:
-                print(f"檢查系統資源時發生錯誤: {e}")
-            
+        async with channel.typing():
             # 生成圖片
             image_url = await generate_image(prompt)
             
@@ -1728,72 +6179,197 @@ async def draw(ctx, *, prompt):
             if file_size == 0:
                 raise Exception("生成的圖片文件為空")
             
-            print(f"圖片文件大小: {file_size / 1024:.1f}KB")
+            logger.debug("圖片文件大小: %.1fKB", file_size / 1024)
             
             # 發送圖片
             try:
                 with open(image_path, 'rb') as f:
                     file = discord.File(f, filename='generated_image.png')
-                    await ctx.send(f"{ctx.author.mention} 已完成繪圖！\n提示詞：{prompt}", file=file)
-                    print("圖片發送成功")
+                    await send_message(channel, f"{author.mention} 已完成繪圖！\n提示詞：{prompt}", file=file)
+                    logger.debug("圖片發送成功")
             except PermissionError:
                 raise Exception("沒有權限讀取圖片文件")
             except Exception as e:
-                print(f"發送圖片失敗: {e}")
+                logger.warning(f"發送圖片失敗: {e}")
                 raise Exception(f"無法發送圖片: {e}")
             
             # 刪除等待消息
-            if wait_msg:
-                await wait_msg.delete()
+            await job.remove_placeholder()
             
     except Exception as e:
-        print(f"繪圖命令執行錯誤: {e}")
-        if wait_msg:
-            try:
-                await wait_msg.delete()
-            except:
-                pass
-        await ctx.send(f"{ctx.author.mention} 繪圖時發生錯誤：{str(e)}")
+        logger.error(f"繪圖命令執行錯誤: {e}")
+        await job.remove_placeholder()
+        await send_message(channel, f"{author.mention} 繪圖時發生錯誤：{str(e)}")
+        raise
     finally:
         # 確保清理臨時文件
         if image_path and os.path.exists(image_path):
             try:
                 os.unlink(image_path)
-                print(f"成功刪除臨時文件: {image_path}")
+                logger.debug("成功刪除臨時文件: %s", image_path)
             except Exception as e:
-                print(f"刪除臨時文件失敗: {e}")
+                logger.warning(f"刪除臨時文件失敗: {e}")
 
-# 運行機器人
-try:
-    print("正在啟動機器人...")
-    print("檢查系統資源...")
-    
-    # 最終系統檢查
+# 註冊背景工作類型（同時執行數可用環境變數調整）
+# 長篇故事的各段平行撰寫，故事的執行緒池要容納每個工作的所有段落
+story_concurrency = int(os.getenv('JOB_CONCURRENCY_STORY', '2'))
+job_queue.register('story', story_job, story_concurrency, threads=story_concurrency * StoryService.MAX_SECTIONS)
+job_queue.register('draw', draw_job, int(os.getenv('JOB_CONCURRENCY_DRAW', '2')))
+
+# 斜線指令：先 defer 取得 15 分鐘的回覆時限，選項由 Discord 解析成對應型別
+class InteractionChannel:
+    """把 defer 後的 followup 包裝成頻道介面，讓斜線指令沿用 run_* 處理流程"""
+
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    @property
+    def id(self):
+        return self.interaction.channel_id
+
+    async def send(self, content=None, **kwargs):
+        # 第一則 followup 會取代「思考中」的佔位訊息
+        return await self.interaction.followup.send(content, wait=True, **kwargs)
+
+    @asynccontextmanager
+    async def typing(self):
+        # defer(thinking=True) 後 Discord 已顯示思考中
+        yield
+
+@asynccontextmanager
+async def slash_command(interaction, command):
+    """追蹤斜線指令並先 defer，回傳可傳給 run_* 的頻道"""
+    with metrics.trace_message():
+        await interaction.response.defer(thinking=True)
+        metrics.route(command)
+        yield InteractionChannel(interaction)
+
+async def sync_app_commands():
+    """向 Discord 註冊斜線指令"""
     try:
-        memory = psutil.virtual_memory()
-        disk = psutil.disk_usage('.')
-        print(f"記憶體使用率: {memory.percent}%")
-        print(f"磁碟使用率: {disk.percent}%")
-        print(f"可用磁碟空間: {disk.free / 1024 / 1024:.1f}MB")
+        synced = await bot.tree.sync()
+        logger.info(f"已同步 {len(synced)} 個斜線指令")
     except Exception as e:
-        print(f"系統檢查失敗: {e}")
+        logger.error(f"同步斜線指令時發生錯誤: {e}")
+
+@bot.tree.command(name='狀態', description='查看小青的系統狀態')
+@app_commands.guild_only()
+async def slash_status(interaction: discord.Interaction):
+    async with slash_command(interaction, "status") as channel:
+        await send_message(channel, f"{interaction.user.mention}\n{await build_status_report()}")
+
+@bot.tree.command(name='stats', description='查看各指令的延遲分位數與 token 用量')
+@app_commands.guild_only()
+async def slash_stats(interaction: discord.Interaction):
+    async with slash_command(interaction, "stats") as channel:
+        await send_message(channel, f"{interaction.user.mention}\n{metrics.format_stats()}")
+
+@bot.tree.command(name='回憶', description='在本伺服器的對話記錄中搜尋關鍵字')
+@app_commands.guild_only()
+@app_commands.rename(keyword='關鍵字')
+@app_commands.describe(keyword='要搜尋的關鍵字，多個關鍵字以空白分隔')
+async def slash_recall(interaction: discord.Interaction, keyword: str):
+    async with slash_command(interaction, "recall") as channel:
+        await run_recall(channel, interaction.guild, interaction.user, keyword)
+
+@bot.tree.command(name='吃什麼', description='依台灣時間推薦現在可以吃什麼')
+@app_commands.guild_only()
+async def slash_food(interaction: discord.Interaction):
+    async with slash_command(interaction, "food") as channel:
+        await run_food(channel, interaction.guild, interaction.user, '吃什麼')
+
+@bot.tree.command(name='塔羅', description='抽一張塔羅牌')
+@app_commands.guild_only()
+@app_commands.rename(question='問題')
+@app_commands.describe(question='想問的問題（留空只顯示牌義）')
+async def slash_tarot(interaction: discord.Interaction, question: str = ''):
+    async with slash_command(interaction, "tarot") as channel:
+        await run_tarot(channel, interaction.guild, interaction.user, f"塔羅牌 {question}".strip(), question.strip())
+
+@bot.tree.command(name='生成怪物', description='生成本月的三隻怪物')
+@app_commands.guild_only()
+async def slash_monster_spawn(interaction: discord.Interaction):
+    async with slash_command(interaction, "monster_spawn") as channel:
+        await run_monster_spawn(channel, interaction.guild, interaction.user)
+
+@bot.tree.command(name='世界王', description='召喚全伺服器共同攻擊的世界王')
+@app_commands.guild_only()
+async def slash_world_boss_spawn(interaction: discord.Interaction):
+    async with slash_command(interaction, "world_boss_spawn") as channel:
+        await run_world_boss_spawn(channel, interaction.guild, interaction.user)
+
+@bot.tree.command(name='攻擊', description='攻擊怪物')
+@app_commands.guild_only()
+@app_commands.rename(monster_name='怪物', damage='傷害')
+@app_commands.describe(monster_name='怪物名稱', damage='傷害值')
+async def slash_attack(interaction: discord.Interaction, monster_name: str, damage: app_commands.Range[int, 0]):
+    async with slash_command(interaction, "attack") as channel:
+        await run_attack(channel, interaction.guild, interaction.user, monster_name, damage)
+
+@slash_attack.autocomplete('monster_name')
+async def monster_name_autocomplete(interaction: discord.Interaction, current: str):
+    """列出本伺服器存活的怪物"""
+    names = await storage.get_alive_monsters(interaction.guild_id)
+    return [app_commands.Choice(name=name, value=name) for name in names if current in name][:25]
+
+@bot.tree.command(name='故事', description='讓小青創作一篇故事')
+@app_commands.guild_only()
+@app_commands.rename(word_count='字數', story_type='類型')
+@app_commands.describe(word_count='故事字數（預設 1000 字）', story_type='故事類型（預設現代）')
+@app_commands.choices(story_type=[app_commands.Choice(name=name, value=name) for name in story_service.story_types])
+async def slash_story(interaction: discord.Interaction, word_count: app_commands.Range[int, 100, 10000] = 1000, story_type: str = '現代'):
+    async with slash_command(interaction, "story") as channel:
+        await run_story(channel, interaction.guild, interaction.user, f"{word_count}字{story_type}故事", word_count, story_type)
+
+@bot.tree.command(name='draw', description='讓小青畫一張圖')
+@app_commands.guild_only()
+@app_commands.rename(prompt='提示詞')
+@app_commands.describe(prompt='想要畫的內容')
+async def slash_draw(interaction: discord.Interaction, prompt: str):
+    async with slash_command(interaction, "draw") as channel:
+        await run_draw(channel, interaction.user, prompt)
+
+# 運行機器人
+def main():
+    parser = argparse.ArgumentParser(description="小青 Discord 機器人")
+    parser.add_argument('--workers', type=int, default=0, help="以多個分片工作程序執行（0 表示單一程序）")
+    parser.add_argument('--shards', type=int, default=0, help="分片總數（預設與工作程序數相同）")
+    args = parser.parse_args()
+    
+    if not discord_token:
+        raise ValueError("缺少 DISCORD_TOKEN 環境變數")
+    if not openai_api_key:
+        raise ValueError("缺少 OPENAI_API_KEY 環境變數")
+    
+    if args.workers:
+        storage.shutdown()
+        chat_memory.shutdown()
+        job_queue.shutdown()
+        ShardSupervisor(args.shards or args.workers, args.workers).run()
+        log_listener.stop()
+        return
     
-    bot.run(discord_token)
-except KeyboardInterrupt:
-    print("正在關閉機器人...")
-    db_manager.close()
-    print("機器人已關閉")
-except Exception as e:
-    print(f"機器人運行錯誤: {e}")
-    print("嘗試關閉資料庫連接...")
-    try:
-        db_manager.close()
-    except Exception as close_error:
-        print(f"關閉資料庫連接時發生錯誤: {close_error}")
-    print("機器人已停止")
-finally:
     try:
-        db_manager.close()
-        print("資料庫連接已關閉")
+        # 系統資源檢查已移至連線後的背景健康檢查（小青!狀態 可查看結果）
+        logger.info("正在啟動機器人...")
+        bot.run(discord_token)
+    except KeyboardInterrupt:
+        logger.info("正在關閉機器人...")
+        logger.info("機器人已關閉")
     except Exception as e:
-        print(f"關閉資料庫連接時發生錯誤: {e}") 
\ No newline at end of file
+        logger.error(f"機器人運行錯誤: {e}")
+        logger.info("機器人已停止")
+    finally:
+        try:
+            storage.shutdown()
+            chat_memory.shutdown()
+            job_queue.shutdown()
+            logger.info("資料庫連接已關閉")
+        except Exception as e:
+            logger.error(f"關閉資料庫連接時發生錯誤: {e}")
+        loop_watchdog.stop()
+        # 將緩衝中的日誌全部寫出
+        log_listener.stop()
+
+if __name__ == '__main__':
+    main()